@@ -0,0 +1,558 @@
+#!/usr/bin/python3
+
+import argparse
+import contextlib
+import gc
+import hashlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy
+
+# Keep the pygame banner out of JSON written to stdout
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+from kac.brush import Brush, BrushTile
+from kac.cache import ParseCache
+from kac.extractor import iter_save_file_records, parse_save_file, write_save_file
+from kac.journal import Journal
+from kac.map import KacMap, MapWidget
+from kac.reader import ReaderMode
+from kac.synthetic import write_synthetic_save
+from kac.tile import TileType
+
+import typing
+if typing.TYPE_CHECKING:
+    from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+
+class BenchmarkSave(object):
+    """A save to run the benchmarks on, scale times as large as the source along each axis"""
+
+    def __init__(self, scale: int, path: str, size: int, cells: int) -> None:
+        self.scale = scale
+        self.path = path
+        self.size = size
+        self.cells = cells
+
+    @property
+    def label(self) -> str:
+        """The size of the save as a multiple of the cells of the source, e.g. 16x"""
+        return "{}x".format(self.scale * self.scale)
+
+
+def make_saves(source_file: str, scales: 'List[int]', work_dir: str) -> 'List[BenchmarkSave]':
+    """Write a synthetic save for each scale to work_dir; scale 1 is a plain copy of the source"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        objects, _ = parse_save_file(source_file)
+    source_cells = len(objects[KacMap.KeyCellSaveData].class_base.instances)
+    saves = []
+    for scale in scales:
+        path = os.path.join(work_dir, "world-{}".format(scale))
+        size = write_synthetic_save(source_file, scale, path)
+        saves.append(BenchmarkSave(scale, path, size, source_cells * scale * scale))
+    return saves
+
+
+def time_samples(function: 'Callable[[], Any]', repeat: int) -> 'List[float]':
+    """The wall time of each of repeat calls of function, with its output suppressed"""
+    samples = []
+    for _ in range(repeat):
+        gc.collect()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start_time = time.perf_counter()
+            function()
+            samples.append(time.perf_counter() - start_time)
+    return samples
+
+
+def time_call(function: 'Callable[[], Any]', repeat: int) -> float:
+    return min(time_samples(function, repeat))
+
+
+def add_result(results: 'List[Dict]', name: str, save: BenchmarkSave, samples: 'List[float]',
+               **metrics: 'Any') -> float:
+    """Record the samples of one benchmark on one save
+
+    :param metrics: Other measurements to report along with the timings
+    :return: The best of the samples, or 0 if there are none
+    """
+    results.append({
+        "benchmark": name,
+        "scale": save.scale * save.scale,
+        "cells": save.cells,
+        "bytes": save.size,
+        "seconds": min(samples) if samples else None,
+        "samples": samples,
+        "metrics": metrics,
+    })
+    return min(samples) if samples else 0.0
+
+
+def _open_map(save: BenchmarkSave, journal: bool=False) -> KacMap:
+    with contextlib.redirect_stdout(io.StringIO()):
+        objects, data = parse_save_file(save.path)
+        return KacMap(objects, data, Journal(data) if journal else None)
+
+
+def bench_parse(saves: 'List[BenchmarkSave]', repeat: int, results: 'List[Dict]') -> None:
+    print("==== PARSE ====")
+    print("{:>6} {:>8} {:>10} {:>10} {:>12}".format("scale", "cells", "bytes", "seconds", "us/cell"))
+    for save in saves:
+        elapsed = add_result(results, "parse", save, time_samples(lambda: parse_save_file(save.path), repeat))
+        print("{:>6} {:>8} {:>10} {:>10.4f} {:>12.2f}".format(save.label, save.cells, save.size, elapsed,
+                                                               elapsed * 1e6 / save.cells))
+
+
+def bench_reader(saves: 'List[BenchmarkSave]', repeat: int, results: 'List[Dict]') -> None:
+    print("==== READER MODES ====")
+    print("{:>6} {:>10} {:>10} {:>10} {:>8}".format("scale", "bytes", "file", "buffer", "speedup"))
+    for save in saves:
+        file_time = add_result(results, "parse.file", save,
+                               time_samples(lambda: parse_save_file(save.path, ReaderMode.File), repeat))
+        buffer_time = add_result(results, "parse.buffer", save,
+                                 time_samples(lambda: parse_save_file(save.path, ReaderMode.Buffer), repeat))
+        print("{:>6} {:>10} {:>10.4f} {:>10.4f} {:>7.2f}x".format(save.label, save.size, file_time, buffer_time,
+                                                                  file_time / buffer_time))
+
+
+def _read_town_name(save_file: str) -> str:
+    for record in iter_save_file_records(save_file, [KacMap.KeyTownName], decode=True):
+        return record.instance["townName"].value
+
+
+def bench_scan(saves: 'List[BenchmarkSave]', repeat: int, results: 'List[Dict]') -> None:
+    print("==== RECORD SCAN ====")
+    print("{:>6} {:>10} {:>10} {:>10} {:>10}".format("scale", "bytes", "parse", "scan", "town name"))
+    for save in saves:
+        parse_time = time_call(lambda: parse_save_file(save.path), repeat)
+        scan_time = add_result(results, "scan.all", save,
+                               time_samples(lambda: sum(1 for _ in iter_save_file_records(save.path)), repeat))
+        name_time = add_result(results, "scan.town_name", save,
+                               time_samples(lambda: _read_town_name(save.path), repeat))
+        print("{:>6} {:>10} {:>10.4f} {:>10.4f} {:>10.4f}".format(save.label, save.size, parse_time, scan_time,
+                                                                  name_time))
+
+
+def bench_memory(saves: 'List[BenchmarkSave]', results: 'List[Dict]') -> None:
+    print("==== MEMORY ====")
+    print("{:>6} {:>8} {:>10} {:>12} {:>12} {:>12}".format("scale", "cells", "bytes", "parsed", "map", "decoded"))
+    for save in saves:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            # Bytes per cell of everything but the save buffer itself, after parsing, after opening the
+            # map, and once every member of every cell has been decoded
+            with contextlib.redirect_stdout(io.StringIO()):
+                objects, data = parse_save_file(save.path)
+                cells = objects[KacMap.KeyCellSaveData].class_base.instances
+                parsed = tracemalloc.get_traced_memory()[0] - len(data)
+                map_obj = KacMap(objects, data)
+                opened = tracemalloc.get_traced_memory()[0] - len(data)
+                for cell in cells:
+                    cell.values
+                    cell["type"].values
+                decoded = tracemalloc.get_traced_memory()[0] - len(data)
+        finally:
+            tracemalloc.stop()
+        count = len(cells)
+        add_result(results, "memory", save, [], parsed=parsed / count, map=opened / count, decoded=decoded / count)
+        print("{:>6} {:>8} {:>10} {:>12.1f} {:>12.1f} {:>12.1f}".format(
+            save.label, count, save.size, parsed / count, opened / count, decoded / count))
+        del objects, data, cells, map_obj
+
+
+def bench_cache(saves: 'List[BenchmarkSave]', repeat: int, results: 'List[Dict]') -> None:
+    print("==== PARSE CACHE ====")
+    print("{:>6} {:>10} {:>10} {:>10} {:>10} {:>8}".format("scale", "bytes", "entry", "parse", "cached", "speedup"))
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for save in saves:
+            cache = ParseCache(os.path.join(cache_dir, save.label))
+            with contextlib.redirect_stdout(io.StringIO()):
+                _, data = cache.parse_file(save.path)
+            digest = cache.resolve(hashlib.sha256(data).hexdigest())
+            entry_size = os.path.getsize(os.path.join(cache.root, digest + ".idx"))
+            parse_time = time_call(lambda: parse_save_file(save.path), repeat)
+            cached_time = add_result(results, "parse.cached", save,
+                                     time_samples(lambda: ParseCache(cache.root).parse_file(save.path), repeat),
+                                     entry_bytes=entry_size)
+            print("{:>6} {:>10} {:>10} {:>10.4f} {:>10.4f} {:>7.2f}x".format(
+                save.label, save.size, entry_size, parse_time, cached_time, parse_time / cached_time))
+
+
+def bench_map(saves: 'List[BenchmarkSave]', repeat: int, results: 'List[Dict]') -> None:
+    print("==== MAP ====")
+    print("{:>6} {:>8} {:>10} {:>10}".format("scale", "cells", "init", "grid"))
+    for save in saves:
+        with contextlib.redirect_stdout(io.StringIO()):
+            objects, data = parse_save_file(save.path)
+        init_samples, grid_samples = [], []
+        for _ in range(repeat):
+            # The grid and colors are built on first use, so each sample needs a new map
+            gc.collect()
+            with contextlib.redirect_stdout(io.StringIO()):
+                start_time = time.perf_counter()
+                map_obj = KacMap(objects, data)
+                init_samples.append(time.perf_counter() - start_time)
+                start_time = time.perf_counter()
+                map_obj.color_indices
+                grid_samples.append(time.perf_counter() - start_time)
+        init_time = add_result(results, "map.init", save, init_samples)
+        grid_time = add_result(results, "map.grid", save, grid_samples)
+        print("{:>6} {:>8} {:>10.4f} {:>10.4f}".format(save.label, save.cells, init_time, grid_time))
+
+
+def bench_edit(saves: 'List[BenchmarkSave]', repeat: int, results: 'List[Dict]') -> None:
+    print("==== EDIT ====")
+    print("{:>6} {:>8} {:>10} {:>10} {:>10}".format("scale", "cells", "stroke", "farms", "clear"))
+    for save in saves:
+        # Edit as the editor does, recording every change for undo
+        map_obj = _open_map(save, journal=True)
+        map_obj.color_indices
+        brush = Brush()
+        brush.size = 3
+        brush.tile = BrushTile.LandFertile
+        end = (map_obj.width - 1, map_obj.height - 1)
+        stroke_time = add_result(results, "edit.stroke", save,
+                                 time_samples(lambda: brush.stroke(map_obj, (0, 0), end), repeat))
+        farms_time = add_result(results, "edit.turn_all_farms", save,
+                                time_samples(lambda: map_obj.turn_all_farms(), repeat))
+        clear_time = add_result(results, "edit.clear", save, time_samples(lambda: map_obj.clear(), repeat))
+        print("{:>6} {:>8} {:>10.4f} {:>10.4f} {:>10.4f}".format(save.label, save.cells, stroke_time, farms_time,
+                                                                 clear_time))
+
+
+class _BuildingMap(object):
+    """A map with buildings added on some tiles, so that saves without any still show how buildings are drawn"""
+
+    def __init__(self, map_obj: KacMap, positions: 'Set[Tuple[int, int]]') -> None:
+        self._map = map_obj
+        self._positions = positions
+
+    def __getattr__(self, name: str) -> 'Any':
+        return getattr(self._map, name)
+
+    def get_object(self, x: int, y: int) -> 'Optional[str]':
+        return "building" if (x, y) in self._positions else self._map.get_object(x, y)
+
+    def object_positions(self) -> 'List[Tuple[int, int]]':
+        return sorted(self._positions.union(self._map.object_positions()))
+
+
+def check_render_parity(map_obj: KacMap, screen: 'Any', size: int, buildings: int=20) -> 'Optional[int]':
+    """Count the pixels that differ between a full redraw of a map and a repaint of each of its tiles
+
+    Buildings are added on the first tiles with trees, and on as many
+    tiles without, since tiles with both are where the two paths are
+    most likely to disagree.
+
+    :return: The number of differing pixels, or None if tiles are too small to be repainted one by one
+    """
+    import pygame
+    grid = map_obj.grid
+    trees = (grid.type == TileType.Land) & (grid.amount > 0)
+    positions = set()
+    for mask in (trees, ~trees):
+        positions.update((int(j), int(i)) for i, j in numpy.argwhere(mask)[:buildings])
+    widget = MapWidget(0, 0, size, size, _BuildingMap(map_obj, positions))
+    widget.render(screen)
+    if widget.scaled:
+        return None
+    full = pygame.surfarray.array3d(screen)
+    widget.mark_dirty((j, i) for i in range(map_obj.height) for j in range(map_obj.width))
+    widget.render(screen)
+    return int(numpy.any(full != pygame.surfarray.array3d(screen), axis=2).sum())
+
+
+def bench_render(saves: 'List[BenchmarkSave]', repeat: int, results: 'List[Dict]', size: int) -> None:
+    # Render offscreen unless a display was asked for explicitly
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    import pygame
+    pygame.display.init()
+    screen = pygame.display.set_mode((size, size))
+
+    print("==== RENDER {0}x{0} ====".format(size))
+    print("{:>6} {:>8} {:>8} {:>10} {:>10} {:>8} {:>9}".format("scale", "tiles", "tile px", "per-tile", "vectorized",
+                                                                "speedup", "mismatch"))
+    for save in saves:
+        map_obj = _open_map(save)
+        widget = MapWidget(0, 0, size, size, map_obj)
+        widget.render(screen)
+
+        def render_full():
+            widget.invalidate()
+            widget.render(screen)
+
+        def render_tiles():
+            widget.mark_dirty((j, i) for i in range(map_obj.height) for j in range(map_obj.width))
+            widget.render(screen)
+
+        full_time = add_result(results, "render.full", save, time_samples(render_full, repeat), size=size)
+        if widget.scaled:
+            # Tiles are smaller than a pixel, so there is no per-tile path to compare against
+            print("{:>6} {:>8} {:>8} {:>10} {:>10.4f} {:>8} {:>9}".format(
+                save.label, save.cells, "<1", "-", full_time, "-", "-"))
+            continue
+        tile_time = add_result(results, "render.tiles", save, time_samples(render_tiles, repeat), size=size)
+        # Both paths must draw the same pixels, since the editor mixes them
+        mismatch = check_render_parity(map_obj, screen, size)
+        add_result(results, "render.parity", save, [], mismatched_pixels=mismatch)
+        print("{:>6} {:>8} {:>8} {:>10.4f} {:>10.4f} {:>7.2f}x {:>9}".format(
+            save.label, save.cells, widget.tile_size[0], tile_time, full_time, tile_time / full_time, mismatch))
+    pygame.display.quit()
+
+
+def bench_write(saves: 'List[BenchmarkSave]', repeat: int, results: 'List[Dict]') -> None:
+    print("==== WRITE ====")
+    print("{:>6} {:>10} {:>10} {:>10}".format("scale", "bytes", "seconds", "MB/s"))
+    with tempfile.TemporaryDirectory() as output_dir:
+        output_file = os.path.join(output_dir, "world")
+        for save in saves:
+            map_obj = _open_map(save)
+            elapsed = add_result(results, "write", save,
+                                 time_samples(lambda: write_save_file(output_file, map_obj.file), repeat))
+            print("{:>6} {:>10} {:>10.4f} {:>10.1f}".format(save.label, save.size, elapsed,
+                                                            save.size / elapsed / 1e6))
+
+
+BENCHMARKS = ("parse", "reader", "scan", "memory", "cache", "map", "edit", "render", "write")
+
+
+def run_benchmarks(saves: 'List[BenchmarkSave]', benchmarks: 'List[str]', repeat: int,
+                   render_size: int) -> 'List[Dict]':
+    """Run the named benchmarks on every save, printing a table for each
+
+    :return: One result per benchmark and save, see add_result
+    """
+    results = []  # type: List[Dict]
+    for name in benchmarks:
+        if name == "memory":
+            bench_memory(saves, results)
+        elif name == "render":
+            bench_render(saves, repeat, results, render_size)
+        else:
+            globals()["bench_" + name](saves, repeat, results)
+    return results
+
+
+def _git(*arguments: str) -> 'Optional[str]':
+    try:
+        output = subprocess.run(("git", ) + arguments, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.stdout.decode("utf-8").strip()
+
+
+def machine_name() -> str:
+    """Identifies this machine in the benchmark history; results are only compared on the same machine"""
+    return "{}-{}-py{}".format(platform.node() or "unknown", platform.machine(), platform.python_version())
+
+
+def make_run(source_file: str, repeat: int, results: 'List[Dict]', machine: str) -> 'Dict':
+    """A benchmark run as stored in the history and written as JSON"""
+    return {
+        "commit": _git("rev-parse", "HEAD"),
+        "dirty": bool(_git("status", "--porcelain", "--untracked-files=no")),
+        "machine": machine,
+        "source": os.path.basename(source_file),
+        "time": time.time(),
+        "repeat": repeat,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+
+def write_report(output_file: str, run: 'Dict') -> None:
+    """Write a run as JSON to output_file, or to stdout if it is -"""
+    if output_file == "-":
+        json.dump(run, sys.stdout, indent=2)
+        print()
+    else:
+        with open(output_file, mode="w") as new_file:
+            json.dump(run, new_file, indent=2)
+
+
+class BenchmarkHistory(object):
+    """Benchmark runs stored in a JSON file, one per commit and machine
+
+    Running the benchmarks again on the same commit and machine replaces
+    the stored run, so the history holds the latest numbers of each.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.runs = []  # type: List[Dict]
+        if os.path.isfile(path):
+            with open(path, mode="r") as file:
+                self.runs = json.load(file)["runs"]
+
+    def add(self, run: 'Dict') -> None:
+        self.runs = [stored for stored in self.runs
+                     if (stored["commit"], stored["machine"]) != (run["commit"], run["machine"])]
+        self.runs.append(run)
+
+    def save(self) -> None:
+        temp_path = self.path + ".tmp"
+        with open(temp_path, mode="w") as new_file:
+            json.dump({"version": 1, "runs": self.runs}, new_file)
+        os.replace(temp_path, self.path)
+
+    def find(self, ref: str, machine: str, exclude: 'Optional[str]'=None) -> 'Dict':
+        """The stored run of a commit on a machine
+
+        :param ref: A git revision or commit hash prefix, or "latest" for the newest
+                    run on the machine of a commit other than exclude
+        :param machine: The machine the run was made on
+        :param exclude: The commit being compared, which is never its own baseline
+        """
+        runs = [run for run in self.runs if run["machine"] == machine]
+        if ref == "latest":
+            runs = [run for run in runs if run["commit"] != exclude]
+            if len(runs) == 0:
+                raise ValueError("No earlier benchmark runs on {} in {}".format(machine, self.path))
+            return max(runs, key=lambda run: run["time"])
+        commit = _git("rev-parse", "--verify", "--quiet", ref + "^{commit}") or ref
+        matches = [run for run in runs if run["commit"] is not None and run["commit"].startswith(commit)]
+        if len(matches) == 0:
+            raise ValueError("No benchmark run of {} on {} in {}".format(ref, machine, self.path))
+        return max(matches, key=lambda run: run["time"])
+
+
+def _quartiles(samples: 'List[float]') -> 'List[float]':
+    return [float(value) for value in numpy.percentile(samples, [25, 50, 75])]
+
+
+def compare_runs(baseline: 'Dict', run: 'Dict', threshold: float) -> 'List[Dict]':
+    """Compare the timings of two runs, benchmark by benchmark
+
+    A benchmark regressed if its median grew by more than threshold and
+    the interquartile ranges of the two runs do not overlap, so that a
+    slowdown within the noise of either run is not reported. Improvements
+    are detected the same way.
+
+    :param threshold: The relative change in median to ignore, e.g. 0.1 for 10%
+    :return: One comparison per benchmark and scale timed in both runs
+    """
+    baseline_results = {(result["benchmark"], result["scale"]): result for result in baseline["results"]}
+    comparisons = []
+    for result in run["results"]:
+        old = baseline_results.get((result["benchmark"], result["scale"]))
+        if old is None or len(old["samples"]) == 0 or len(result["samples"]) == 0:
+            continue
+        old_q1, old_median, old_q3 = _quartiles(old["samples"])
+        new_q1, new_median, new_q3 = _quartiles(result["samples"])
+        change = new_median / old_median - 1.0 if old_median > 0 else 0.0
+        if change > threshold and new_q1 > old_q3:
+            status = "regressed"
+        elif change < -threshold and new_q3 < old_q1:
+            status = "improved"
+        else:
+            status = "ok"
+        comparisons.append({
+            "benchmark": result["benchmark"],
+            "scale": result["scale"],
+            "baseline": old_median,
+            "baseline_iqr": old_q3 - old_q1,
+            "current": new_median,
+            "current_iqr": new_q3 - new_q1,
+            "change": change,
+            "status": status,
+        })
+    return comparisons
+
+
+def print_comparison(baseline: 'Dict', comparisons: 'List[Dict]') -> None:
+    print("==== COMPARED TO {}{} ====".format((baseline["commit"] or "unknown")[:12],
+                                             " (dirty)" if baseline["dirty"] else ""))
+    print("{:<22} {:>6} {:>10} {:>8} {:>10} {:>8} {:>8} {:>9}".format(
+        "benchmark", "scale", "baseline", "iqr", "current", "iqr", "change", "status"))
+    for comparison in comparisons:
+        print("{:<22} {:>5}x {:>10.4f} {:>8.4f} {:>10.4f} {:>8.4f} {:>+7.1f}% {:>9}".format(
+            comparison["benchmark"], comparison["scale"], comparison["baseline"], comparison["baseline_iqr"],
+            comparison["current"], comparison["current_iqr"], comparison["change"] * 100.0,
+            comparison["status"].upper() if comparison["status"] == "regressed" else comparison["status"]))
+    regressed = [comparison for comparison in comparisons if comparison["status"] == "regressed"]
+    print("{} benchmarks compared, {} regressed, {} improved".format(
+        len(comparisons), len(regressed), sum(1 for comparison in comparisons if comparison["status"] == "improved")))
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Kingdoms and Castles editor benchmarks")
+    parser.add_argument("--input", "-i", help="The save to scale up", default="./test/world")
+    parser.add_argument("--scales", "-s", help="Comma separated map scale factors, per axis; 1,2,4 gives saves "
+                                               "with 1x, 4x and 16x the cells of the input", default="1,2,4")
+    parser.add_argument("--repeat", "-r", help="Number of timed runs per benchmark; use 5 or more when comparing "
+                                               "against a baseline", type=int, default=3)
+    parser.add_argument("--render-size", help="Size in pixels of the map widget to render", type=int, default=640)
+    parser.add_argument("--benchmarks", "-b", help="Comma separated benchmarks to run, out of "
+                                                   "{}".format(",".join(BENCHMARKS)), default=",".join(BENCHMARKS))
+    parser.add_argument("--json", "-j", help="Also write the results as JSON to this file, - for stdout")
+    parser.add_argument("--generate", "-g", help="Only write the synthetic saves to this directory")
+    parser.add_argument("--history", help="The file benchmark runs are stored in",
+                        default="./benchmark-history.json")
+    parser.add_argument("--record", help="Store this run in the history, replacing any earlier run of the same "
+                                         "commit on this machine", action="store_true")
+    parser.add_argument("--baseline", help="Compare against the stored run of this commit, or of the latest "
+                                           "other commit with 'latest', and fail on regressions")
+    parser.add_argument("--threshold", help="Relative slowdown of the median to tolerate when comparing",
+                        type=float, default=0.1)
+    parser.add_argument("--machine", help="Name of this machine in the history", default=machine_name())
+    args = parser.parse_args()
+
+    scales = [int(scale) for scale in args.scales.split(",")]
+    benchmarks = [name.strip() for name in args.benchmarks.split(",")]
+    for name in benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("Unknown benchmark {}; expected one of {}".format(name, ", ".join(BENCHMARKS)))
+    repeat = max(1, args.repeat)
+
+    if args.generate is not None:
+        os.makedirs(args.generate, exist_ok=True)
+        for save in make_saves(args.input, scales, args.generate):
+            print("{} {} cells, {} bytes".format(save.path, save.cells, save.size))
+        return 0
+
+    history = BenchmarkHistory(args.history)
+    # Keep stdout clean for the JSON report
+    tables = sys.stderr if args.json == "-" else sys.stdout
+    with tempfile.TemporaryDirectory() as work_dir:
+        saves = make_saves(args.input, scales, work_dir)
+        with contextlib.redirect_stdout(tables):
+            results = run_benchmarks(saves, benchmarks, repeat, args.render_size)
+    run = make_run(args.input, repeat, results, args.machine)
+    if args.json is not None:
+        write_report(args.json, run)
+
+    mismatched = [result for result in results if result["metrics"].get("mismatched_pixels")]
+    for result in mismatched:
+        print("Full and per-tile rendering differ in {} pixels at {}x".format(
+            result["metrics"]["mismatched_pixels"], result["scale"]), file=sys.stderr)
+
+    regressed = False
+    if args.baseline is not None:
+        try:
+            baseline = history.find(args.baseline, args.machine, exclude=run["commit"])
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            return 2
+        comparisons = compare_runs(baseline, run, args.threshold)
+        with contextlib.redirect_stdout(tables):
+            print_comparison(baseline, comparisons)
+        regressed = any(comparison["status"] == "regressed" for comparison in comparisons)
+    if args.record:
+        history.add(run)
+        history.save()
+    return 1 if regressed or len(mismatched) > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,195 @@
+import hashlib
+import json
+import os
+import time
+import zlib
+
+from kac.fileio import write_atomic
+
+import typing
+if typing.TYPE_CHECKING:
+    from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+
+DEFAULT_STORE = os.path.join(os.path.expanduser("~"), ".kac-backups")
+
+# Edits never move data around in a save, so fixed-size chunks line up
+# between backups of the same save and unchanged chunks are shared
+CHUNK_SIZE = 4096
+
+
+class BackupStore(object):
+    """Deduplicated store of save backups
+
+    A backup is a JSON manifest listing the SHA-256 of each CHUNK_SIZE
+    chunk of the save. Chunks are stored zlib-compressed under their
+    hash, once, however many backups contain them, so backing up a save
+    that changed in a few places only costs the chunks that changed.
+
+    Layout of the store directory:
+      objects/<2 hex digits>/<sha256>   compressed chunks
+      manifests/<id>.json               one per backup
+    """
+
+    def __init__(self, root: str=DEFAULT_STORE) -> None:
+        self.root = root
+        self._objects = os.path.join(root, "objects")
+        self._manifests = os.path.join(root, "manifests")
+
+    def backup(self, save_file: str) -> 'Dict[str, Any]':
+        """Back up a save file
+
+        :return: The manifest of the backup; if the save is unchanged since
+                 its last backup, that backup's manifest
+        """
+        with open(save_file, mode="rb") as file:
+            data = file.read()
+        source = os.path.abspath(save_file)
+        digest = hashlib.sha256(data).hexdigest()
+        previous = self.list(source)
+        if len(previous) > 0 and previous[-1]["sha256"] == digest:
+            return previous[-1]
+
+        # Backups of different saves with the same contents still get their own id
+        key = hashlib.sha256((source + digest).encode("utf-8")).hexdigest()
+        chunks = []
+        for start in range(0, len(data), CHUNK_SIZE):
+            chunks.append(self._put_chunk(data[start:start + CHUNK_SIZE]))
+        manifest = {
+            "id": time.strftime("%Y%m%d%H%M%S") + "-" + key[:12],
+            "source": source,
+            "time": time.time(),
+            "size": len(data),
+            "sha256": digest,
+            "chunks": chunks,
+        }
+        os.makedirs(self._manifests, exist_ok=True)
+        write_atomic(self._manifest_path(manifest["id"]), json.dumps(manifest).encode("utf-8"))
+        return manifest
+
+    def list(self, source: 'Optional[str]'=None) -> 'List[Dict[str, Any]]':
+        """The manifests of all backups, or of one save's backups, oldest first"""
+        if not os.path.isdir(self._manifests):
+            return []
+        if source is not None:
+            source = os.path.abspath(source)
+        manifests = []
+        for name in os.listdir(self._manifests):
+            if not name.endswith(".json"):
+                continue
+            with open(os.path.join(self._manifests, name), mode="r") as file:
+                manifest = json.load(file)
+            if source is None or manifest["source"] == source:
+                manifests.append(manifest)
+        manifests.sort(key=lambda manifest: (manifest["time"], manifest["id"]))
+        return manifests
+
+    def get(self, backup_id: str) -> 'Dict[str, Any]':
+        path = self._manifest_path(backup_id)
+        if not os.path.isfile(path):
+            raise ValueError("No backup {} in {}".format(backup_id, self.root))
+        with open(path, mode="r") as file:
+            return json.load(file)
+
+    def read(self, backup_id: str) -> bytes:
+        """The contents of a backed up save, checked against its hash"""
+        manifest = self.get(backup_id)
+        data = b"".join(self._get_chunk(chunk) for chunk in manifest["chunks"])
+        if hashlib.sha256(data).hexdigest() != manifest["sha256"]:
+            raise ValueError("Backup {} is corrupt".format(backup_id))
+        return data
+
+    def restore(self, backup_id: str, output_file: 'Optional[str]'=None) -> str:
+        """Write a backed up save to output_file, or back where it came from
+
+        A save that would be overwritten is backed up first.
+
+        :return: The path written to
+        """
+        data = self.read(backup_id)
+        if output_file is None:
+            output_file = self.get(backup_id)["source"]
+        if os.path.isfile(output_file):
+            self.backup(output_file)
+        with open(output_file, mode="wb") as new_file:
+            new_file.write(data)
+        return output_file
+
+    def prune(self, keep: int, source: 'Optional[str]'=None) -> 'Dict[str, int]':
+        """Keep only the newest backups of each save, then delete unreferenced chunks
+
+        :param keep: How many backups to keep per save
+        :param source: Only prune the backups of this save
+        :return: The number of backups and chunks removed and the bytes freed
+        """
+        by_source = {}  # type: Dict[str, List[Dict[str, Any]]]
+        for manifest in self.list(source):
+            by_source.setdefault(manifest["source"], []).append(manifest)
+
+        removed = 0
+        for manifests in by_source.values():
+            for manifest in manifests[:max(0, len(manifests) - keep)]:
+                os.remove(self._manifest_path(manifest["id"]))
+                removed += 1
+
+        live = set()
+        for manifest in self.list():
+            live.update(manifest["chunks"])
+        chunks, freed = 0, 0
+        for chunk, path in self._chunk_files():
+            if chunk not in live:
+                freed += os.path.getsize(path)
+                os.remove(path)
+                chunks += 1
+        return {"backups": removed, "chunks": chunks, "bytes": freed}
+
+    def stats(self) -> 'Dict[str, int]':
+        """How much space the store takes compared to plain copies of every backup"""
+        manifests = self.list()
+        chunk_bytes = sum(os.path.getsize(path) for _, path in self._chunk_files())
+        manifest_bytes = sum(os.path.getsize(self._manifest_path(manifest["id"])) for manifest in manifests)
+        logical = sum(manifest["size"] for manifest in manifests)
+        stored = chunk_bytes + manifest_bytes
+        return {
+            "backups": len(manifests),
+            "sources": len(set(manifest["source"] for manifest in manifests)),
+            "chunks": sum(1 for _ in self._chunk_files()),
+            "logical_bytes": logical,
+            "stored_bytes": stored,
+            "saved_bytes": logical - stored,
+        }
+
+    def _manifest_path(self, backup_id: str) -> str:
+        return os.path.join(self._manifests, backup_id + ".json")
+
+    def _chunk_path(self, chunk: str) -> str:
+        return os.path.join(self._objects, chunk[:2], chunk)
+
+    def _chunk_files(self) -> 'Iterator[Tuple[str, str]]':
+        if not os.path.isdir(self._objects):
+            return
+        for prefix in os.listdir(self._objects):
+            directory = os.path.join(self._objects, prefix)
+            for chunk in os.listdir(directory):
+                if not chunk.endswith(".tmp"):
+                    yield chunk, os.path.join(directory, chunk)
+
+    def _put_chunk(self, chunk: bytes) -> str:
+        digest = hashlib.sha256(chunk).hexdigest()
+        path = self._chunk_path(digest)
+        if not os.path.isfile(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_atomic(path, zlib.compress(chunk))
+        return digest
+
+    def _get_chunk(self, chunk: str) -> bytes:
+        path = self._chunk_path(chunk)
+        if not os.path.isfile(path):
+            raise ValueError("Missing chunk {} in {}".format(chunk, self.root))
+        with open(path, mode="rb") as file:
+            return zlib.decompress(file.read())
+
+
+def backup_save(save_file: str, store: 'Optional[str]'=None) -> 'Dict[str, Any]':
+    """Back up a save to the store at store, or the default store"""
+    return BackupStore(store or DEFAULT_STORE).backup(save_file)
@@ -0,0 +1,238 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import contextlib
+import glob
+import io
+import os
+import time
+
+from kac.backup import DEFAULT_STORE, backup_save
+from kac.brush import Brush, BrushTile
+from kac.cache import DEFAULT_CACHE_LIMIT, ParseCache
+from kac.extractor import parse_save_file, write_save_file
+from kac.grid import polygon_mask, rect_mask
+from kac.map import KacMap
+from kac.patch import apply_patch_file, read_patch, write_patch
+from kac.tile import TileType
+
+import typing
+if typing.TYPE_CHECKING:
+    from typing import Callable, Dict, Iterator, List, Optional, Tuple
+    import numpy
+
+
+_BULK_OPERATIONS = {
+    "fertilize": KacMap.fertilize,
+    "clear": KacMap.clear,
+    "salt-water": KacMap.salt_water,
+    "strip-trees": KacMap.strip_trees,
+}
+
+
+def _brush_operation(arguments: 'List[str]') -> 'Callable[[KacMap], None]':
+    if len(arguments) not in (2, 3):
+        raise ValueError("brush expects brush:<tile>:<x>,<y>[:<size>]")
+    try:
+        tile = BrushTile[arguments[0]]
+    except KeyError:
+        raise ValueError("Unknown brush tile {}; expected one of {}".format(
+            arguments[0], ", ".join(tile.name for tile in BrushTile)))
+    x, y = (int(value) for value in arguments[1].split(","))
+    brush = Brush()
+    brush.tile = tile
+    if len(arguments) == 3:
+        brush.size = int(arguments[2])
+    return lambda map_obj: brush.apply(map_obj, x, y)
+
+
+def _parse_tile_type(text: str) -> int:
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        return TileType[text]
+    except KeyError:
+        raise ValueError("Unknown tile type {}; expected one of {}".format(
+            text, ", ".join(tile_type.name for tile_type in TileType)))
+
+
+def _parse_region(text: str) -> 'Callable[[KacMap], numpy.ndarray]':
+    kind, _, points = text.partition(":")
+    if kind == "rect":
+        x, y, width, height = (int(value) for value in points.split(","))
+        return lambda map_obj: rect_mask(map_obj.grid.shape, x, y, width, height)
+    if kind == "poly":
+        vertices = [tuple(float(value) for value in point.split(",")) for point in points.split(";")]
+        if any(len(vertex) != 2 for vertex in vertices):
+            raise ValueError("Polygon points must be x,y pairs separated by ';'")
+        return lambda map_obj: polygon_mask(map_obj.grid.shape, vertices)
+    raise ValueError("Unknown region {}; expected rect:x,y,w,h or poly:x,y;x,y;...".format(text))
+
+
+def parse_operation(text: str) -> 'Callable[[KacMap], None]':
+    """Turn an operation string into a function editing a map
+
+    Supported operations are:
+      fertilize                       turn all land fertile+
+      clear                           turn the whole map into deep water
+      salt-water                      turn all shallow water into salt water
+      strip-trees                     remove every tree
+      replace:<type>:<type>           change tiles of one type into another, e.g. replace:Rock:Land
+      brush:<tile>:<x>,<y>[:<size>]   paint one brush stamp, e.g. brush:WaterSalt:10,12:3
+
+    All but brush may be limited to a region by appending @rect:x,y,w,h
+    or @poly:x,y;x,y;..., e.g. clear@rect:0,0,20,10.
+
+    :param text: The operation to parse
+    :return: A function applying the operation to a KacMap
+    """
+    operation, _, region_text = text.strip().partition("@")
+    parts = operation.split(":")
+    name = parts[0].lower()
+    if name == "brush":
+        if region_text:
+            raise ValueError("brush does not take a region")
+        return _brush_operation(parts[1:])
+
+    region = _parse_region(region_text) if region_text else (lambda map_obj: None)
+    if name == "replace" and len(parts) == 3:
+        old, new = _parse_tile_type(parts[1]), _parse_tile_type(parts[2])
+        return lambda map_obj: map_obj.replace_type(old, new, region(map_obj))
+    if len(parts) == 1 and name in _BULK_OPERATIONS:
+        function = _BULK_OPERATIONS[name]
+        return lambda map_obj: function(map_obj, mask=region(map_obj))
+    raise ValueError("Unknown operation: {}".format(text))
+
+
+def expand_inputs(inputs: 'List[str]') -> 'List[str]':
+    """Expand directories and glob patterns into a sorted list of save files"""
+    paths = set()
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            matches = [os.path.join(pattern, name) for name in os.listdir(pattern)]
+        else:
+            matches = glob.glob(pattern)
+        paths.update(path for path in matches if os.path.isfile(path))
+    return sorted(paths)
+
+
+def _write(cache: 'Optional[ParseCache]', path: str, data: bytearray) -> None:
+    if cache is None:
+        write_save_file(path, data)
+    else:
+        cache.write_file(path, data)
+
+
+def process_save(path: str, operations: 'List[str]', output_dir: 'Optional[str]'=None,
+                 backup_store: 'Optional[str]'=DEFAULT_STORE, patch: bool=False,
+                 cache_dir: 'Optional[str]'=None, cache_limit: 'Optional[int]'=DEFAULT_CACHE_LIMIT) -> 'Dict':
+    """Apply operations to one save file
+
+    This runs in a worker process, so it takes and returns only plain
+    data. Errors are caught and reported in the result rather than
+    raised, so one broken save does not stop the batch.
+
+    :param path: The save to edit
+    :param operations: Operation strings, see parse_operation
+    :param output_dir: Where to write the edited save; the save is edited in place if None
+    :param backup_store: The backup store to back the save up to before editing it in place; None for no backup
+    :param patch: Write only a <save>.kacpatch patch of the changes, leaving the save untouched
+    :param cache_dir: Load and store parsed saves in the ParseCache at this directory
+    :param cache_limit: The most bytes the cache may take, see ParseCache
+    :return: A dict with the path, any error, and the time taken by each phase
+    """
+    result = {"path": path, "error": None, "timings": {}}
+    timings = result["timings"]
+    start_time = time.perf_counter()
+    try:
+        functions = [parse_operation(operation) for operation in operations]
+        with contextlib.redirect_stdout(io.StringIO()):
+            phase_start = time.perf_counter()
+            cache = None if cache_dir is None else ParseCache(cache_dir, cache_limit)
+            objects, data = parse_save_file(path) if cache is None else cache.parse_file(path)
+            original = bytes(data) if patch else None
+            map_obj = KacMap(objects, data)
+            timings["parse"] = time.perf_counter() - phase_start
+
+            phase_start = time.perf_counter()
+            for function in functions:
+                function(map_obj)
+            timings["edit"] = time.perf_counter() - phase_start
+
+        phase_start = time.perf_counter()
+        if patch:
+            patch_dir = os.path.dirname(path) if output_dir is None else output_dir
+            write_patch(os.path.join(patch_dir, os.path.basename(path) + ".kacpatch"), original, map_obj.file)
+        elif output_dir is None:
+            if backup_store is not None:
+                backup_save(path, backup_store)
+            _write(cache, path, map_obj.file)
+        else:
+            _write(cache, os.path.join(output_dir, os.path.basename(path)), map_obj.file)
+        timings["write"] = time.perf_counter() - phase_start
+    except Exception as e:
+        result["error"] = "{}: {}".format(type(e).__name__, e)
+    timings["total"] = time.perf_counter() - start_time
+    return result
+
+
+def patch_save(path: str, patch_file: str, output_dir: 'Optional[str]'=None,
+               backup_store: 'Optional[str]'=DEFAULT_STORE, verify: bool=True,
+               cache_dir: 'Optional[str]'=None) -> 'Dict':
+    """Apply a patch file to one save, without parsing it
+
+    Arguments and result are as for process_save. If the patch was made
+    from this exact save (verify) and that save is in the cache, the
+    patched save is recorded as sharing its cache entry.
+    """
+    result = {"path": path, "error": None, "timings": {}}
+    start_time = time.perf_counter()
+    try:
+        output_file = path if output_dir is None else os.path.join(output_dir, os.path.basename(path))
+        if output_dir is None and backup_store is not None:
+            backup_save(path, backup_store)
+        apply_patch_file(patch_file, path, output_file, verify)
+        if verify and cache_dir is not None:
+            with open(patch_file, mode="rb") as file:
+                _, digest, _ = read_patch(file.read())
+            with open(output_file, mode="rb") as file:
+                ParseCache(cache_dir).alias(file.read(), digest.hex())
+    except Exception as e:
+        result["error"] = "{}: {}".format(type(e).__name__, e)
+    result["timings"]["total"] = time.perf_counter() - start_time
+    return result
+
+
+def run_batch(paths: 'List[str]', operations: 'List[str]', workers: 'Optional[int]'=None,
+              output_dir: 'Optional[str]'=None, backup_store: 'Optional[str]'=DEFAULT_STORE,
+              patch: bool=False, cache_dir: 'Optional[str]'=None,
+              cache_limit: 'Optional[int]'=DEFAULT_CACHE_LIMIT) -> 'Iterator[Dict]':
+    """Process many saves in parallel, yielding each result as it completes"""
+    for operation in operations:
+        # Fail fast on typos, before any worker is started
+        parse_operation(operation)
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(process_save, path, operations, output_dir, backup_store, patch, cache_dir,
+                                   cache_limit) for path in paths]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def format_result(result: 'Dict') -> str:
+    timings = result["timings"]
+    phases = " ".join("{}={:.1f}ms".format(phase, timings[phase] * 1000.0)
+                      for phase in ("parse", "edit", "write", "total") if phase in timings)
+    if result["error"] is not None:
+        return "FAIL {} {} ({})".format(result["path"], phases, result["error"])
+    return "OK   {} {}".format(result["path"], phases)
+
+
+def summarize(results: 'List[Dict]', elapsed: float) -> 'Tuple[int, str]':
+    failures = sum(1 for result in results if result["error"] is not None)
+    total = sum(result["timings"]["total"] for result in results)
+    summary = "{} saves, {} failed, {:.2f}s wall time, {:.2f}s total work".format(
+        len(results), failures, elapsed, total)
+    return failures, summary
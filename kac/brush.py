@@ -3,6 +3,7 @@ from enum import IntEnum, unique
 
 import typing
 if typing.TYPE_CHECKING:
+    from typing import List, Tuple
     from kac.map import KacMap
 
 
@@ -22,6 +23,26 @@ class BrushTile(IntEnum):
     ResourceNoTree = 11
 
 
+def line(x0: int, y0: int, x1: int, y1: int) -> 'List[Tuple[int, int]]':
+    """The tiles on a line between two tiles, both ends included (Bresenham)"""
+    points = []
+    dx, dy = abs(x1 - x0), -abs(y1 - y0)
+    step_x = 1 if x0 < x1 else -1
+    step_y = 1 if y0 < y1 else -1
+    error = dx + dy
+    while True:
+        points.append((x0, y0))
+        if x0 == x1 and y0 == y1:
+            return points
+        double_error = 2 * error
+        if double_error >= dy:
+            error += dy
+            x0 += step_x
+        if double_error <= dx:
+            error += dx
+            y0 += step_y
+
+
 class Brush(object):
     def __init__(self) -> None:
         self._tile = BrushTile.Nothing
@@ -30,55 +51,78 @@ class Brush(object):
     def _apply(self, map_obj: 'KacMap', tile: 'dict'):
         # TODO: Make sure to remove trees if they exist and they shouldn't on the new tile
         if self._tile == BrushTile.WaterDeep:
-            tile["type"]["value__"].update(map_obj.file, 3)
-            tile["deepWater"].update(map_obj.file, True)
+            tile["type"]["value__"].update(map_obj.file, 3, map_obj.journal)
+            tile["deepWater"].update(map_obj.file, True, map_obj.journal)
         elif self._tile == BrushTile.WaterFresh:
-            tile["type"]["value__"].update(map_obj.file, 3)
-            tile["deepWater"].update(map_obj.file, False)
-            tile["saltWater"].update(map_obj.file, False)
+            tile["type"]["value__"].update(map_obj.file, 3, map_obj.journal)
+            tile["deepWater"].update(map_obj.file, False, map_obj.journal)
+            tile["saltWater"].update(map_obj.file, False, map_obj.journal)
         elif self._tile == BrushTile.WaterSalt:
-            tile["type"]["value__"].update(map_obj.file, 3)
-            tile["deepWater"].update(map_obj.file, False)
-            tile["saltWater"].update(map_obj.file, True)
+            tile["type"]["value__"].update(map_obj.file, 3, map_obj.journal)
+            tile["deepWater"].update(map_obj.file, False, map_obj.journal)
+            tile["saltWater"].update(map_obj.file, True, map_obj.journal)
         elif self._tile == BrushTile.LandBarren:
-            tile["type"]["value__"].update(map_obj.file, 0)
-            tile["fertile"].update(map_obj.file, 0)
+            tile["type"]["value__"].update(map_obj.file, 0, map_obj.journal)
+            tile["fertile"].update(map_obj.file, 0, map_obj.journal)
         elif self._tile == BrushTile.LandFertile:
-            tile["type"]["value__"].update(map_obj.file, 0)
-            tile["fertile"].update(map_obj.file, 1)
+            tile["type"]["value__"].update(map_obj.file, 0, map_obj.journal)
+            tile["fertile"].update(map_obj.file, 1, map_obj.journal)
         elif self._tile == BrushTile.LandVeryFertile:
-            tile["type"]["value__"].update(map_obj.file, 0)
-            tile["fertile"].update(map_obj.file, 2)
+            tile["type"]["value__"].update(map_obj.file, 0, map_obj.journal)
+            tile["fertile"].update(map_obj.file, 2, map_obj.journal)
         elif self._tile == BrushTile.ResourceRock:
-            tile["type"]["value__"].update(map_obj.file, 4)
+            tile["type"]["value__"].update(map_obj.file, 4, map_obj.journal)
         elif self._tile == BrushTile.ResourceStone:
-            tile["type"]["value__"].update(map_obj.file, 2)
+            tile["type"]["value__"].update(map_obj.file, 2, map_obj.journal)
         elif self._tile == BrushTile.ResourceIron:
-            tile["type"]["value__"].update(map_obj.file, 5)
+            tile["type"]["value__"].update(map_obj.file, 5, map_obj.journal)
         elif self._tile == BrushTile.ResourceTree:
-            tile["amount"].update(map_obj.file, 3)
+            tile["amount"].update(map_obj.file, 3, map_obj.journal)
         elif self._tile == BrushTile.ResourceNoTree:
-            tile["amount"].update(map_obj.file, 0)
+            tile["amount"].update(map_obj.file, 0, map_obj.journal)
         else:
             RuntimeError("Invalid BrushTile value: {}".format(self._tile))
 
-    def apply(self, map_obj: 'KacMap', x: int, y: int):
+    def apply(self, map_obj: 'KacMap', x: int, y: int) -> 'List[Tuple[int, int]]':
+        """Paint the brush centered on a tile
+
+        :return: The (x, y) coordinates of every tile that was painted
+        """
+        touched = []
         if self._tile == BrushTile.Nothing:
-            return
+            return touched
 
         start_x = x - self._size // 2
         start_y = y - self._size // 2
-        for i in range(self._size):
-            t_y = start_y + i
-            if not (0 <= t_y < map_obj.height):
-                continue
-
-            for j in range(self._size):
-                t_x = start_x + j
-                if not (0 <= t_x < map_obj.width):
+        with map_obj.edit_group():
+            for i in range(self._size):
+                t_y = start_y + i
+                if not (0 <= t_y < map_obj.height):
                     continue
-                tile = map_obj.tiles[t_y * map_obj.width + t_x]
-                self._apply(map_obj, tile)
+
+                for j in range(self._size):
+                    t_x = start_x + j
+                    if not (0 <= t_x < map_obj.width):
+                        continue
+                    tile = map_obj.tiles[t_y * map_obj.width + t_x]
+                    self._apply(map_obj, tile)
+                    touched.append((t_x, t_y))
+        map_obj.refresh_tiles(touched)
+        return touched
+
+    def stroke(self, map_obj: 'KacMap', start: 'Tuple[int, int]', end: 'Tuple[int, int]') -> 'List[Tuple[int, int]]':
+        """Paint the brush along a line from start to end, start excluded
+
+        Used for mouse drags, so that a fast stroke whose motion events are
+        several tiles apart still paints a continuous line.
+
+        :return: The (x, y) coordinates of every tile that was painted
+        """
+        touched = set()
+        with map_obj.edit_group():
+            for x, y in line(start[0], start[1], end[0], end[1])[1:]:
+                touched.update(self.apply(map_obj, x, y))
+        return list(touched)
 
     @property
     def tile(self) -> BrushTile:
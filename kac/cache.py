@@ -0,0 +1,427 @@
+import array
+import hashlib
+import itertools
+import marshal
+import os
+import struct
+import weakref
+import zlib
+
+from kac.datatypes import (UNDECODED, ArrayInfo, ArrayInstance, BinaryObjectString, ClassInfo, ClassTypeInfo,
+                           ClassWithMembersAndTypes, MemberReference, ObjectInstance, ObjectRegistry, PrimitiveType)
+from kac.extractor import RecordDecoder, parse_save_buffer
+from kac.fileio import write_atomic
+from kac.gcpause import gc_paused
+from kac.vartypes import FIELD_TYPES
+
+import typing
+if typing.TYPE_CHECKING:
+    from typing import Any, Dict, List, MutableMapping, Optional, Tuple
+
+
+DEFAULT_CACHE = os.path.join(os.path.expanduser("~"), ".kac-cache")
+# Entries beyond this many bytes are dropped, least recently used first
+DEFAULT_CACHE_LIMIT = 128 * 1024 * 1024
+
+# Bump whenever the parser or the layout of the parsed objects changes,
+# so that stale entries are ignored rather than loaded
+CACHE_VERSION = 4
+
+_MAGIC = b"KACINDEX"
+_HEADER = struct.Struct("<8sI")
+
+# Node kinds of the flattened object graph
+_INSTANCE = 0
+_ARRAY = 1
+_CLASS = 2
+_REFERENCE = 3
+_STRING = 4
+
+# Value kinds; fields are stored as their position in the save, and
+# their kind is _FIELD plus the index of their type in FIELD_TYPES
+_PLAIN = 0
+_NODE = 1
+_UNDECODED = 2
+_FIELD = 3
+_FIELD_KINDS = {field_type: _FIELD + index for index, field_type in enumerate(FIELD_TYPES)}
+
+# Member type info entries
+_INFO_PLAIN = 0
+_INFO_PRIMITIVE = 1
+_INFO_CLASS = 2
+
+
+class _Flattener(object):
+    """Turns the parsed object graph into plain tuples that marshal can store
+
+    Every instance, array, class, reference and string becomes a node,
+    numbered in the order it is first reached. Values that read through
+    to the save buffer are stored as their position only.
+    """
+
+    def __init__(self, data: 'Any') -> None:
+        self._data = data
+        self._ids = {}  # type: Dict[int, int]
+        self.nodes = []  # type: List[Any]
+        # (class node, value kinds, number of runs) -> instance nodes, object ids, class base ids,
+        # values and run positions of all instances
+        self.groups = {}  # type: Dict[Tuple[int, bytes, int], Tuple[List[int], List[int], List[Any], List[Any]]]
+
+    def node(self, obj: 'Any') -> int:
+        index = self._ids.get(id(obj))
+        if index is not None:
+            return index
+        index = len(self.nodes)
+        self._ids[id(obj)] = index
+        self.nodes.append(None)
+
+        kind = type(obj)
+        if kind is ObjectInstance:
+            # Instances are stored per class, as long as their values are of the same kinds. Members
+            # that are not decoded yet stay that way, and the positions of their runs follow the values
+            class_index = self.node(obj.class_base)
+            runs = () if obj.runs is None else obj.runs
+            kinds, payload = self._values(obj.members + list(runs))
+            key = (class_index, kinds, len(runs))
+            group = self.groups.get(key)
+            if group is None:
+                group = self.groups[key] = ([], [], [], [])
+            group[0].append(index)
+            group[1].append(obj.object_id)
+            group[2].append(obj.class_base_id)
+            group[3].extend(payload)
+            node = (_INSTANCE, )
+        elif kind is ArrayInstance:
+            if isinstance(obj.values, array.array):
+                values = (obj.values.typecode, obj.values.tobytes())
+            else:
+                values = self._values(obj.values)
+            node = (_ARRAY, obj.array_info.object_id, obj.array_info.length, int(obj.primitive_type), values,
+                    obj.offset)
+        elif kind is ClassWithMembersAndTypes:
+            info = obj.class_info
+            node = (_CLASS, info.object_id, info.name, info.member_count, list(info.member_names),
+                    list(obj.member_type_info[0]), [_member_info(entry) for entry in obj.member_type_info[1]],
+                    [self.node(instance) for instance in obj.instances])
+        elif kind is MemberReference:
+            node = (_REFERENCE, obj.idRef, -1 if obj.target is None else self.node(obj.target))
+        elif kind is BinaryObjectString:
+            node = (_STRING, obj.object_id, obj.value)
+        else:
+            raise ValueError("Cannot cache a {}".format(kind.__name__))
+        self.nodes[index] = node
+        return index
+
+    def _values(self, values: 'List[Any]') -> 'Tuple[bytes, List[Any]]':
+        kinds = bytearray(len(values))
+        payload = []
+        for i, value in enumerate(values):
+            kind = type(value)
+            if kind in _FIELD_KINDS:
+                if value.data is not self._data:
+                    raise ValueError("Value at {} is not backed by the save".format(value.position))
+                kinds[i] = _FIELD_KINDS[kind]
+                payload.append(value.position)
+            elif value is UNDECODED:
+                kinds[i] = _UNDECODED
+                payload.append(None)
+            elif kind in _NODE_TYPES:
+                kinds[i] = _NODE
+                payload.append(self.node(value))
+            else:
+                payload.append(value)
+        return bytes(kinds), payload
+
+
+_NODE_TYPES = (ObjectInstance, ArrayInstance, ClassWithMembersAndTypes, MemberReference, BinaryObjectString)
+
+
+def _member_info(entry: 'Any') -> 'Tuple':
+    if isinstance(entry, PrimitiveType):
+        return _INFO_PRIMITIVE, int(entry)
+    if isinstance(entry, ClassTypeInfo):
+        return _INFO_CLASS, entry.typeName, entry.libraryId
+    return _INFO_PLAIN, entry
+
+
+def _restore_member_info(entry: 'Tuple') -> 'Any':
+    if entry[0] == _INFO_PRIMITIVE:
+        return PrimitiveType(entry[1])
+    if entry[0] == _INFO_CLASS:
+        return ClassTypeInfo(entry[1], entry[2])
+    return entry[1]
+
+
+def flatten(objects: 'Dict[str, ObjectInstance]', data: 'Any') -> 'Tuple[Dict[str, int], List[Any], List[Any]]':
+    """The top level objects of a parse as a graph of plain tuples
+
+    :return: The node index of each top level object, the nodes, and the
+             instances grouped by class and value kinds
+    """
+    flattener = _Flattener(data)
+    roots = {name: flattener.node(obj) for name, obj in objects.items()}
+    groups = [key + group for key, group in flattener.groups.items()]
+    return roots, flattener.nodes, groups
+
+
+def _column(kind: int, values: 'List[Any]', built: 'List[Any]', data: bytearray) -> 'List[Any]':
+    if kind == _PLAIN:
+        return values
+    if kind == _NODE:
+        return [built[value] for value in values]
+    if kind == _UNDECODED:
+        return [UNDECODED] * len(values)
+    return list(map(FIELD_TYPES[kind - _FIELD], itertools.repeat(None), values, itertools.repeat(data)))
+
+
+def unflatten(roots: 'Dict[str, int]', nodes: 'List[Any]', groups: 'List[Any]',
+              data: bytearray) -> 'Dict[str, ObjectInstance]':
+    """Rebuild the objects flattened by flatten on top of a save buffer
+
+    Every object is created before any is filled in, so that values can
+    refer to objects later in the graph; most are filled in without
+    running their constructors. Classes are built next, through
+    ClassWithMembersAndTypes.restore, as only instances refer to them.
+    The values of all instances of a group are built a column at a time, so most of
+    the work happens in map and zip rather than in per-value Python code.
+    """
+    registry = ObjectRegistry()
+    built = [None] * len(nodes)  # type: List[Any]
+    new = object.__new__
+
+    # Create every object first
+    for index, node in enumerate(nodes):
+        kind = node[0]
+        if kind == _INSTANCE:
+            built[index] = new(ObjectInstance)
+        elif kind == _ARRAY:
+            built[index] = new(ArrayInstance)
+        elif kind == _CLASS:
+            # Built below, once the instances it lists exist
+            continue
+        elif kind == _REFERENCE:
+            built[index] = new(MemberReference)
+        else:
+            built[index] = BinaryObjectString(node[1], node[2])
+            registry.register(built[index])
+
+    # Classes first, since instances take their member names from them
+    for index, node in enumerate(nodes):
+        if node[0] != _CLASS:
+            continue
+        member_type_info = [node[5], [_restore_member_info(entry) for entry in node[6]]]
+        built[index] = ClassWithMembersAndTypes.restore(ClassInfo(node[1], node[2], node[3], node[4]),
+                                                        member_type_info, RecordDecoder(member_type_info), data,
+                                                        [built[instance] for instance in node[7]])
+
+    for class_index, kinds, run_count, indices, object_ids, class_base_ids, payload in groups:
+        class_base = built[class_index]
+        width = len(kinds)
+        count = width - run_count
+        columns = [_column(kind, payload[column::width], built, data) for column, kind in enumerate(kinds)]
+        rows = zip(*columns) if width > 0 else itertools.repeat(())
+        for index, object_id, class_base_id, row in zip(indices, object_ids, class_base_ids, rows):
+            obj = built[index]
+            obj.object_id = object_id
+            obj.class_base = class_base
+            obj.class_base_id = class_base_id
+            obj.set_members(list(row[:count]), row[count:] if run_count else None)
+            registry.register(obj)
+
+    for index, node in enumerate(nodes):
+        kind = node[0]
+        obj = built[index]
+        if kind == _ARRAY:
+            if isinstance(node[4][0], str):
+                array_values = array.array(node[4][0])
+                array_values.frombytes(node[4][1])
+            else:
+                array_values = [column[0] for column in (_column(kind, [value], built, data)
+                                                         for kind, value in zip(node[4][0], node[4][1]))]
+            ArrayInstance.__init__(obj, ArrayInfo(node[1], node[2]), PrimitiveType(node[3]), array_values, node[5])
+            registry.register(obj)
+        elif kind == _REFERENCE:
+            obj.idRef = node[1]
+            obj.target = None if node[2] < 0 else built[node[2]]
+            obj._registry = registry
+
+    return {name: built[index] for name, index in roots.items()}
+
+
+class _SaveBuffer(bytearray):
+    """The contents of a save, which unlike a bytearray can be weakly referenced"""
+
+    __slots__ = ("digest", "__weakref__")
+
+
+class ParseCache(object):
+    """On-disk cache of parsed saves, keyed by the SHA-256 of their contents
+
+    Each entry is the flattened object graph of one parse, marshalled and
+    compressed. Loading an entry rebuilds the objects on top of the save
+    buffer without decoding any records.
+
+    Edits made through the editor only ever write to fields that read
+    through to the save buffer and never change the layout of the save,
+    so the entry of a save stays valid for its edited versions. When the
+    cache writes a save it parsed, or a patch is applied to a cached
+    save, the new contents are recorded as an alias of the original entry
+    instead of being parsed again on the next load.
+
+    Loading an entry marks it as used. Whenever an entry is stored, the
+    least recently used entries are dropped until the cache takes at
+    most limit bytes.
+    """
+
+    def __init__(self, root: str=DEFAULT_CACHE, limit: 'Optional[int]'=DEFAULT_CACHE_LIMIT) -> None:
+        self.root = root
+        self.limit = limit
+        # id of each buffer handed out by parse_file -> the buffer, held weakly so it can be freed
+        self._loaded = weakref.WeakValueDictionary()  # type: MutableMapping[int, _SaveBuffer]
+
+    def load(self, data: bytearray) -> 'Optional[Dict[str, ObjectInstance]]':
+        """The parsed objects of a save, or None if it is not cached"""
+        digest = self.resolve(hashlib.sha256(data).hexdigest())
+        if digest is None:
+            return None
+        try:
+            with open(self._entry_path(digest), mode="rb") as file:
+                entry = file.read()
+            magic, version = _HEADER.unpack_from(entry, 0)
+            if magic != _MAGIC or version != CACHE_VERSION:
+                return None
+            roots, nodes, groups = marshal.loads(zlib.decompress(entry[_HEADER.size:]))
+        except (OSError, ValueError, EOFError, TypeError, zlib.error):
+            return None
+        try:
+            # Mark the entry as used, so that pruning keeps it over older ones
+            os.utime(self._entry_path(digest))
+        except OSError:
+            pass
+        # Nothing built here is garbage, so don't let the collector walk it over and over
+        with gc_paused():
+            objects = unflatten(roots, nodes, groups, data)
+        self._track(data, digest)
+        return objects
+
+    def store(self, data: bytearray, objects: 'Dict[str, ObjectInstance]') -> str:
+        """Add the parsed objects of a save to the cache
+
+        :return: The digest the entry is stored under
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        entry = _HEADER.pack(_MAGIC, CACHE_VERSION) + zlib.compress(marshal.dumps(flatten(objects, data)), 1)
+        os.makedirs(self.root, exist_ok=True)
+        write_atomic(self._entry_path(digest), entry)
+        self._track(data, digest)
+        if self.limit is not None:
+            self.prune(self.limit)
+        return digest
+
+    def alias(self, data: 'Any', digest: str) -> None:
+        """Make a save with the same layout as a cached one load from its entry"""
+        target = self.resolve(digest)
+        if target is None:
+            return
+        new_digest = hashlib.sha256(data).hexdigest()
+        if new_digest != target:
+            os.makedirs(self.root, exist_ok=True)
+            write_atomic(self._alias_path(new_digest), target.encode("ascii"))
+
+    def resolve(self, digest: str) -> 'Optional[str]':
+        """The digest of the entry holding a save's objects, following an alias"""
+        if os.path.isfile(self._entry_path(digest)):
+            return digest
+        try:
+            with open(self._alias_path(digest), mode="r") as file:
+                target = file.read().strip()
+        except OSError:
+            return None
+        return target if os.path.isfile(self._entry_path(target)) else None
+
+    def parse_file(self, filename: str) -> 'Tuple[Dict[str, ObjectInstance], bytearray]':
+        """Like parse_save_file, but loads the objects from the cache when it can"""
+        with open(filename, mode="rb") as file:
+            data = _SaveBuffer(file.read())
+        objects = self.load(data)
+        if objects is None:
+            objects = parse_save_buffer(data).parentless_objects
+            self.store(data, objects)
+        return objects, data
+
+    def write_file(self, filename: str, data: bytearray) -> None:
+        """Write a save returned by parse_file, keeping its cache entry valid for the new contents"""
+        write_atomic(filename, data)
+        loaded = self._loaded.pop(id(data), None)
+        if loaded is data:
+            self.alias(data, data.digest)
+
+    def prune(self, limit: int) -> 'Dict[str, int]':
+        """Drop the least recently used entries until the cache takes at most limit bytes
+
+        Aliases of dropped entries are removed along with them.
+
+        :return: The number of entries and aliases removed and the bytes freed
+        """
+        entries, aliases = self._files()
+        total = sum(size for _, _, size in entries)
+        removed, freed = set(), 0
+        for digest, _, size in sorted(entries, key=lambda entry: entry[1]):
+            if total - freed <= limit:
+                break
+            if _remove(self._entry_path(digest)):
+                removed.add(digest)
+                freed += size
+        alias_count = 0
+        for digest in aliases:
+            try:
+                with open(self._alias_path(digest), mode="r") as file:
+                    target = file.read().strip()
+            except OSError:
+                continue
+            if target in removed or not os.path.isfile(self._entry_path(target)):
+                if _remove(self._alias_path(digest)):
+                    alias_count += 1
+        return {"entries": len(removed), "aliases": alias_count, "bytes": freed}
+
+    def stats(self) -> 'Dict[str, int]':
+        entries, aliases = self._files()
+        return {"entries": len(entries), "aliases": len(aliases), "bytes": sum(size for _, _, size in entries)}
+
+    def _files(self) -> 'Tuple[List[Tuple[str, float, int]], List[str]]':
+        """The (digest, last use, size) of every entry and the digest of every alias"""
+        entries, aliases = [], []
+        if not os.path.isdir(self.root):
+            return entries, aliases
+        for name in os.listdir(self.root):
+            digest, extension = os.path.splitext(name)
+            if extension == ".idx":
+                try:
+                    status = os.stat(os.path.join(self.root, name))
+                except OSError:
+                    continue
+                entries.append((digest, status.st_mtime, status.st_size))
+            elif extension == ".alias":
+                aliases.append(digest)
+        return entries, aliases
+
+    def _track(self, data: 'Any', digest: str) -> None:
+        """Remember the entry a buffer handed out by parse_file was built from"""
+        if isinstance(data, _SaveBuffer):
+            data.digest = digest
+            self._loaded[id(data)] = data
+
+    def _entry_path(self, digest: str) -> str:
+        return os.path.join(self.root, digest + ".idx")
+
+    def _alias_path(self, digest: str) -> str:
+        return os.path.join(self.root, digest + ".alias")
+
+
+def _remove(path: str) -> bool:
+    # Another process sharing the cache may have removed it first
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return False
+    return True
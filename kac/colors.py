@@ -1,9 +1,13 @@
+from enum import IntEnum, unique
+
+import numpy
 
 from kac.tile import TileType, Fertility
 
 import typing
 if typing.TYPE_CHECKING:
-    from typing import Tuple
+    from typing import Optional, Tuple
+    from kac.grid import TileGrid
 
 
 White = (255, 255, 255)
@@ -28,29 +32,95 @@ UnusableStone = (32, 32, 32)
 Tree = (102, 51, 0)
 
 
-def get_tile_color(tile: dict) -> 'Tuple[int, int, int]':
+@unique
+class ColorIndex(IntEnum):
+    """Index of each color in Palette, for palette-indexed tile buffers"""
+    Unknown = 0
+    LandBarren = 1
+    LandFertile = 2
+    LandVeryFertile = 3
+    WaterFresh = 4
+    WaterSalt = 5
+    WaterDeep = 6
+    ResourceStone = 7
+    ResourceIron = 8
+    UnusableStone = 9
+    Tree = 10
+    Grid = 11
+
+
+Palette = numpy.array([
+    Unknown,
+    LandBarren,
+    LandFertile,
+    LandVeryFertile,
+    WaterFresh,
+    WaterSalt,
+    WaterDeep,
+    ResourceStone,
+    ResourceIron,
+    UnusableStone,
+    Tree,
+    Black,
+], dtype=numpy.uint8)
+
+_PaletteColors = [tuple(int(channel) for channel in color) for color in Palette]
+
+
+def get_tile_color_index(tile: dict) -> ColorIndex:
     tile_type = tile["type"]["value__"].value
     if tile_type == TileType.Land:
         fertility = tile["fertile"].value
         if fertility == Fertility.Barren:
-            return LandBarren
+            return ColorIndex.LandBarren
         if fertility == Fertility.Fertile:
-            return LandFertile
+            return ColorIndex.LandFertile
         if fertility == Fertility.VeryFertile:
-            return LandVeryFertile
-        return Unknown
+            return ColorIndex.LandVeryFertile
+        return ColorIndex.Unknown
     if tile_type == TileType.Stone:
-        return ResourceStone
+        return ColorIndex.ResourceStone
     if tile_type == TileType.Water:
         if tile["deepWater"].value:
-            return WaterDeep
+            return ColorIndex.WaterDeep
         if tile["saltWater"].value:
-            return WaterSalt
-        return WaterFresh
+            return ColorIndex.WaterSalt
+        return ColorIndex.WaterFresh
     if tile_type == TileType.Rock:
-        return UnusableStone
+        return ColorIndex.UnusableStone
     if tile_type == TileType.Iron:
-        return ResourceIron
+        return ColorIndex.ResourceIron
 
     print("Unknown tile type: {}".format(tile_type))
-    return 255, 0, 255
+    return ColorIndex.Unknown
+
+
+def get_tile_color(tile: dict) -> 'Tuple[int, int, int]':
+    return _PaletteColors[get_tile_color_index(tile)]
+
+
+def tile_color_indices(grid: 'TileGrid', mask: 'Optional[numpy.ndarray]'=None) -> numpy.ndarray:
+    """The ColorIndex of every tile, computed the same way as get_tile_color_index
+
+    :param mask: A (height, width) boolean array of the tiles to compute; all tiles if None
+    :return: A (height, width) uint8 array of ColorIndex values, or a flat
+             array of the selected tiles if mask is given
+    """
+    types = grid.values("type", mask)
+    fertile = grid.values("fertile", mask)
+    indices = numpy.full(types.shape, ColorIndex.Unknown, dtype=numpy.uint8)
+
+    land = types == TileType.Land
+    indices[land & (fertile == Fertility.Barren)] = ColorIndex.LandBarren
+    indices[land & (fertile == Fertility.Fertile)] = ColorIndex.LandFertile
+    indices[land & (fertile == Fertility.VeryFertile)] = ColorIndex.LandVeryFertile
+
+    water = types == TileType.Water
+    indices[water] = ColorIndex.WaterFresh
+    indices[water & grid.values("saltWater", mask)] = ColorIndex.WaterSalt
+    indices[water & grid.values("deepWater", mask)] = ColorIndex.WaterDeep
+
+    indices[types == TileType.Stone] = ColorIndex.ResourceStone
+    indices[types == TileType.Rock] = ColorIndex.UnusableStone
+    indices[types == TileType.Iron] = ColorIndex.ResourceIron
+    return indices
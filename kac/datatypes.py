@@ -1,12 +1,24 @@
 
 from enum import IntEnum, unique
 
+import typing
+if typing.TYPE_CHECKING:
+    from typing import Any, Dict, Iterator, List, Optional, Tuple
+
 
 IDENTIFIER_DEFAULT_VALUE = -1
 IDENTIFIER_ARRAY_VALUES = -2
 
-INSTANCE_LIST = []
-ARRAY_LIST = []
+
+class _Undecoded(object):
+    __slots__ = ()
+
+    def __repr__(self):
+        return "<undecoded>"
+
+
+# Stands in for an instance member that has not been decoded from the save yet
+UNDECODED = _Undecoded()
 
 
 @unique
@@ -77,23 +89,90 @@ class BinaryArrayType(IntEnum):
     RectangularOffset = 5
 
 
+class ObjectRegistry(object):
+    """Every identifiable object of a save, keyed by object id
+
+    The parser registers instances, arrays and BinaryObjectStrings here
+    as it creates them. MemberReferences resolve against it on first use,
+    with a single dict lookup, since their targets may appear later in
+    the stream than they do.
+    """
+
+    def __init__(self) -> None:
+        self._objects = {}  # type: Dict[int, Any]
+
+    def register(self, obj: 'Any') -> None:
+        self._objects[obj.object_id] = obj
+
+    def get(self, object_id: int) -> 'Optional[Any]':
+        return self._objects.get(object_id)
+
+    def __contains__(self, object_id: int) -> bool:
+        return object_id in self._objects
+
+    def __len__(self) -> int:
+        return len(self._objects)
+
+    def __iter__(self) -> 'Iterator[Any]':
+        return iter(self._objects.values())
+
+    def resolve_all(self) -> 'List[MemberReference]':
+        """Resolve every MemberReference of the save at once
+
+        Walks the members of the registered instances and the values of
+        the registered arrays, so no list of references has to be kept
+        while parsing. Members not decoded yet are skipped.
+
+        :return: The references whose target is not registered, such as
+                 arrays of objects, which the parser builds no object for
+        """
+        objects = self._objects
+        unresolved = []
+        for obj in objects.values():
+            if isinstance(obj, ArrayInstance):
+                values = obj.values
+                if not isinstance(values, list):
+                    continue
+            elif isinstance(obj, ObjectInstance):
+                values = obj.members
+            else:
+                continue
+            for value in values:
+                if type(value) is MemberReference:
+                    value.target = objects.get(value.idRef)
+                    if value.target is None:
+                        unresolved.append(value)
+        return unresolved
+
+
 class MemberReference(object):
-    def __init__(self, id_ref):
+    __slots__ = ("idRef", "target", "_registry")
+
+    def __init__(self, id_ref, registry: ObjectRegistry):
         self.idRef = id_ref
+        self.target = None
+        self._registry = registry
+
+    def __repr__(self):
+        return "<reference to=" + str(self.idRef) + ">"
 
     def resolve(self):
-        for element in INSTANCE_LIST + ARRAY_LIST:
-            if element.objectId == self.idRef:
-                return element
+        if self.target is None:
+            self.target = self._registry.get(self.idRef)
+        return self.target
 
 
 class BinaryLibrary(object):
+    __slots__ = ("libraryId", "libraryName")
+
     def __init__(self, library_id, library_name):
         self.libraryId = library_id
         self.libraryName = library_name
 
 
 class ClassTypeInfo(object):
+    __slots__ = ("typeName", "libraryId")
+
     def __init__(self, type_name, library_id):
         self.typeName = type_name
         self.libraryId = library_id
@@ -103,6 +182,8 @@ class ClassTypeInfo(object):
 
 
 class ClassInfo(object):
+    __slots__ = ("object_id", "name", "member_count", "member_names")
+
     def __init__(self, object_id, name, member_count, member_names):
         self.object_id = object_id
         self.name = name
@@ -119,74 +200,181 @@ class ClassWithMembersAndTypes:
         self.class_info = class_info
         self.member_type_info = member_type_info
         self.default_values = None
+        self.decoder = None
+        # The save the instances' fixed-width members are decoded from
+        self.data = None
+        self.member_indices = {name: index for index, name in enumerate(class_info.member_names)}
         self.instances = []
-        self.instances.append(ObjectInstance(IDENTIFIER_DEFAULT_VALUE, self.class_info.object_id))
+        # The record defining the class also holds the values of its first instance
+        self.instances.append(ObjectInstance(self.class_info.object_id, self.class_info.object_id))
         self.instances[0].class_base = self
 
+    @classmethod
+    def restore(cls, class_info: 'ClassInfo', member_type_info: 'List[Any]', decoder: 'Any', data: 'Any',
+                instances: 'List[ObjectInstance]') -> 'ClassWithMembersAndTypes':
+        """A class as it was parsed, over instances built elsewhere, such as by the parse cache
+
+        The instances are taken as they are, not pointed back at the class.
+        """
+        class_object = cls.__new__(cls)
+        class_object.class_info = class_info
+        class_object.member_type_info = member_type_info
+        class_object.default_values = None
+        class_object.decoder = decoder
+        class_object.data = data
+        class_object.member_indices = {name: index for index, name in enumerate(class_info.member_names)}
+        class_object.instances = instances
+        return class_object
+
+    def decode_member(self, runs: 'Tuple[int, ...]', index: int) -> 'Any':
+        """Decode the fixed-width member at index of the instance whose runs start at runs"""
+        return self.decoder.member(self.data, runs, index)
+
     def register_instance(self, instance: 'ObjectInstance'):
         instance.class_base = self
         self.instances.append(instance)
 
     def get_instance(self, index):
         instance = self.instances[index]
-        if len(instance.values) != len(self.class_info.memberNames):
+        if len(instance.values) != len(self.class_info.member_names):
             # TODO: Maybe make this an exception?
             print("ERR: Not enough data !")
 
-        for i in range(0, len(self.class_info.memberNames)):
-            value = instance.values[i]
+        for name in self.class_info.member_names:
+            value = instance.values.get(name)
             if type(value) is MemberReference:
                 value = value.resolve()
 
-            print(self.class_info.memberNames[i], "=>", value)
+            print(name, "=>", value)
 
         return instance
 
 
-class ObjectInstance:
+class ObjectInstance(object):
+    """An instance of a class in a save
+
+    Members are stored in a list in declaration order; the name of each
+    is looked up in the member_indices table its class shares between
+    all of its instances.
+
+    Members that are nested records or strings are decoded while
+    parsing. Fixed-width members are decoded from the save the first
+    time they are looked up, then kept: until then their slot holds
+    UNDECODED, runs holds where each run of them starts in the save, and
+    the class's decoder knows where each member is within its run.
+    Accessing values decodes every member.
+    """
+
+    __slots__ = ("object_id", "class_base", "class_base_id", "_values", "runs")
+
     def __init__(self, object_id: int, class_base_id):
-        INSTANCE_LIST.append(self)
         self.object_id = object_id
         self.class_base = None
         self.class_base_id = class_base_id
-        self.values = {}
-        self.addresses = []
+        self._values = []  # type: List[Any]
+        self.runs = None  # type: Optional[Tuple[int, ...]]
 
     def __repr__(self):
         return "<instance of=" + self.class_base.class_info.name + ">"
 
     def __getitem__(self, item):
-        return self.values[item]
-
-    def add_value(self, value, address=None):
-        self.values[self.class_base.class_info.member_names[len(self.values)]] = value
-        self.addresses.append(address)
+        index = self.class_base.member_indices[item]
+        try:
+            value = self._values[index]
+        except IndexError:
+            raise KeyError(item)
+        if value is UNDECODED:
+            value = self._values[index] = self.class_base.decode_member(self.runs, index)
+        return value
+
+    @property
+    def values(self) -> 'Dict[str, Any]':
+        """Every member by name, in declaration order"""
+        return {name: self[name] for name in self.class_base.class_info.member_names[:len(self._values)]}
+
+    @property
+    def members(self) -> 'List[Any]':
+        """The members in declaration order, as stored: UNDECODED for those not decoded yet"""
+        return self._values
+
+    def set_members(self, values: 'List[Any]', runs: 'Optional[Tuple[int, ...]]'=None) -> None:
+        """Set every member at once, see RecordDecoder.decode"""
+        self._values = values
+        self.runs = runs
+
+    def position(self, name: str) -> int:
+        """The offset in the save of a fixed-width member, without decoding it"""
+        class_base = self.class_base
+        index = class_base.member_indices[name]
+        if self.runs is not None and class_base.decoder.fields[index] is not None:
+            return class_base.decoder.position(self.runs, index)
+        return self[name].position
+
+    def add_value(self, value):
+        self._values.append(value)
 
 
 class ArrayInstance(ObjectInstance):
-    def __init__(self, array_info: 'ArrayInfo', primitive_type: 'PrimitiveType'):
+    __slots__ = ("array_info", "primitive_type", "values", "offset")
+
+    def __init__(self, array_info: 'ArrayInfo', primitive_type: 'PrimitiveType', values=None,
+                 offset: 'Optional[int]'=None):
+        """An array of primitive values
+
+        Arrays of fixed-width primitives are decoded in one go into an
+        array.array, in which case offset is the position of the first
+        element in the save. The array.array supports the buffer
+        protocol, so numpy.frombuffer can view it without a copy.
+        """
         ObjectInstance.__init__(self, array_info.object_id, primitive_type)
-        ARRAY_LIST.append(self)
         self.array_info = array_info
         self.primitive_type = primitive_type
-        self.values = []
-        self.addresses = []
+        self.values = [] if values is None else values
+        self.offset = offset
 
     def __repr__(self):
         return "<array, size=" + str(self.array_info.length) + ", type=" + str(self.primitive_type) + ">"
 
-    def add_value(self, value, address=None):
+    def __getitem__(self, item):
+        return self.values[item]
+
+    def add_value(self, value):
         self.values.append(value)
-        self.addresses.append(address)
 
 
-class IdentifiableObject:
+class SaveRecord(object):
+    """One record of a save, as yielded by RecordScanner
+
+    :param record_type: The RecordType of the record
+    :param offset: The position of the record in the save, at its record type byte
+    :param length: The size of the record in bytes, including any nested member records
+    :param header: The fields of the record header, as a dict
+    :param instance: The decoded object, if the scanner was asked to decode this record
+    """
+
+    def __init__(self, record_type: RecordType, offset: int, length: int, header: 'Dict[str, Any]',
+                 instance: 'Any'=None) -> None:
+        self.record_type = record_type
+        self.offset = offset
+        self.length = length
+        self.header = header
+        self.instance = instance
+
+    def __repr__(self):
+        return "<record {} at {}, {} bytes>".format(self.record_type.name, self.offset, self.length)
+
+
+class IdentifiableObject(object):
+    __slots__ = ("object_id", "extra_data")
+
     def __init__(self, object_id, extra_data=None):
         self.object_id = object_id
         self.extra_data = extra_data
 
 
-class ArrayInfo:
+class ArrayInfo(object):
+    __slots__ = ("object_id", "length")
+
     def __init__(self, object_id, length):
         self.object_id = object_id
         self.length = length
@@ -195,7 +383,9 @@ class ArrayInfo:
         return str(self.object_id) + " " + str(self.length)
 
 
-class BinaryObjectString:
+class BinaryObjectString(object):
+    __slots__ = ("object_id", "value")
+
     def __init__(self, object_id, value):
         self.object_id = object_id
         self.value = value
@@ -1,36 +1,32 @@
+import struct
 import time
 
 from kac.datatypes import *
+from kac.gcpause import gc_paused
+from kac.reader import BufferReader, FileReader, ReaderMode
 from kac.vartypes import *
 
 import typing
 if typing.TYPE_CHECKING:
-    from typing import Optional
+    from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+    from kac.telemetry import ParseTelemetry
 
 
-BinaryLibraryRecord = []
-MemberReferencesList = []
-objectIds = []
-typeStats = [0] * 22
-parentlessObjects = {}
+_UNSIGNED = {
+    1: struct.Struct("<B"),
+    2: struct.Struct("<H"),
+    4: struct.Struct("<I"),
+    8: struct.Struct("<Q"),
+}
+_CLASS_WITH_ID = struct.Struct("<II")
+# root id, header id, major version, minor version
+_STREAM_HEADER = struct.Struct("<IIII")
 
 
-def register_object_id(object_id: IdentifiableObject):
-    objectIds.append(object_id)
-
-
-def get_object_from_id(object_id) -> 'Optional[IdentifiableObject]':
-    for obj in objectIds:
-        if obj.object_id == object_id:
-            return obj
-
-
-def get_boolean(file):
-    return MSBoolean(position=file.tell(), value=file.read(1) == b'\x01')
-
-
-def get_byte(file):
-    return file.read(1)
+def get_field(file, field_type):
+    """Read a fixed-width primitive, as a field_type wrapper attached to the save buffer"""
+    position = file.tell()
+    return field_type(file.unpack(field_type.fmt)[0], position, file.data)
 
 
 def get_char(file):
@@ -41,51 +37,15 @@ def get_decimal(file):
     raise NotImplementedError("get_decimal")
 
 
-def get_double(file):
-    raise NotImplementedError("get_double")
-
-
 def get_int(file, size: int=1):
-    return int.from_bytes(file.read(size), "little")
-
-
-def get_typed_int32(file):
-    position = file.tell()
-    val = get_int(file, 4)
-    return MSInteger32(val, position)
-
-
-def get_signed_byte(file):
-    raise NotImplementedError("get_signed_byte")
-
-
-def get_single(file):
-    a1 = file.read(1)
-    a2 = file.read(1)
-    a3 = file.read(1)
-    a4 = file.read(1)
-    val = struct.unpack('f', a1 + a2 + a3 + a4)
-    return val
-
-
-def get_time_span(file):
-    raise NotImplementedError("get_time_span")
-
-
-def get_date_time(file):
-    raise NotImplementedError("get_date_time")
+    return file.unpack(_UNSIGNED[size])[0]
 
 
 def get_unsigned_int(file, size: int=1) -> int:
-    if size == 1:
-        return struct.unpack("<B", file.read(1))[0]
-    if size == 2:
-        return struct.unpack("<H", file.read(2))[0]
-    if size == 4:
-        return struct.unpack("<I", file.read(4))[0]
-    if size == 8:
-        return struct.unpack("<Q", file.read(8))[0]
-    raise ValueError("Invalid unsigned int size {}: must be one of 1, 2, 4, or 8".format(size))
+    fmt = _UNSIGNED.get(size)
+    if fmt is None:
+        raise ValueError("Invalid unsigned int size {}: must be one of 1, 2, 4, or 8".format(size))
+    return file.unpack(fmt)[0]
 
 
 def get_null(file):
@@ -97,17 +57,16 @@ def get_string(file):
 
 
 def get_length_prefixed_string(file, extend: bool=False):
-    length = int.from_bytes(file.read(1), "little")
+    length = file.read_byte()
 
     is_longer = (length >> 7) & 1
     if is_longer == 1:
         old_length = length & 0b01111111
-        length_2 = int.from_bytes(file.read(1), "little")
+        length_2 = file.read_byte()
         length_2 = length_2 & 0b01111111
         length = (length_2 << 7) + old_length
 
-    string = file.read(length).decode('utf-8')
-    return string
+    return file.read_string(length)
 
 
 def get_object(file):
@@ -134,64 +93,53 @@ def get_primitive_array(file):
     raise NotImplementedError("get_primitive_array")
 
 
-def get_values(file, member_type_info_list, instance: ObjectInstance):
-    for i in range(0, len(member_type_info_list[0])):
-        member_type_info = member_type_info_list[0][i]
-        additional_info = member_type_info_list[1][i]
-
-        if member_type_info == BinaryType.Primitive:
-            if additional_info == PrimitiveType.Boolean:
-                instance.add_value(get_boolean(file))
-            elif additional_info == PrimitiveType.Byte:
-                instance.add_value(get_byte(file))
-            elif additional_info == PrimitiveType.Char:
-                instance.add_value(get_char(file))
-            elif additional_info == PrimitiveType.Decimal:
-                instance.add_value(get_decimal(file))
-            elif additional_info == PrimitiveType.Double:
-                instance.add_value(get_double(file))
-            elif additional_info == PrimitiveType.Int16:
-                instance.add_value(get_int(file, 2))
-            elif additional_info == PrimitiveType.Int32:
-                instance.add_value(get_typed_int32(file))
-            elif additional_info == PrimitiveType.Int64:
-                instance.add_value(get_int(file, 8))
-            elif additional_info == PrimitiveType.SByte:
-                instance.add_value(get_signed_byte(file))
-            elif additional_info == PrimitiveType.Single:
-                instance.add_value(get_single(file))
-            elif additional_info == PrimitiveType.TimeSpan:
-                instance.add_value(get_time_span(file))
-            elif additional_info == PrimitiveType.DateTime:
-                instance.add_value(get_date_time(file))
-            elif additional_info == PrimitiveType.UInt16:
-                instance.add_value(get_unsigned_int(file, 2))
-            elif additional_info == PrimitiveType.UInt32:
-                instance.add_value(get_unsigned_int(file, 4))
-            elif additional_info == PrimitiveType.UInt64:
-                instance.add_value(get_unsigned_int(file, 8))
-            elif additional_info == PrimitiveType.Null:
-                instance.add_value(get_null(file))
-            elif additional_info == PrimitiveType.String:
-                instance.add_value(get_string(file))
-            else:
-                raise RuntimeError("Unknown primitive type {}".format(additional_info))
-        elif member_type_info == BinaryType.String:
-            instance.add_value(read_record_type_enum(file))
-        elif member_type_info == BinaryType.Object:
-            instance.add_value(read_record_type_enum(file))
-        elif member_type_info == BinaryType.SystemClass:
-            instance.add_value(read_record_type_enum(file))
-        elif member_type_info == BinaryType.Class:
-            instance.add_value(read_record_type_enum(file))
-        elif member_type_info == BinaryType.ObjectArray:
-            instance.add_value(read_record_type_enum(file))
-        elif member_type_info == BinaryType.StringArray:
-            instance.add_value(read_record_type_enum(file))
-        elif member_type_info == BinaryType.PrimitiveArray:
-            instance.add_value(read_record_type_enum(file))
-        else:
-            raise RuntimeError("member_type_info {} is invalid".format(member_type_info))
+# Field wrapper of each fixed-width primitive. TimeSpan and DateTime are
+# kept as their raw 64-bit tick counts
+_FIXED_PRIMITIVES = {
+    PrimitiveType.Boolean: MSBoolean,
+    PrimitiveType.Byte: MSByte,
+    PrimitiveType.Double: MSDouble,
+    PrimitiveType.Int16: MSInteger16,
+    PrimitiveType.Int32: MSInteger32,
+    PrimitiveType.Int64: MSInteger64,
+    PrimitiveType.SByte: MSSignedByte,
+    PrimitiveType.Single: MSSingle,
+    PrimitiveType.TimeSpan: MSInteger64,
+    PrimitiveType.DateTime: MSUnsignedInteger64,
+    PrimitiveType.UInt16: MSUnsignedInteger16,
+    PrimitiveType.UInt32: MSUnsignedInteger32,
+    PrimitiveType.UInt64: MSUnsignedInteger64,
+}
+
+# array.array typecode used to bulk decode an ArraySinglePrimitive of each type
+_ARRAY_TYPECODES = {
+    PrimitiveType.Boolean: "B",
+    PrimitiveType.Byte: "B",
+    PrimitiveType.Double: "d",
+    PrimitiveType.Int16: "h",
+    PrimitiveType.Int32: "i",
+    PrimitiveType.Int64: "q",
+    PrimitiveType.SByte: "b",
+    PrimitiveType.Single: "f",
+    PrimitiveType.UInt16: "H",
+    PrimitiveType.UInt32: "I",
+    PrimitiveType.UInt64: "Q",
+}
+
+
+def get_primitive(file, primitive_type):
+    field_type = _FIXED_PRIMITIVES.get(primitive_type)
+    if field_type is not None:
+        return get_field(file, field_type)
+    elif primitive_type == PrimitiveType.Char:
+        return get_char(file)
+    elif primitive_type == PrimitiveType.Decimal:
+        return get_decimal(file)
+    elif primitive_type == PrimitiveType.Null:
+        return get_null(file)
+    elif primitive_type == PrimitiveType.String:
+        return get_string(file)
+    raise RuntimeError("Unknown primitive type {}".format(primitive_type))
 
 
 def get_array_info(file):
@@ -214,42 +162,7 @@ def get_class_info(file, extend: bool=False):
 
 
 def get_system_class_type_info(file):
-    type_name = get_string(file)
-    print("get_system_class_type_info() -> Read {}".format(type_name))
-
-
-def get_class_type_info(file):
-    type_name = get_length_prefixed_string(file)
-    library_id = get_int(file, 4)
-    is_valid_library_id = False
-    for binaryLibrary in BinaryLibraryRecord:
-        if binaryLibrary.libraryId == library_id:
-            is_valid_library_id = True
-            break
-    if not is_valid_library_id:
-        raise RuntimeError("Class {} does not have a valid library_id ({})".format(type_name, library_id))
-
-    return ClassTypeInfo(type_name, library_id)
-
-
-def get_member_type_info(file, class_info):
-    binary_types = list()
-
-    for i in range(0, class_info.member_count):
-        binary_types.append(get_int(file))
-
-    additional_info = list()
-    for bin_type in binary_types:
-        if bin_type == 0 or bin_type == 7:
-            additional_info.append(get_int(file))
-        elif bin_type == 1 or bin_type == 2 or bin_type == 5 or bin_type == 6:
-            additional_info.append(None)
-        elif bin_type == 3:
-            additional_info.append(get_system_class_type_info(file))
-        elif bin_type == 4:
-            additional_info.append(get_class_type_info(file))
-
-    return binary_types, additional_info
+    get_string(file)  # type name
 
 
 def read_serialized_stream_header(file):
@@ -264,23 +177,6 @@ def read_serialized_stream_header(file):
     print("=> HEADER VERIFICATION SUCCESS")
 
 
-def get_class_with_id(file):
-    # Type value 1
-    object_id = get_int(file, 4)
-    metadata_id = get_int(file, 4)
-    update_object = get_object_from_id(metadata_id)
-    if update_object is None:
-        print("ERR: unable to find object to update")
-
-    # TODO: Check if making the above an exception breaks anything
-
-    new_instance = ObjectInstance(object_id, metadata_id)
-    update_object.extra_data.register_instance(new_instance)
-    get_values(file, update_object.extra_data.member_type_info, new_instance)
-
-    return new_instance
-
-
 def read_system_class_with_members(file):
     # Type value 2
     pos = file.tell()
@@ -288,74 +184,6 @@ def read_system_class_with_members(file):
     print("read_system_class_with_members() -> Read {} at {}".format(class_info, pos))
 
 
-def get_class_with_members_and_types(file):
-    # Type value 5
-    class_info = get_class_info(file)
-    member_type_info = get_member_type_info(file, class_info)
-    _ = get_int(file, 4)  # library_id
-    class_object = ClassWithMembersAndTypes(class_info, member_type_info)
-    get_values(file, member_type_info, class_object.instances[0])
-    register_object_id(IdentifiableObject(class_info.object_id, class_object))
-    return class_object.instances[0]
-
-
-def get_system_class_with_members_and_types(file):
-    # Type value 4
-    class_info = get_class_info(file)
-    member_type_info = get_member_type_info(file, class_info)
-    class_object = ClassWithMembersAndTypes(class_info, member_type_info)
-    _ = get_values(file, member_type_info, class_object.instances[0])  # values
-    register_object_id(IdentifiableObject(class_info.object_id, class_object))
-    return class_object.instances[0]
-
-
-def read_binary_object_string(file):
-    # Type value 6
-    object_id = get_int(file, 4)
-    value = get_length_prefixed_string(file)
-    return BinaryObjectString(object_id, value)
-
-
-def read_binary_array(file):
-    # Type value 7
-    _ = get_int(file, 4)  # object_id
-    binary_type_enum = get_int(file)
-    rank = get_int(file, 4)
-    lengths = list()
-    for i in range(0, rank):
-        lengths.append(get_int(file, 4))
-
-    if binary_type_enum in [BinaryArrayType.SingleOffset, BinaryArrayType.JaggedOffset,
-                            BinaryArrayType.RectangularOffset]:
-        lower_bounds = []
-        for i in range(0, rank):
-            lower_bounds.append(get_int(file, 4))
-
-    type_enum = get_int(file)
-    if type_enum == 0 or type_enum == 7:
-        get_int(file)
-    elif type_enum == 1 or type_enum == 2 or type_enum == 5 or type_enum == 6:
-        pass
-    elif type_enum == 3:
-        get_system_class_type_info(file)
-    elif type_enum == 4:
-        get_class_type_info(file)
-
-
-def get_member_reference(file):
-    # Type value 9
-    id_ref = get_int(file, 4)
-    return MemberReference(id_ref)
-
-
-def read_binary_library(file):
-    # Type value 12
-    library_id = get_int(file, 4)
-    library_name = get_length_prefixed_string(file)
-
-    BinaryLibraryRecord.append(BinaryLibrary(library_id, library_name))
-
-
 def read_object_null_multiple_256(file):
     # Type value 14
     null_count = get_int(file)
@@ -368,18 +196,6 @@ def read_object_null_multiple(file):
     print("read_object_null_multiple() -> Read {}".format(null_count))
 
 
-def read_array_single_primitive(file):
-    # Type value 15
-    array_info = get_array_info(file)
-    primitive_type_enum = get_int(file, 1)
-
-    values = ArrayInstance(array_info, PrimitiveType(primitive_type_enum))
-
-    for i in range(0, array_info.length):
-        get_values(file, ([BinaryType.Primitive], [primitive_type_enum]), values)
-    return
-
-
 def read_array_single_object(file):
     # Type value 16
     array_info = get_array_info(file)
@@ -392,79 +208,629 @@ def read_array_single_string(file):
     print("read_array_single_string() -> Read {}".format(array_info))
 
 
-def read_record_type_enum(file, top_level: bool=False):
-    global parentlessObjects
-
-    bin_type = get_int(file)
-    typeStats[bin_type] += 1
-
-    if bin_type == RecordType.SerializedStreamHeader:
-        return False
-
-    if bin_type == RecordType.ClassWithId:
-        return get_class_with_id(file)
-    elif bin_type == RecordType.SystemClassWithMembersAndTypes:
-        return get_system_class_with_members_and_types(file)
-    elif bin_type == RecordType.SystemClassWithMembers:
-        return read_system_class_with_members(file)
-    elif bin_type == RecordType.ClassWithMembersAndTypes:
-        val = get_class_with_members_and_types(file)
-        if top_level:
-            parentlessObjects[val.class_base.class_info.name] = val
-        return val
-    elif bin_type == RecordType.BinaryObjectString:
-        return read_binary_object_string(file)
-    elif bin_type == RecordType.BinaryArray:
-        return read_binary_array(file)
-    elif bin_type == RecordType.MemberReference:
-        return get_member_reference(file)
-    elif bin_type == RecordType.ObjectNull:
-        pass
-    elif bin_type == RecordType.BinaryLibrary:
-        return read_binary_library(file)
-    elif bin_type == RecordType.ObjectNullMultiple256:
-        return read_object_null_multiple_256(file)
-    elif bin_type == RecordType.ObjectNullMultiple:
-        return read_object_null_multiple(file)
-    elif bin_type == RecordType.ArraySinglePrimitive:
-        return read_array_single_primitive(file)
-    elif bin_type == RecordType.ArraySingleObject:
-        return read_array_single_object(file)
-    elif bin_type == RecordType.ArraySingleString:
-        return read_array_single_string(file)
-    elif bin_type == RecordType.MessageEnd:
-        return False
-    else:
-        raise ValueError("Unknown Binary Type {} at {}".format(bin_type, file.tell()))
+class RecordDecoder(object):
+    """Decodes the members of every instance of one class
+
+    The member type info of a class is walked once, when the class is
+    defined. Runs of consecutive fixed-width primitives are merged into a
+    single step, and every other member becomes a step of its own, so
+    decoding an instance never dispatches on the type of each member.
+
+    Fixed-width members are not decoded while parsing: the parser only
+    records where each run starts, in the instance's runs, and skips
+    over it. A member is decoded from the save the first time it is
+    accessed, see ObjectInstance. Nested records and strings, whose size
+    is only known by reading them, are decoded straight away.
+    """
+
+    def __init__(self, member_type_info) -> None:
+        self._steps = []
+        # Per member: (run, offset in the run, field type) for fixed-width members, None for the others
+        self.fields = []  # type: List[Optional[Tuple[int, int, Any]]]
+        self.run_count = 0
+        run_size = 0
+        for index, (binary_type, additional_info) in enumerate(zip(member_type_info[0], member_type_info[1])):
+            field_type = _FIXED_PRIMITIVES.get(additional_info) if binary_type == BinaryType.Primitive else None
+            if field_type is not None:
+                self.fields.append((self.run_count, run_size, field_type))
+                run_size += field_type.fmt.size
+                continue
+
+            if run_size:
+                self._steps.append((run_size, None, None))
+                self.run_count += 1
+                run_size = 0
+            self.fields.append(None)
+            if binary_type == BinaryType.Primitive:
+                self._steps.append((0, index, additional_info))
+            else:
+                # Every non-primitive member is a nested record
+                self._steps.append((0, index, None))
+        if run_size:
+            self._steps.append((run_size, None, None))
+            self.run_count += 1
+
+    def decode(self, parser: 'SaveParser', instance: ObjectInstance) -> None:
+        file = parser.file
+        values = [UNDECODED] * len(self.fields)
+        runs = []
+        for run_size, index, info in self._steps:
+            if run_size:
+                position = file.tell()
+                runs.append(position)
+                file.seek(position + run_size)
+            elif info is None:
+                values[index] = parser.read_record_type_enum()
+            else:
+                values[index] = get_primitive(file, info)
+        instance.set_members(values, tuple(runs) if runs else None)
+
+    def member(self, data: 'Any', runs: 'Tuple[int, ...]', index: int) -> 'Any':
+        """Decode the fixed-width member at index of an instance whose runs start at runs"""
+        run, offset, field_type = self.fields[index]
+        # The wrapper reads its value from the save, so there is no need to unpack it here
+        return field_type(None, runs[run] + offset, data)
+
+    def position(self, runs: 'Tuple[int, ...]', index: int) -> int:
+        """The offset in the save of the fixed-width member at index"""
+        run, offset, _ = self.fields[index]
+        return runs[run] + offset
+
+    def skip(self, scanner: 'RecordScanner', found: 'List[SaveRecord]') -> None:
+        """Move past the members of an instance without decoding them
+
+        Fixed-width runs are skipped with a single seek. Nested member
+        records are walked by the scanner, which adds the ones it yields
+        to found.
+        """
+        file = scanner.file
+        for run_size, _, info in self._steps:
+            if run_size:
+                file.seek(file.tell() + run_size)
+            elif info is None:
+                scanner.scan_record(found)
+            else:
+                get_primitive(file, info)
 
 
-def dump_class(target, level: int=1):
-    target_class = target.classBase
-    print("="*level + ">DUMPING", target_class.classInfo.name, "WITH", len(target_class.instances), "ELEMENTS")
+class SaveParser(object):
+    """Parses one save, and owns everything collected while doing so
 
-    print("="*level + "> VALUES")
-    print("="*level + str(target_class.classInfo.memberNames))
+    All of the state of a parse lives on the parser: the binary
+    libraries, the class definitions by object id, the registry of every
+    identifiable object, the record statistics and the top level
+    objects. Separate parsers share nothing, so saves may be parsed one
+    after another or from several threads at once, and everything read
+    from a save is released together once its parser and objects are
+    dropped.
+    """
 
+    def __init__(self, file) -> None:
+        self.file = file
+        self.libraries = []  # type: List[BinaryLibrary]
+        self.object_ids = {}  # type: Dict[int, IdentifiableObject]
+        self.registry = ObjectRegistry()
+        self.type_stats = [0] * (max(RecordType) + 1)
+        self.parentless_objects = {}  # type: Dict[str, ObjectInstance]
 
-def parse_save_file(filename):
-    with open(filename, mode='rb') as inspected_file:
+    def register_object_id(self, object_id: IdentifiableObject):
+        self.object_ids[object_id.object_id] = object_id
 
-        data_array = bytearray(inspected_file.read())
-        inspected_file.seek(0)
+    def get_object_from_id(self, object_id) -> 'Optional[IdentifiableObject]':
+        """Look up a registered object by its id
 
+        The object table is a dict keyed by object id, so this is a
+        constant time lookup no matter how many records have been parsed.
+
+        :param object_id: The id of the object to find
+        :return: The registered object, or None if no object has that id
+        """
+        return self.object_ids.get(object_id)
+
+    def parse(self) -> 'Dict[str, ObjectInstance]':
+        file = self.file
         start_time = time.time()
         # Read file header
-        header_check = get_int(inspected_file)
+        header_check = get_int(file)
         # The SerializedStreamHeader must be the first record
         assert(header_check == 0)
-        read_serialized_stream_header(inspected_file)
+        read_serialized_stream_header(file)
 
-        while read_record_type_enum(inspected_file, True) is not False:
+        while self.read_record_type_enum(True) is not False:
             continue
         print("==== FINISHED ====")
         print("=> Loading took ", time.time() - start_time, "seconds")
+        return self.parentless_objects
+
+    def get_class_type_info(self):
+        file = self.file
+        type_name = get_length_prefixed_string(file)
+        library_id = get_int(file, 4)
+        is_valid_library_id = False
+        for binaryLibrary in self.libraries:
+            if binaryLibrary.libraryId == library_id:
+                is_valid_library_id = True
+                break
+        if not is_valid_library_id:
+            raise RuntimeError("Class {} does not have a valid library_id ({})".format(type_name, library_id))
+
+        return ClassTypeInfo(type_name, library_id)
+
+    def get_member_type_info(self, class_info):
+        file = self.file
+        binary_types = list()
+
+        for i in range(0, class_info.member_count):
+            binary_types.append(get_int(file))
+
+        additional_info = list()
+        for bin_type in binary_types:
+            if bin_type == 0 or bin_type == 7:
+                additional_info.append(get_int(file))
+            elif bin_type == 1 or bin_type == 2 or bin_type == 5 or bin_type == 6:
+                additional_info.append(None)
+            elif bin_type == 3:
+                additional_info.append(get_system_class_type_info(file))
+            elif bin_type == 4:
+                additional_info.append(self.get_class_type_info())
+
+        return binary_types, additional_info
+
+    def get_class_with_id(self):
+        # Type value 1
+        object_id, metadata_id = self.file.unpack(_CLASS_WITH_ID)
+        update_object = self.get_object_from_id(metadata_id)
+        if update_object is None:
+            print("ERR: unable to find object to update")
+
+        # TODO: Check if making the above an exception breaks anything
+
+        new_instance = ObjectInstance(object_id, metadata_id)
+        self.registry.register(new_instance)
+        update_object.extra_data.register_instance(new_instance)
+        update_object.extra_data.decoder.decode(self, new_instance)
+
+        return new_instance
+
+    def get_class_with_members_and_types(self):
+        # Type value 5
+        file = self.file
+        class_info = get_class_info(file)
+        member_type_info = self.get_member_type_info(class_info)
+        _ = get_int(file, 4)  # library_id
+        return self._define_class(class_info, member_type_info)
+
+    def get_system_class_with_members_and_types(self):
+        # Type value 4
+        class_info = get_class_info(self.file)
+        member_type_info = self.get_member_type_info(class_info)
+        return self._define_class(class_info, member_type_info)
+
+    def _define_class(self, class_info, member_type_info):
+        class_object = self._register_class(class_info, member_type_info)
+        self.registry.register(class_object.instances[0])
+        class_object.decoder.decode(self, class_object.instances[0])
+        return class_object.instances[0]
+
+    def _register_class(self, class_info, member_type_info) -> ClassWithMembersAndTypes:
+        class_object = ClassWithMembersAndTypes(class_info, member_type_info)
+        class_object.decoder = RecordDecoder(member_type_info)
+        class_object.data = self.file.data
+        self.register_object_id(IdentifiableObject(class_info.object_id, class_object))
+        return class_object
+
+    def read_binary_object_string(self):
+        # Type value 6
+        object_id = get_int(self.file, 4)
+        value = get_length_prefixed_string(self.file)
+        string = BinaryObjectString(object_id, value)
+        self.registry.register(string)
+        return string
+
+    def read_binary_array(self):
+        # Type value 7
+        self.get_binary_array_header()
+
+    def get_binary_array_header(self) -> 'Dict[str, Any]':
+        file = self.file
+        object_id = get_int(file, 4)
+        binary_type_enum = get_int(file)
+        rank = get_int(file, 4)
+        lengths = list()
+        for i in range(0, rank):
+            lengths.append(get_int(file, 4))
+
+        lower_bounds = []
+        if binary_type_enum in [BinaryArrayType.SingleOffset, BinaryArrayType.JaggedOffset,
+                                BinaryArrayType.RectangularOffset]:
+            for i in range(0, rank):
+                lower_bounds.append(get_int(file, 4))
+
+        type_enum = get_int(file)
+        if type_enum == 0 or type_enum == 7:
+            get_int(file)
+        elif type_enum == 1 or type_enum == 2 or type_enum == 5 or type_enum == 6:
+            pass
+        elif type_enum == 3:
+            get_system_class_type_info(file)
+        elif type_enum == 4:
+            self.get_class_type_info()
+
+        return {"object_id": object_id, "array_type": binary_type_enum, "lengths": lengths,
+                "lower_bounds": lower_bounds, "item_type": type_enum}
+
+    def get_member_reference(self):
+        # Type value 9
+        id_ref = get_int(self.file, 4)
+        return MemberReference(id_ref, self.registry)
+
+    def read_binary_library(self):
+        # Type value 12
+        library_id = get_int(self.file, 4)
+        library_name = get_length_prefixed_string(self.file)
+
+        self.libraries.append(BinaryLibrary(library_id, library_name))
+
+    def read_array_single_primitive(self):
+        # Type value 15
+        file = self.file
+        array_info = get_array_info(file)
+        primitive_type_enum = get_int(file, 1)
+
+        primitive_type = PrimitiveType(primitive_type_enum)
+        return self._read_primitive_array(array_info, primitive_type)
+
+    def _read_primitive_array(self, array_info: ArrayInfo, primitive_type: PrimitiveType) -> ArrayInstance:
+        file = self.file
+        typecode = _ARRAY_TYPECODES.get(primitive_type)
+        if typecode is not None:
+            offset = file.tell()
+            values = ArrayInstance(array_info, primitive_type, file.read_array(typecode, array_info.length), offset)
+        else:
+            values = ArrayInstance(array_info, primitive_type)
+            for i in range(0, array_info.length):
+                values.add_value(get_primitive(file, primitive_type))
+        self.registry.register(values)
+        return values
+
+    def read_record_type_enum(self, top_level: bool=False):
+        file = self.file
+        bin_type = get_int(file)
+        self.type_stats[bin_type] += 1
+
+        if bin_type == RecordType.SerializedStreamHeader:
+            return False
+
+        if bin_type == RecordType.ClassWithId:
+            return self.get_class_with_id()
+        elif bin_type == RecordType.SystemClassWithMembersAndTypes:
+            return self.get_system_class_with_members_and_types()
+        elif bin_type == RecordType.SystemClassWithMembers:
+            return read_system_class_with_members(file)
+        elif bin_type == RecordType.ClassWithMembersAndTypes:
+            val = self.get_class_with_members_and_types()
+            if top_level:
+                self.parentless_objects[val.class_base.class_info.name] = val
+            return val
+        elif bin_type == RecordType.BinaryObjectString:
+            return self.read_binary_object_string()
+        elif bin_type == RecordType.BinaryArray:
+            return self.read_binary_array()
+        elif bin_type == RecordType.MemberReference:
+            return self.get_member_reference()
+        elif bin_type == RecordType.ObjectNull:
+            pass
+        elif bin_type == RecordType.BinaryLibrary:
+            return self.read_binary_library()
+        elif bin_type == RecordType.ObjectNullMultiple256:
+            return read_object_null_multiple_256(file)
+        elif bin_type == RecordType.ObjectNullMultiple:
+            return read_object_null_multiple(file)
+        elif bin_type == RecordType.ArraySinglePrimitive:
+            return self.read_array_single_primitive()
+        elif bin_type == RecordType.ArraySingleObject:
+            return read_array_single_object(file)
+        elif bin_type == RecordType.ArraySingleString:
+            return read_array_single_string(file)
+        elif bin_type == RecordType.MessageEnd:
+            return False
+        else:
+            raise ValueError("Unknown Binary Type {} at {}".format(bin_type, file.tell()))
+
+
+class InstrumentedSaveParser(SaveParser):
+    """A SaveParser reporting every record it reads to a ParseTelemetry
+
+    Automatic garbage collection is paused while parsing, since a
+    collection resets the object counts the telemetry relies on.
+    """
+
+    def __init__(self, file, telemetry: 'ParseTelemetry') -> None:
+        super().__init__(file)
+        self.telemetry = telemetry
+
+    def parse(self) -> 'Dict[str, ObjectInstance]':
+        with gc_paused():
+            objects = super().parse()
+        self.telemetry.saves += 1
+        return objects
+
+    def read_record_type_enum(self, top_level: bool=False):
+        file = self.file
+        start = file.tell()
+        self.telemetry.begin(start)
+        record = super().read_record_type_enum(top_level)
+        # Arrays are ObjectInstances too, but of no class
+        class_base = record.class_base if isinstance(record, ObjectInstance) else None
+        self.telemetry.end(file.data[start], file.tell(), None if class_base is None else class_base.class_info.name)
+        return record
+
+
+_RECORD_TYPES = {int(record_type): record_type for record_type in RecordType}
+
+# Records that are instances of a class, and so can be filtered by class name
+_CLASS_RECORDS = (RecordType.ClassWithId, RecordType.SystemClassWithMembersAndTypes,
+                  RecordType.ClassWithMembersAndTypes, RecordType.SystemClassWithMembers)
+
+
+class RecordScanner(SaveParser):
+    """Walks the records of a save one at a time, without building the object graph
+
+    Records are yielded in stream order as SaveRecords. Records nested in
+    the members of a class record follow that record, so its length can
+    include them. The bodies of class instances and primitive arrays are
+    skipped with the decoders' fixed-width runs rather than decoded, and
+    nothing is kept but the class definitions needed to skip later
+    instances. A caller that found what it needed can stop iterating early.
+
+    With class_names, only instances of those classes are yielded, and
+    every other record is skipped without building its header or
+    SaveRecord. Such a filtered scan takes a third to a half of the time
+    of a full parse. An unfiltered scan yields a SaveRecord for every
+    record and takes about as long as a parse.
+
+    With decode, the yielded records are decoded as SaveParser would, and
+    the result is the record's instance; members nested in a decoded
+    record are part of its instance rather than yielded on their own, and
+    references to records that were skipped stay unresolved.
+    """
+
+    def __init__(self, file, class_names: 'Optional[Iterable[str]]'=None, decode: bool=False) -> None:
+        SaveParser.__init__(self, file)
+        self.class_names = None if class_names is None else set(class_names)
+        self.decode = decode
+
+    def records(self) -> 'Iterator[SaveRecord]':
+        file = self.file
+        offset = file.tell()
+        if get_int(file) != RecordType.SerializedStreamHeader:
+            raise ValueError("Not a save: the first record is not a SerializedStreamHeader")
+        root_id, header_id, major_version, minor_version = file.unpack(_STREAM_HEADER)
+        if self.class_names is None:
+            header = {"root_id": root_id, "header_id": header_id,
+                      "major_version": major_version, "minor_version": minor_version}
+            yield SaveRecord(RecordType.SerializedStreamHeader, offset, file.tell() - offset, header)
+
+        found = []  # type: List[SaveRecord]
+        while True:
+            record_type = self.scan_record(found)
+            yield from found
+            found.clear()
+            if record_type in (RecordType.MessageEnd, RecordType.SerializedStreamHeader):
+                return
+
+    def scan_record(self, found: 'List[SaveRecord]') -> RecordType:
+        """Read one record, adding it and the records nested in it to found if they are wanted
+
+        :return: The type of the record read
+        """
+        file = self.file
+        offset = file.tell()
+        bin_type = get_int(file)
+        record_type = _RECORD_TYPES.get(bin_type)
+        if record_type is None:
+            raise ValueError("Unknown Binary Type {} at {}".format(bin_type, offset))
+        self.type_stats[bin_type] += 1
+
+        if record_type in _CLASS_RECORDS:
+            self._scan_class_record(record_type, offset, found)
+        elif self.class_names is None:
+            # Nested records follow the record they are in, so take its place before reading it
+            index = len(found)
+            found.append(None)
+            header, instance = self._scan_record(record_type)
+            found[index] = SaveRecord(record_type, offset, file.tell() - offset, header, instance)
+        else:
+            self._skip_record(record_type)
+        return record_type
+
+    def _wanted(self, class_name: str) -> bool:
+        return self.class_names is None or class_name in self.class_names
+
+    def _scan_class_record(self, record_type: RecordType, offset: int, found: 'List[SaveRecord]') -> None:
+        file = self.file
+        if record_type == RecordType.ClassWithId:
+            object_id, metadata_id = file.unpack(_CLASS_WITH_ID)
+            definition = self.get_object_from_id(metadata_id)
+            if definition is None:
+                raise ValueError("Record {} refers to undefined class {}".format(object_id, metadata_id))
+            class_object = definition.extra_data
+            class_name = class_object.class_info.name
+            if not self._wanted(class_name):
+                class_object.decoder.skip(self, found)
+                return
+            index = len(found)
+            found.append(None)
+            header = {"object_id": object_id, "metadata_id": metadata_id, "class_name": class_name}
+            instance = None
+            if self.decode:
+                instance = ObjectInstance(object_id, metadata_id)
+                self.registry.register(instance)
+                class_object.register_instance(instance)
+                class_object.decoder.decode(self, instance)
+            else:
+                class_object.decoder.skip(self, found)
+            found[index] = SaveRecord(record_type, offset, file.tell() - offset, header, instance)
+            return
+
+        class_info = get_class_info(file)
+        wanted = self._wanted(class_info.name)
+        if record_type == RecordType.SystemClassWithMembers:
+            # Not supported by SaveParser either: its members have no type info to decode them with
+            member_type_info, library_id = None, None
+        else:
+            member_type_info = self.get_member_type_info(class_info)
+            library_id = get_int(file, 4) if record_type == RecordType.ClassWithMembersAndTypes else None
+        index = len(found)
+        if wanted:
+            found.append(None)
+        instance = None
+        if member_type_info is not None:
+            if wanted and self.decode:
+                instance = self._define_class(class_info, member_type_info)
+            else:
+                self._register_class(class_info, member_type_info).decoder.skip(self, found)
+        if wanted:
+            header = {"object_id": class_info.object_id, "class_name": class_info.name,
+                      "member_names": class_info.member_names}
+            if library_id is not None:
+                header["library_id"] = library_id
+            found[index] = SaveRecord(record_type, offset, file.tell() - offset, header, instance)
+
+    def _skip_record(self, record_type: RecordType) -> None:
+        """Move past a record that is not a class instance without reading more of it than needed"""
+        file = self.file
+        if record_type == RecordType.MemberReference:
+            file.seek(file.tell() + 4)
+        elif record_type in (RecordType.ObjectNull, RecordType.MessageEnd, RecordType.SerializedStreamHeader):
+            pass
+        elif record_type == RecordType.ObjectNullMultiple256:
+            file.seek(file.tell() + 1)
+        elif record_type == RecordType.ObjectNullMultiple:
+            file.seek(file.tell() + 4)
+        else:
+            self._scan_record(record_type)
+
+    def _scan_record(self, record_type: RecordType) -> 'Tuple[Dict, Any]':
+        file = self.file
+        if record_type == RecordType.BinaryObjectString:
+            object_id = get_int(file, 4)
+            return {"object_id": object_id, "value": get_length_prefixed_string(file)}, None
+        elif record_type == RecordType.BinaryArray:
+            return self.get_binary_array_header(), None
+        elif record_type == RecordType.MemberReference:
+            return {"id_ref": get_int(file, 4)}, None
+        elif record_type == RecordType.BinaryLibrary:
+            self.read_binary_library()
+            library = self.libraries[-1]
+            return {"library_id": library.libraryId, "name": library.libraryName}, None
+        elif record_type == RecordType.ObjectNullMultiple256:
+            return {"null_count": get_int(file)}, None
+        elif record_type == RecordType.ObjectNullMultiple:
+            return {"null_count": get_int(file, 4)}, None
+        elif record_type == RecordType.ArraySinglePrimitive:
+            array_info = get_array_info(file)
+            primitive_type = PrimitiveType(get_int(file))
+            header = {"object_id": array_info.object_id, "length": array_info.length,
+                      "primitive_type": primitive_type}
+            if self.decode:
+                return header, self._read_primitive_array(array_info, primitive_type)
+            typecode = _ARRAY_TYPECODES.get(primitive_type)
+            if typecode is not None:
+                file.seek(file.tell() + struct.calcsize(typecode) * array_info.length)
+            else:
+                for i in range(0, array_info.length):
+                    get_primitive(file, primitive_type)
+            return header, None
+        elif record_type in (RecordType.ArraySingleObject, RecordType.ArraySingleString):
+            array_info = get_array_info(file)
+            return {"object_id": array_info.object_id, "length": array_info.length}, None
+        elif record_type in (RecordType.ObjectNull, RecordType.MessageEnd, RecordType.SerializedStreamHeader):
+            return {}, None
+        raise ValueError("Unsupported record type {} at {}".format(record_type.name, file.tell() - 1))
+
 
-    return parentlessObjects, data_array
+def dump_class(target, level: int=1):
+    target_class = target.classBase
+    print("="*level + ">DUMPING", target_class.classInfo.name, "WITH", len(target_class.instances), "ELEMENTS")
+
+    print("="*level + "> VALUES")
+    print("="*level + str(target_class.classInfo.memberNames))
+
+
+def _make_parser(file, telemetry: 'Optional[ParseTelemetry]') -> SaveParser:
+    return SaveParser(file) if telemetry is None else InstrumentedSaveParser(file, telemetry)
+
+
+def parse_save_buffer(data, telemetry: 'Optional[ParseTelemetry]'=None) -> SaveParser:
+    """Parse a save held in memory
+
+    :param data: The contents of a save; any object supporting the buffer protocol
+    :param telemetry: Measure every record read into this
+    :return: The parser, holding the parsed objects and all parse state
+    """
+    reader = BufferReader(data)
+    parser = _make_parser(reader, telemetry)
+    try:
+        parser.parse()
+    finally:
+        reader.close()
+        parser.file = None
+    return parser
+
+
+def parse_save_file(filename, mode: ReaderMode=ReaderMode.Buffer, telemetry: 'Optional[ParseTelemetry]'=None):
+    """Parse a save file
+
+    The file is read into memory once. With ReaderMode.Buffer the records
+    are decoded straight out of that buffer; ReaderMode.File decodes them
+    from the file object instead, one read call per field.
+
+    :param filename: The path of the save to parse
+    :param mode: Where records are decoded from
+    :param telemetry: Measure every record read into this, see ParseTelemetry
+    :return: A tuple of (top level objects, save contents)
+    """
+    with open(filename, mode='rb') as inspected_file:
+        data_array = bytearray(inspected_file.read())
+        if mode != ReaderMode.File:
+            return parse_save_buffer(data_array, telemetry).parentless_objects, data_array
+
+        inspected_file.seek(0)
+        parser = _make_parser(FileReader(inspected_file, data_array), telemetry)
+        parser.parse()
+        parser.file = None
+
+    return parser.parentless_objects, data_array
+
+
+def iter_save_records(data, class_names: 'Optional[Iterable[str]]'=None,
+                      decode: bool=False) -> 'Iterator[SaveRecord]':
+    """Iterate over the records of a save held in memory, see RecordScanner
+
+    :param data: The contents of a save; any object supporting the buffer protocol
+    :param class_names: Only yield instances of these classes
+    :param decode: Decode the yielded records into objects
+    :return: The records, in stream order
+    """
+    reader = BufferReader(data)
+    scanner = RecordScanner(reader, class_names, decode)
+    try:
+        yield from scanner.records()
+    finally:
+        scanner.file = None
+        reader.close()
+
+
+def iter_save_file_records(filename, class_names: 'Optional[Iterable[str]]'=None,
+                           decode: bool=False) -> 'Iterator[SaveRecord]':
+    """Iterate over the records of a save file, see iter_save_records
+
+    Decoded values refer to the save contents read here, not to the file.
+    """
+    with open(filename, mode='rb') as inspected_file:
+        data_array = bytearray(inspected_file.read())
+    yield from iter_save_records(data_array, class_names, decode)
 
 
 def write_save_file(output_file_name, data_array):
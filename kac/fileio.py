@@ -0,0 +1,13 @@
+import os
+
+
+def write_atomic(path: str, data: bytes) -> None:
+    """Write a file so that readers only ever see it complete
+
+    Batch workers share the backup store and the parse cache, so a partly
+    written file must never be left where another process may read it.
+    """
+    temp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(temp_path, mode="wb") as new_file:
+        new_file.write(data)
+    os.replace(temp_path, path)
@@ -0,0 +1,37 @@
+import contextlib
+import gc
+import threading
+
+import typing
+if typing.TYPE_CHECKING:
+    from typing import Iterator
+
+
+_lock = threading.Lock()
+# How many gc_paused blocks are running, and whether the collector was enabled when the first began
+_depth = 0
+_was_enabled = False
+
+
+@contextlib.contextmanager
+def gc_paused() -> 'Iterator[None]':
+    """Pause automatic garbage collection while the block runs
+
+    The collector is global to the process, so overlapping pauses, from
+    nested blocks or from other threads, are counted: the collector is
+    disabled when the first one begins and, if it was enabled then,
+    enabled again only when the last one ends.
+    """
+    global _depth, _was_enabled
+    with _lock:
+        if _depth == 0:
+            _was_enabled = gc.isenabled()
+            gc.disable()
+        _depth += 1
+    try:
+        yield
+    finally:
+        with _lock:
+            _depth -= 1
+            if _depth == 0 and _was_enabled:
+                gc.enable()
@@ -0,0 +1,144 @@
+import numpy
+
+from kac.vartypes import MSBoolean, MSInteger32
+
+import typing
+if typing.TYPE_CHECKING:
+    from typing import Any, Dict, List, Optional, Sequence, Tuple
+    from kac.journal import Journal
+
+
+class TileGrid(object):
+    """NumPy view of the tile fields of a map
+
+    For each tile field the grid holds an array of shape (height, width)
+    with the byte offset of that field in the save, so that whole-map
+    edits become vectorized writes to the save buffer instead of one
+    update() call per field per tile. Values are always read from the
+    buffer, so they reflect edits made through any path.
+    """
+
+    # Field name -> type of the field in the save
+    Fields = {
+        "type": MSInteger32,
+        "amount": MSInteger32,
+        "fertile": MSInteger32,
+        "saltWater": MSBoolean,
+        "deepWater": MSBoolean,
+    }
+
+    def __init__(self, tiles: 'List[Any]', width: int, height: int, data: bytearray) -> None:
+        if len(tiles) != width * height:
+            raise ValueError("Expected {} tiles, got {}".format(width * height, len(tiles)))
+        self._width = width
+        self._height = height
+        self._data = data
+        self._offsets = {}  # type: Dict[str, numpy.ndarray]
+        for name in TileGrid.Fields:
+            if name == "type":
+                positions = [tile["type"].position("value__") for tile in tiles]
+            else:
+                positions = [tile.position(name) for tile in tiles]
+            self._offsets[name] = numpy.array(positions, dtype=numpy.intp).reshape(height, width)
+
+    def offsets(self, name: str) -> numpy.ndarray:
+        """The byte offset of a field for every tile, as a (height, width) array"""
+        return self._offsets[name]
+
+    def values(self, name: str, mask: 'Optional[numpy.ndarray]'=None) -> numpy.ndarray:
+        """The current value of a field for every tile
+
+        :param mask: A (height, width) boolean array of the tiles to read; all tiles if None
+        :return: A (height, width) array, or a flat array of the selected tiles if mask is given
+        """
+        offsets = self._offsets[name]
+        if mask is not None:
+            offsets = offsets[mask]
+        return TileGrid.Fields[name].read_many(self._data, offsets)
+
+    def write(self, name: str, value: 'Any', mask: 'Optional[numpy.ndarray]'=None,
+              journal: 'Optional[Journal]'=None) -> int:
+        """Write a field of every tile selected by mask
+
+        :param name: The field to write
+        :param value: A scalar, or an array broadcastable to the selected tiles
+        :param mask: A (height, width) boolean array of the tiles to write; all tiles if None
+        :param journal: Records the bytes changed, for undo
+        :return: The number of tiles written
+        """
+        offsets = self._offsets[name]
+        if mask is not None:
+            offsets = offsets[mask]
+            if numpy.ndim(value) > 0:
+                value = numpy.asarray(value)[mask]
+        return TileGrid.Fields[name].update_many(self._data, offsets, value, journal)
+
+    @property
+    def width(self) -> int:
+        return self._width
+
+    @property
+    def height(self) -> int:
+        return self._height
+
+    @property
+    def shape(self) -> 'Tuple[int, int]':
+        return self._height, self._width
+
+    @property
+    def type(self) -> numpy.ndarray:
+        return self.values("type")
+
+    @property
+    def amount(self) -> numpy.ndarray:
+        return self.values("amount")
+
+    @property
+    def fertile(self) -> numpy.ndarray:
+        return self.values("fertile")
+
+    @property
+    def salt_water(self) -> numpy.ndarray:
+        return self.values("saltWater")
+
+    @property
+    def deep_water(self) -> numpy.ndarray:
+        return self.values("deepWater")
+
+
+def rect_mask(shape: 'Tuple[int, int]', x: int, y: int, width: int, height: int) -> numpy.ndarray:
+    """Select the tiles of a rectangle, clipped to the map
+
+    :param shape: The (height, width) of the map
+    :return: A boolean array of the given shape
+    """
+    mask = numpy.zeros(shape, dtype=bool)
+    mask[max(0, y):max(0, y + height), max(0, x):max(0, x + width)] = True
+    return mask
+
+
+def polygon_mask(shape: 'Tuple[int, int]', points: 'Sequence[Tuple[float, float]]') -> numpy.ndarray:
+    """Select the tiles whose centers lie inside a polygon
+
+    Uses the even-odd rule, testing every tile center against each edge
+    at once.
+
+    :param shape: The (height, width) of the map
+    :param points: The (x, y) vertices of the polygon, in tile coordinates
+    :return: A boolean array of the given shape
+    """
+    if len(points) < 3:
+        raise ValueError("A polygon needs at least 3 points, got {}".format(len(points)))
+    ys, xs = numpy.mgrid[0:shape[0], 0:shape[1]]
+    xs = xs + 0.5
+    ys = ys + 0.5
+    mask = numpy.zeros(shape, dtype=bool)
+    for i in range(len(points)):
+        x1, y1 = points[i - 1]
+        x2, y2 = points[i]
+        if y1 == y2:
+            continue
+        crosses = (ys >= min(y1, y2)) & (ys < max(y1, y2))
+        intersect_x = x1 + (ys - y1) * (x2 - x1) / (y2 - y1)
+        mask ^= crosses & (xs < intersect_x)
+    return mask
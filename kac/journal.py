@@ -0,0 +1,147 @@
+import contextlib
+
+import numpy
+
+import typing
+if typing.TYPE_CHECKING:
+    from typing import Any, Iterator, List, Tuple, Union
+
+
+# Rough per-entry cost of a scalar patch tuple on top of its bytes
+_ENTRY_OVERHEAD = 120
+
+
+class Journal(object):
+    """Records edits to a save buffer as byte patches, for undo and redo
+
+    Each patch is (offset, old bytes, new bytes) for a single field write,
+    or (positions, old bytes, new bytes) as NumPy arrays for a bulk write.
+    Patches are grouped so that one brush stroke or one bulk operation is
+    undone as a whole; undo and redo only touch the bytes that changed.
+    When the recorded history grows past budget bytes the oldest groups
+    are dropped.
+    """
+
+    def __init__(self, data: bytearray, budget: int=64 * 1024 * 1024) -> None:
+        self._data = data
+        self._bytes = numpy.frombuffer(data, dtype=numpy.uint8)
+        self.budget = budget
+        self._undo = []  # type: List[List[Tuple[Any, Any, Any]]]
+        self._redo = []  # type: List[List[Tuple[Any, Any, Any]]]
+        self._group = None  # type: List[Tuple[Any, Any, Any]]
+        self._depth = 0
+        self._size = 0
+
+    def begin(self) -> None:
+        """Start a group; groups may nest, only the outermost one counts"""
+        if self._depth == 0:
+            self._group = []
+        self._depth += 1
+
+    def end(self) -> None:
+        """Close the group opened by begin"""
+        if self._depth == 0:
+            return
+        self._depth -= 1
+        if self._depth == 0:
+            group, self._group = self._group, None
+            if len(group) > 0:
+                self._push(group)
+
+    @contextlib.contextmanager
+    def group(self) -> 'Iterator[None]':
+        self.begin()
+        try:
+            yield
+        finally:
+            self.end()
+
+    def record(self, offset: int, old: bytes, new: bytes) -> None:
+        """Record a write of new over old at offset; the write itself is done by the caller"""
+        if old == new:
+            return
+        self._add((offset, bytes(old), bytes(new)))
+
+    def record_bytes(self, positions: numpy.ndarray, old: numpy.ndarray, new: numpy.ndarray) -> None:
+        """Record a bulk write of the single bytes at positions, keeping only those that changed"""
+        changed = old != new
+        if not changed.any():
+            return
+        self._add((positions[changed], old[changed], new[changed]))
+
+    def undo(self) -> bool:
+        """Revert the most recent group
+
+        :return: False if there was nothing to undo
+        """
+        if len(self._undo) == 0:
+            return False
+        group = self._undo.pop()
+        for offset, old, _ in reversed(group):
+            self._apply(offset, old)
+        self._redo.append(group)
+        return True
+
+    def redo(self) -> bool:
+        """Reapply the most recently undone group
+
+        :return: False if there was nothing to redo
+        """
+        if len(self._redo) == 0:
+            return False
+        group = self._redo.pop()
+        for offset, _, new in group:
+            self._apply(offset, new)
+        self._undo.append(group)
+        return True
+
+    def clear(self) -> None:
+        self._undo = []
+        self._redo = []
+        self._size = 0
+
+    @property
+    def can_undo(self) -> bool:
+        return len(self._undo) > 0
+
+    @property
+    def can_redo(self) -> bool:
+        return len(self._redo) > 0
+
+    @property
+    def size(self) -> int:
+        """The approximate memory used by the recorded history, in bytes"""
+        return self._size
+
+    def _add(self, entry: 'Tuple[Any, Any, Any]') -> None:
+        if self._group is not None:
+            self._group.append(entry)
+        else:
+            self._push([entry])
+
+    def _push(self, group: 'List[Tuple[Any, Any, Any]]') -> None:
+        # A new edit makes the undone history unreachable
+        for undone in self._redo:
+            self._size -= _group_size(undone)
+        self._redo = []
+        self._undo.append(group)
+        self._size += _group_size(group)
+        while self._size > self.budget and len(self._undo) > 1:
+            self._size -= _group_size(self._undo.pop(0))
+
+    def _apply(self, offset: 'Union[int, numpy.ndarray]', values: 'Any') -> None:
+        if isinstance(offset, numpy.ndarray):
+            self._bytes[offset] = values
+        else:
+            self._data[offset:offset + len(values)] = values
+
+
+def _entry_size(entry: 'Tuple[Any, Any, Any]') -> int:
+    offset, old, new = entry
+    if isinstance(offset, numpy.ndarray):
+        return offset.nbytes + old.nbytes + new.nbytes
+    return _ENTRY_OVERHEAD + len(old) + len(new)
+
+
+def _group_size(group: 'List[Tuple[Any, Any, Any]]') -> int:
+    return sum(_entry_size(entry) for entry in group)
@@ -1,16 +1,20 @@
 
+import contextlib
 import math
+import numpy
 import pygame
 from pygame import Rect
 
 import kac.colors as colors
 from kac.brush import Brush
+from kac.grid import TileGrid
 from kac.gui import Widget
 from kac.tile import TileType, Fertility
 
 import typing
 if typing.TYPE_CHECKING:
-    import Optional
+    from typing import ContextManager, Iterable, List, Optional, Set, Tuple
+    from kac.journal import Journal
 
 
 class KacMap(object):
@@ -19,21 +23,24 @@ class KacMap(object):
     KeyTownName = "TownNameUI+TownNameSaveData"
     KeyBuildings = "Building+BuildingSaveData"
 
-    def __init__(self, map_objects, data_file) -> None:
+    def __init__(self, map_objects, data_file, journal: 'Optional[Journal]'=None) -> None:
         self._map_objects = map_objects
         self._data_file = data_file
+        self._journal = journal
         self._tiles = map_objects[KacMap.KeyCellSaveData].class_base.instances
         self._width = self._map_objects[KacMap.KeyWorldSaveData]["gridWidth"].value
         self._height = self._map_objects[KacMap.KeyWorldSaveData]["gridHeight"].value
         self._name = self._map_objects[KacMap.KeyTownName]["townName"].value
         self._object_data = None
         self._objects = [None] * len(self._tiles)
+        self._grid = None
+        self._color_indices = None  # type: Optional[numpy.ndarray]
 
         if KacMap.KeyBuildings in self._map_objects:
             print("Buildings: ")
             self._object_data = self._map_objects[KacMap.KeyBuildings].class_base.instances
             for building in self._object_data:
-                pos = building["globalPosition"]["x"][0], building["globalPosition"]["z"][0]
+                pos = building["globalPosition"]["x"].value, building["globalPosition"]["z"].value
                 idx = int(pos[0] + pos[1] * self._width)
                 self._objects[idx] = building["uniqueName"].value
                 print("  ({}, {}) -> {}".format(int(pos[0]), int(pos[1]), building.values.keys()))
@@ -41,16 +48,110 @@ class KacMap(object):
     def tile_size(self, width: float) -> float:
         return width / self._width
 
-    def turn_all_farms(self):
-        for tile in self._tiles:
-            tile["fertile"].update(self._data_file, 2)
+    def _select(self, condition: 'Optional[numpy.ndarray]', mask: 'Optional[numpy.ndarray]') -> numpy.ndarray:
+        if condition is None:
+            condition = numpy.ones(self.grid.shape, dtype=bool)
+        return condition if mask is None else condition & mask
+
+    def turn_all_farms(self, mask: 'Optional[numpy.ndarray]'=None) -> int:
+        """Make every tile very fertile
+
+        All of the bulk operations below take an optional (height, width)
+        boolean mask, see kac.grid.rect_mask and kac.grid.polygon_mask,
+        and return the number of tiles they changed.
+        """
+        selected = self._select(None, mask)
+        count = self.grid.write("fertile", Fertility.VeryFertile, selected, self._journal)
+        self.refresh_colors(selected)
+        return count
+
+    def fertilize(self, fertility: int=Fertility.VeryFertile, mask: 'Optional[numpy.ndarray]'=None) -> int:
+        """Set the fertility of every land tile"""
+        grid = self.grid
+        selected = self._select(grid.type == TileType.Land, mask)
+        count = grid.write("fertile", fertility, selected, self._journal)
+        self.refresh_colors(selected)
+        return count
+
+    def clear(self, mask: 'Optional[numpy.ndarray]'=None) -> int:
+        """Turn tiles into deep water"""
+        grid = self.grid
+        selected = self._select(None, mask)
+        with self.edit_group():
+            grid.write("fertile", Fertility.Barren, selected, self._journal)
+            grid.write("deepWater", True, selected, self._journal)
+            grid.write("saltWater", False, selected, self._journal)
+            count = grid.write("type", TileType.Water, selected, self._journal)
+        self.refresh_colors(selected)
+        return count
+
+    def salt_water(self, mask: 'Optional[numpy.ndarray]'=None) -> int:
+        """Turn all shallow water into salt water"""
+        grid = self.grid
+        selected = self._select((grid.type == TileType.Water) & ~grid.deep_water, mask)
+        count = grid.write("saltWater", True, selected, self._journal)
+        self.refresh_colors(selected)
+        return count
+
+    def strip_trees(self, mask: 'Optional[numpy.ndarray]'=None) -> int:
+        """Remove the trees from every land tile"""
+        grid = self.grid
+        trees = (grid.type == TileType.Land) & (grid.amount > 0)
+        return grid.write("amount", 0, self._select(trees, mask), self._journal)
+
+    def replace_type(self, old: int, new: int, mask: 'Optional[numpy.ndarray]'=None) -> int:
+        """Change the type of every tile of type old to new"""
+        grid = self.grid
+        selected = self._select(grid.type == old, mask)
+        count = grid.write("type", new, selected, self._journal)
+        self.refresh_colors(selected)
+        return count
+
+    def edit_group(self) -> 'ContextManager':
+        """Group the writes of one operation so they are undone together, if edits are recorded"""
+        if self._journal is None:
+            return contextlib.nullcontext()
+        return self._journal.group()
+
+    def undo(self) -> bool:
+        """Revert the last stroke or bulk operation
+
+        :return: False if there is no journal or nothing to undo
+        """
+        if self._journal is None or not self._journal.undo():
+            return False
+        self.refresh_colors()
+        return True
+
+    def redo(self) -> bool:
+        """Reapply the last undone stroke or bulk operation
+
+        :return: False if there is no journal or nothing to redo
+        """
+        if self._journal is None or not self._journal.redo():
+            return False
+        self.refresh_colors()
+        return True
+
+    def refresh_colors(self, mask: 'Optional[numpy.ndarray]'=None) -> None:
+        """Recompute the color index of the tiles selected by mask, all tiles if None
+
+        Call this after changing tile fields outside of the brush and the
+        bulk operations, which keep the color index up to date themselves.
+        """
+        if self._color_indices is None:
+            return
+        if mask is None:
+            self._color_indices = colors.tile_color_indices(self.grid)
+        else:
+            self._color_indices[mask] = colors.tile_color_indices(self.grid, mask)
 
-    def clear(self):
-        for tile in self._tiles:
-            tile["fertile"].update(self._data_file, Fertility.Barren)
-            tile["deepWater"].update(self._data_file, True)
-            tile["saltWater"].update(self._data_file, False)
-            tile["type"]["value__"].update(self._data_file, TileType.Water)
+    def refresh_tiles(self, positions: 'Iterable[Tuple[int, int]]') -> None:
+        """Recompute the color index of a few (x, y) tiles"""
+        if self._color_indices is None:
+            return
+        for x, y in positions:
+            self._color_indices[y, x] = colors.get_tile_color_index(self.get_tile(x, y))
 
     def get_tile(self, x: int, y: int) -> dict:
         return self._tiles[y * self._width + x]
@@ -58,10 +159,38 @@ class KacMap(object):
     def get_object(self, x: int, y: int) -> 'Optional[str]':
         return self._objects[x + y * self._width]
 
+    def object_positions(self) -> 'List[Tuple[int, int]]':
+        """The (x, y) coordinates of every tile with a building on it"""
+        return [(idx % self._width, idx // self._width) for idx, name in enumerate(self._objects) if name is not None]
+
     @property
     def tiles(self) -> dict:
         return self._tiles
 
+    @property
+    def grid(self) -> TileGrid:
+        """The tile fields as NumPy arrays, built on first use"""
+        if self._grid is None:
+            self._grid = TileGrid(self._tiles, self._width, self._height, self._data_file)
+        return self._grid
+
+    @property
+    def color_indices(self) -> numpy.ndarray:
+        """The colors.ColorIndex of every tile, as a (height, width) uint8 array
+
+        It is built on first use and then kept up to date incrementally by
+        the brush and the bulk operations, so renderers and statistics can
+        read it instead of walking the tile objects.
+        """
+        if self._color_indices is None:
+            self._color_indices = colors.tile_color_indices(self.grid)
+        return self._color_indices
+
+    @property
+    def journal(self) -> 'Optional[Journal]':
+        """Records edits for undo; None if edits are not recorded"""
+        return self._journal
+
     @property
     def objects(self) -> dict:
         return self._map_objects
@@ -84,103 +213,209 @@ class KacMap(object):
 
 
 class MapWidget(Widget):
+    """Draws a map and applies the brush to it
+
+    The map is kept in an offscreen surface. A full redraw only happens
+    when the whole map may have changed (see invalidate) and is done as
+    one vectorized blit; brush strokes repaint just the tiles they
+    touched. render returns the screen rects that changed so they can be
+    passed to pygame.display.update.
+    """
+
     def __init__(self, x: int, y: int, width: int, height: int, map_object: KacMap) -> None:
         Widget.__init__(self, x, y, width, height)
         self.map = map_object
         self.brush = Brush()
         self.grid = True
         self.grid_color = colors.Black
-        self._map_area = self.rect
+        self._surface = None  # type: Optional[pygame.Surface]
+        self._full_redraw = True
+        self._dirty_tiles = set()  # type: Set[Tuple[int, int]]
+        self._tile_origin = (0, 0)
+        self._tile_step = (0, 0)
         self._tile_size = (0, 0)
+        self._scaled = False
+        self._palette = []  # type: List[Tuple[int, int, int]]
+        self._stroke_tile = None  # type: Optional[Tuple[int, int]]
+        self._stroke_open = False
+
+    def invalidate(self) -> None:
+        """Redraw the whole map on the next render"""
+        self._full_redraw = True
+        self.dirty = True
+
+    @property
+    def tile_size(self) -> 'Tuple[float, float]':
+        """The size in pixels of a tile, as of the last full redraw"""
+        return self._tile_size
+
+    @property
+    def scaled(self) -> bool:
+        """Whether the map has more tiles than pixels and is drawn scaled down"""
+        return self._scaled
+
+    def mark_dirty(self, tiles: 'Iterable[Tuple[int, int]]') -> None:
+        """Repaint the given (x, y) tiles on the next render"""
+        self._dirty_tiles.update(tiles)
+        if len(self._dirty_tiles) > 0:
+            self.dirty = True
 
-    def render(self, screen):
+    def render(self, screen: 'pygame.Surface') -> 'List[Rect]':
         if not self._dirty:
-            return
+            return []
+
+        if self._surface is None or self._surface.get_size() != self.dimensions:
+            self._surface = pygame.Surface(self.dimensions)
+            self._full_redraw = True
 
-        if self.grid:
-            self._render_grid(screen)
+        if self._full_redraw or (self._scaled and len(self._dirty_tiles) > 0):
+            self._layout()
+            self._render_map()
+            screen.blit(self._surface, self.origin)
+            rects = [self.rect]
         else:
-            self._render_nogrid(screen)
+            rects = []
+            for j, i in self._dirty_tiles:
+                tile_rect = self._render_tile(j, i)
+                screen.blit(self._surface, (self.x + tile_rect.x, self.y + tile_rect.y), tile_rect)
+                rects.append(tile_rect.move(self.x, self.y))
+
+        self._full_redraw = False
+        self._dirty_tiles.clear()
         self._dirty = False
+        return rects
 
-    def _render_nogrid(self, screen):
-        self._map_area = self.rect
-        tile_size = self.width / self.map.width
-        self._tile_size = tile_size, tile_size
-        for i in range(self.map.height):
-            for j in range(self.map.width):
-                tile = self.map.tiles[self.map.height * i + j]
-                color = colors.get_tile_color(tile)
-                upper_left = self.x + (self.map.width - j - 1) * tile_size, self.y + i * tile_size
-
-                screen.fill(color, pygame.Rect(upper_left[0], upper_left[1], tile_size, tile_size))
-                if tile["amount"].value > 0 and tile["type"]["value__"].value == 0:
-                        tree_size = int(tile_size / 2.0)
-                        tile_rect = Rect(upper_left[0] + tree_size, upper_left[1] + tree_size, tree_size, tree_size)
-                        screen.fill(colors.Tree, tile_rect)
-
-    def _render_grid(self, screen):
+    def _layout(self) -> None:
         map_width = self.map.width
         map_height = self.map.height
-        grid_pixels = map_width + 1, map_height + 1
+        gap = 1 if self.grid else 0
         tile_size = (
-            int((self.width - grid_pixels[0]) / map_width),
-            int((self.height - grid_pixels[1]) / map_height)
-        )
-        border_width = (
-            (self.width - ((tile_size[0] * map_width) + map_width + 1)) / 2.0,
-            (self.height - ((tile_size[1] * map_height) + map_height + 1)) / 2.0
+            (self.width - gap * (map_width + 1)) // map_width,
+            (self.height - gap * (map_height + 1)) // map_height
         )
+        self._scaled = tile_size[0] < 1 or tile_size[1] < 1
+        if self._scaled:
+            # More tiles than pixels: the map is scaled down to fit, without grid lines
+            self._tile_size = self.width / map_width, self.height / map_height
+            self._tile_step = self._tile_size
+            self._tile_origin = (0, 0)
+            return
 
-        # Draw our borders
-        left = Rect(0, 0, int(math.floor(border_width[0])), self.height)
-        right_width = int(math.ceil(border_width[0]))
-        right = Rect(self.width - right_width, 0, right_width, self.height)
-        top_width = right.left - left.right
-        top = Rect(left.right, 0, top_width, int(math.floor(border_width[1])))
-        bottom_height = int(math.ceil(border_width[1]))
-        bottom = Rect(left.right, self.height - bottom_height, top_width, bottom_height)
-        screen.fill(self.grid_color, left)
-        screen.fill(self.grid_color, right)
-        screen.fill(self.grid_color, top)
-        screen.fill(self.grid_color, bottom)
-
-        self._map_area = Rect(left.right, top.bottom, right.left, bottom.top)
+        used = tile_size[0] * map_width + gap * (map_width + 1), tile_size[1] * map_height + gap * (map_height + 1)
         self._tile_size = tile_size
-        x, y = self._map_area.left, self._map_area.top
-
-        for i in range(map_height):
-            for j in range(map_width):
-                tile = self.map.get_tile(j, i)
-                # tile = self.map.tiles[map_height * i + j]
-                color = colors.get_tile_color(tile)
-                # upper_left = x + (map_width - j - 1) * tile_size[0] + j, y + i * tile_size[1] + i
-                upper_left = x + j * tile_size[0] + j, y + i * tile_size[1] + i
-                tile_rect = Rect(upper_left[0], upper_left[1], tile_size[0], tile_size[1])
-                screen.fill(color, Rect(upper_left[0], upper_left[1], tile_size[0], tile_size[1]))
-                building = self.map.get_object(j, i)
-                if building is not None:
-                    pygame.draw.rect(screen, colors.Magenta, tile_rect, 2)
-                if tile["amount"].value > 0 and tile["type"]["value__"].value == 0:
-                    tree_size = int(tile_size[0] / 2.0)
-                    tile_rect = Rect(upper_left[0] + tree_size/2, upper_left[1] + tree_size/2, tree_size, tree_size)
-                    screen.fill(colors.Tree, tile_rect)
+        self._tile_step = tile_size[0] + gap, tile_size[1] + gap
+        self._tile_origin = (self.width - used[0]) // 2 + gap, (self.height - used[1]) // 2 + gap
+
+    def _render_map(self) -> None:
+        """Draw the whole map into the offscreen surface
+
+        Every pixel is given a palette index in one vectorized pass: pixel
+        rows and columns are mapped to tiles, looked up in the tile color
+        indices, and grid lines and trees are masked in on top. The result
+        is written with a single surfarray blit; only building outlines
+        are drawn one by one.
+        """
+        grid = self.map.grid
+        indices = self.map.color_indices
+        palette = colors.Palette.copy()
+        palette[colors.ColorIndex.Grid] = self.grid_color
+        self._palette = [tuple(color) for color in palette.tolist()]
+
+        if self._scaled:
+            tiles = pygame.surfarray.make_surface(palette[indices.T])
+            pygame.transform.scale(tiles, self.dimensions, self._surface)
+            return
+
+        trees = (grid.type == TileType.Land) & (grid.amount > 0)
+        tree_size = self._tile_size[0] // 2
+        columns, column_inside, column_tree = self._pixel_tiles(self.width, 0, self.map.width, tree_size)
+        rows, row_inside, row_tree = self._pixel_tiles(self.height, 1, self.map.height, tree_size)
+
+        pixels = indices[rows[:, None], columns[None, :]]
+        pixels[trees[rows[:, None], columns[None, :]] & row_tree[:, None] & column_tree[None, :]] = colors.ColorIndex.Tree
+        pixels[~(row_inside[:, None] & column_inside[None, :])] = colors.ColorIndex.Grid
+        pygame.surfarray.blit_array(self._surface, palette[pixels.T])
+
+        for j, i in self.map.object_positions():
+            self._render_building(j, i)
+
+    def _pixel_tiles(self, length: int, axis: int, tiles: int,
+                     tree_size: int) -> 'Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]':
+        """Map each pixel along one axis of the widget to a tile
+
+        :return: The tile index of every pixel, clipped to the map, whether
+                 the pixel lies inside a tile rather than on the grid or
+                 border, and whether it lies inside the tree marker
+        """
+        pixels = numpy.arange(length) - self._tile_origin[axis]
+        tile = pixels // self._tile_step[axis]
+        offset = pixels % self._tile_step[axis]
+        inside = (pixels >= 0) & (tile < tiles) & (offset < self._tile_size[axis])
+        tree = (offset >= tree_size // 2) & (offset < tree_size // 2 + tree_size)
+        return numpy.clip(tile, 0, tiles - 1), inside, tree
+
+    def _tile_rect(self, j: int, i: int) -> Rect:
+        return Rect(self._tile_origin[0] + j * self._tile_step[0], self._tile_origin[1] + i * self._tile_step[1],
+                    self._tile_size[0], self._tile_size[1])
+
+    def _render_building(self, j: int, i: int) -> None:
+        pygame.draw.rect(self._surface, colors.Magenta, self._tile_rect(j, i), 2)
+
+    def _render_tile(self, j: int, i: int) -> Rect:
+        """Draw one tile into the offscreen surface
+
+        :return: The rect of the tile, relative to the widget
+        """
+        tile = self.map.get_tile(j, i)
+        tile_rect = self._tile_rect(j, i)
+        self._surface.fill(self._palette[self.map.color_indices[i, j]], tile_rect)
+        if tile["amount"].value > 0 and tile["type"]["value__"].value == TileType.Land:
+            tree_size = self._tile_size[0] // 2
+            tree_rect = Rect(tile_rect.x + tree_size // 2, tile_rect.y + tree_size // 2, tree_size, tree_size)
+            self._surface.fill(colors.Tree, tree_rect)
+        # Building outlines go over trees, as in _render_map
+        if self.map.get_object(j, i) is not None:
+            self._render_building(j, i)
+        return tile_rect
+
+    def tile_at(self, x: int, y: int) -> 'Optional[Tuple[int, int]]':
+        """The map coordinates of the tile under a screen position, if any"""
+        step_x, step_y = self._tile_step
+        if step_x <= 0 or step_y <= 0:
+            return None
+        tile_x = int(math.floor((x - self.x - self._tile_origin[0]) / step_x))
+        tile_y = int(math.floor((y - self.y - self._tile_origin[1]) / step_y))
+        if 0 <= tile_x < self.map.width and 0 <= tile_y < self.map.height:
+            return tile_x, tile_y
+        return None
 
     def click(self, x: int, y: int) -> None:
-        inside_x = self._map_area.left <= x <= self._map_area.right
-        inside_y = self._map_area.top <= y <= self._map_area.bottom
-        if not (inside_x and inside_y):
+        """Start a brush stroke"""
+        tile = self.tile_at(x, y)
+        self._stroke_tile = tile
+        if tile is None:
             return
 
-        x -= self._map_area.left
-        y -= self._map_area.top
+        if self.map.journal is not None and not self._stroke_open:
+            self.map.journal.begin()
+            self._stroke_open = True
+        self.mark_dirty(self.brush.apply(self.map, tile[0], tile[1]))
 
-        grid_add = 1 if self.grid else 0
-        tile_size = self._tile_size[0] + grid_add, self._tile_size[1] + grid_add
+    def drag(self, x: int, y: int) -> None:
+        """Continue a brush stroke, painting every tile between the last position and this one"""
+        tile = self.tile_at(x, y)
+        if tile is None or self._stroke_tile is None:
+            self.click(x, y)
+            return
+        if tile == self._stroke_tile:
+            return
 
-        # tile_factor = self.map.width / self._map_area.width
-        tile_x = int(math.floor(x / tile_size[0]))
-        tile_y = int(math.floor(y / tile_size[1]))
-        if 0 <= tile_x < self.map.width and 0 <= tile_y < self.map.height:
-            self.brush.apply(self.map, tile_x, tile_y)
-            self._dirty = True
+        self.mark_dirty(self.brush.stroke(self.map, self._stroke_tile, tile))
+        self._stroke_tile = tile
+
+    def release(self) -> None:
+        """End a brush stroke"""
+        self._stroke_tile = None
+        if self._stroke_open:
+            self.map.journal.end()
+            self._stroke_open = False
@@ -0,0 +1,125 @@
+import hashlib
+import struct
+
+import numpy
+
+import typing
+if typing.TYPE_CHECKING:
+    from typing import Any, List, Optional, Tuple
+
+
+PATCH_MAGIC = b"KACPATCH"
+PATCH_VERSION = 1
+
+# magic, version, size of the save the patch applies to, its SHA-256, number of ranges
+_HEADER = struct.Struct("<8sBQ32sI")
+# offset, length; followed by length bytes of data
+_RANGE = struct.Struct("<QI")
+
+# Changed ranges closer than this are merged, since a range header costs 12 bytes
+_MERGE_GAP = 12
+
+
+def diff_ranges(original: 'Any', data: 'Any', merge_gap: int=_MERGE_GAP) -> 'List[Tuple[int, int]]':
+    """Find the byte ranges where two saves of the same size differ
+
+    :param original: The save as it was parsed
+    :param data: The edited save
+    :param merge_gap: Ranges separated by fewer unchanged bytes than this are merged
+    :return: Sorted (offset, length) pairs
+    """
+    if len(original) != len(data):
+        raise ValueError("Saves differ in size: {} and {} bytes".format(len(original), len(data)))
+    changed = numpy.flatnonzero(numpy.frombuffer(original, dtype=numpy.uint8) !=
+                                numpy.frombuffer(data, dtype=numpy.uint8))
+    if changed.size == 0:
+        return []
+    breaks = numpy.flatnonzero(numpy.diff(changed) > merge_gap)
+    starts = numpy.concatenate(([changed[0]], changed[breaks + 1]))
+    ends = numpy.concatenate((changed[breaks], [changed[-1]])) + 1
+    return [(int(start), int(end - start)) for start, end in zip(starts, ends)]
+
+
+def make_patch(original: 'Any', data: 'Any') -> bytes:
+    """Encode the changes from original to data as a patch"""
+    ranges = diff_ranges(original, data)
+    view = memoryview(data)
+    parts = [_HEADER.pack(PATCH_MAGIC, PATCH_VERSION, len(original), hashlib.sha256(original).digest(), len(ranges))]
+    for offset, length in ranges:
+        parts.append(_RANGE.pack(offset, length))
+        parts.append(view[offset:offset + length].tobytes())
+    return b"".join(parts)
+
+
+def read_patch(patch: bytes) -> 'Tuple[int, bytes, List[Tuple[int, bytes]]]':
+    """Decode a patch
+
+    :return: The size and SHA-256 of the save it applies to, and its (offset, data) ranges
+    """
+    if len(patch) < _HEADER.size:
+        raise ValueError("Patch is truncated")
+    magic, version, size, digest, count = _HEADER.unpack_from(patch, 0)
+    if magic != PATCH_MAGIC:
+        raise ValueError("Not a save patch")
+    if version != PATCH_VERSION:
+        raise ValueError("Unsupported patch version {}".format(version))
+
+    ranges = []
+    position = _HEADER.size
+    for _ in range(count):
+        if position + _RANGE.size > len(patch):
+            raise ValueError("Patch is truncated")
+        offset, length = _RANGE.unpack_from(patch, position)
+        position += _RANGE.size
+        if position + length > len(patch) or offset + length > size:
+            raise ValueError("Patch is truncated or corrupt")
+        ranges.append((offset, patch[position:position + length]))
+        position += length
+    return size, digest, ranges
+
+
+def apply_patch(data: bytearray, patch: bytes, verify: bool=True) -> int:
+    """Apply a patch to a save in place
+
+    :param data: The save to patch
+    :param patch: The encoded patch
+    :param verify: Refuse saves other than the exact one the patch was made from;
+                   otherwise only the size has to match
+    :return: The number of bytes written
+    """
+    size, digest, ranges = read_patch(patch)
+    if len(data) != size:
+        raise ValueError("Patch is for a save of {} bytes, not {}".format(size, len(data)))
+    if verify and hashlib.sha256(data).digest() != digest:
+        raise ValueError("Patch was made from a different save")
+    written = 0
+    for offset, values in ranges:
+        data[offset:offset + len(values)] = values
+        written += len(values)
+    return written
+
+
+def write_patch(patch_file: str, original: 'Any', data: 'Any') -> int:
+    """Write the changes from original to data to a patch file
+
+    :return: The size of the patch in bytes
+    """
+    patch = make_patch(original, data)
+    with open(patch_file, mode="wb") as new_file:
+        new_file.write(patch)
+    return len(patch)
+
+
+def apply_patch_file(patch_file: str, save_file: str, output_file: 'Optional[str]'=None, verify: bool=True) -> int:
+    """Apply a patch file to a save file, writing the result to output_file or back to the save
+
+    :return: The number of bytes written
+    """
+    with open(patch_file, mode="rb") as file:
+        patch = file.read()
+    with open(save_file, mode="rb") as file:
+        data = bytearray(file.read())
+    written = apply_patch(data, patch, verify)
+    with open(output_file or save_file, mode="wb") as new_file:
+        new_file.write(data)
+    return written
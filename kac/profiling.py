@@ -0,0 +1,105 @@
+import contextlib
+import cProfile
+import io
+import os
+import pstats
+import time
+import tracemalloc
+
+import typing
+if typing.TYPE_CHECKING:
+    from typing import Dict, Iterator, List, Optional
+
+
+class PhaseStats(object):
+    """Everything measured for one phase, over every time it ran"""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.profile = cProfile.Profile()
+        self.calls = 0
+        self.seconds = 0.0
+        # Net bytes allocated, and the most allocated at once above what was allocated before the phase
+        self.allocated = 0
+        self.peak = 0
+        self.allocations = None  # type: Optional[List[tracemalloc.StatisticDiff]]
+
+
+class PhaseProfiler(object):
+    """Profiles the phases of a run with cProfile and tracemalloc
+
+    Each phase has a profile of its own, enabled only while the phase
+    runs, so a phase that runs many times, such as drawing a frame, adds
+    up to one profile. Memory is traced from the start of the first
+    phase. Allocations are compared line by line only around the first
+    run of each phase, as taking a snapshot is slow; later runs only add
+    to the totals. Phases must not nest.
+
+    write saves a <phase>.pstats file per phase, to be read with pstats
+    or a viewer such as snakeviz, and a summary.txt of the time,
+    allocations and slowest functions of every phase.
+    """
+
+    def __init__(self, output_dir: str, top: int=20) -> None:
+        self.output_dir = output_dir
+        self.top = top
+        self.phases = {}  # type: Dict[str, PhaseStats]
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> 'Iterator[None]':
+        stats = self.phases.get(name)
+        if stats is None:
+            stats = self.phases[name] = PhaseStats(name)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        before = _snapshot() if stats.allocations is None else None
+        traced = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        start_time = time.perf_counter()
+        stats.profile.enable()
+        try:
+            yield
+        finally:
+            stats.profile.disable()
+            stats.seconds += time.perf_counter() - start_time
+            stats.calls += 1
+            current, peak = tracemalloc.get_traced_memory()
+            stats.allocated += current - traced
+            stats.peak = max(stats.peak, peak - traced)
+            if before is not None:
+                stats.allocations = _snapshot().compare_to(before, "lineno")[:self.top]
+
+    def summary(self) -> str:
+        lines = []
+        for stats in self.phases.values():
+            lines.append("==== {} ====".format(stats.name))
+            lines.append("{} runs, {:.4f} seconds, {:.1f} KiB allocated, {:.1f} KiB peak".format(
+                stats.calls, stats.seconds, stats.allocated / 1024.0, stats.peak / 1024.0))
+            lines.append("Top allocations of the first run:")
+            lines.extend("  {}".format(allocation) for allocation in stats.allocations or [])
+            stream = io.StringIO()
+            pstats.Stats(stats.profile, stream=stream).sort_stats("cumulative").print_stats(self.top)
+            lines.append("Top functions by cumulative time:")
+            lines.append(stream.getvalue().strip())
+            lines.append("")
+        return "\n".join(lines)
+
+    def write(self) -> str:
+        """Write the profiles and the summary, and stop tracing memory
+
+        :return: The path of the summary
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        for stats in self.phases.values():
+            stats.profile.dump_stats(os.path.join(self.output_dir, stats.name + ".pstats"))
+        summary_file = os.path.join(self.output_dir, "summary.txt")
+        with open(summary_file, mode="w") as new_file:
+            new_file.write(self.summary())
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        return summary_file
+
+
+def _snapshot() -> tracemalloc.Snapshot:
+    # Leave out what tracemalloc allocates for the snapshots themselves
+    return tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__), ))
@@ -0,0 +1,105 @@
+import array
+from enum import IntEnum, unique
+import struct
+import sys
+
+import typing
+if typing.TYPE_CHECKING:
+    from typing import Any, BinaryIO, Tuple
+
+
+@unique
+class ReaderMode(IntEnum):
+    Buffer = 0
+    File = 1
+
+
+class BufferReader(object):
+    """Reads a save from a single in-memory buffer
+
+    Values are decoded with struct.unpack_from at an integer cursor, so
+    reading a field never copies bytes out of the buffer. Any object
+    supporting the buffer protocol works, including bytearray and mmap.
+    """
+
+    def __init__(self, buffer: 'Any', position: int=0) -> None:
+        self._view = memoryview(buffer)
+        self.position = position
+        self.data = buffer
+
+    def read(self, size: int) -> bytes:
+        position = self.position
+        self.position = position + size
+        return self._view[position:position + size].tobytes()
+
+    def read_byte(self) -> int:
+        position = self.position
+        self.position = position + 1
+        return self._view[position]
+
+    def read_string(self, size: int) -> str:
+        position = self.position
+        self.position = position + size
+        return str(self._view[position:position + size], 'utf-8')
+
+    def unpack(self, fmt: struct.Struct) -> 'Tuple':
+        position = self.position
+        self.position = position + fmt.size
+        return fmt.unpack_from(self._view, position)
+
+    def read_array(self, typecode: str, length: int) -> 'array.array':
+        values = array.array(typecode)
+        position = self.position
+        self.position = position + values.itemsize * length
+        values.frombytes(self._view[position:self.position])
+        if sys.byteorder == "big":
+            values.byteswap()
+        return values
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, position: int) -> None:
+        self.position = position
+
+    def close(self) -> None:
+        self._view.release()
+
+
+class FileReader(object):
+    """Reads a save from a file object, one field at a time
+
+    data is the in-memory copy of the save that edits are made to, if any.
+    """
+
+    def __init__(self, file: 'BinaryIO', data: 'Any'=None) -> None:
+        self._file = file
+        self.data = data
+
+    def read(self, size: int) -> bytes:
+        return self._file.read(size)
+
+    def read_byte(self) -> int:
+        return self._file.read(1)[0]
+
+    def read_string(self, size: int) -> str:
+        return self._file.read(size).decode('utf-8')
+
+    def unpack(self, fmt: struct.Struct) -> 'Tuple':
+        return fmt.unpack(self._file.read(fmt.size))
+
+    def read_array(self, typecode: str, length: int) -> 'array.array':
+        values = array.array(typecode)
+        values.frombytes(self._file.read(values.itemsize * length))
+        if sys.byteorder == "big":
+            values.byteswap()
+        return values
+
+    def tell(self) -> int:
+        return self._file.tell()
+
+    def seek(self, position: int) -> None:
+        self._file.seek(position)
+
+    def close(self) -> None:
+        pass
@@ -0,0 +1,127 @@
+import contextlib
+import io
+import struct
+
+from kac.datatypes import BinaryType, RecordType
+from kac.extractor import parse_save_file
+
+import typing
+if typing.TYPE_CHECKING:
+    from typing import List
+
+
+SYNTHETIC_ID_BASE = 1 << 24
+
+CellClassName = "Cell+CellSaveData"
+WorldClassName = "World+WorldSaveData"
+
+# Size of a Cell+CellSaveData ClassWithId record whose ResourceType member
+# is itself a ClassWithId record, and of the trailing value bytes copied
+# between cells (value__, amount, fertile, saltWater, deepWater)
+_CELL_RECORD_SIZE = 32
+_CELL_PAYLOAD_SIZE = 14
+
+
+def _length_prefixed(value: str) -> bytes:
+    encoded = value.encode('utf-8')
+    if len(encoded) >= 128:
+        raise ValueError("Class name {} is too long".format(value))
+    return bytes((len(encoded), )) + encoded
+
+
+def generate_save(source_file: str, scale: int) -> bytearray:
+    """Build a larger, valid save by tiling the map of an existing save
+
+    The grid of the source save is repeated scale times along each axis,
+    so the generated save has scale**2 times as many cells. Every new
+    cell gets a fresh object id and a matching MemberReference in the
+    cell array, and the world dimensions are updated to match.
+
+    :param source_file: The save to use as a template
+    :param scale: How many times to repeat the map along each axis
+    :return: The bytes of the generated save
+    """
+    if scale < 1:
+        raise ValueError("Scale must be at least 1, got {}".format(scale))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        objects, data = parse_save_file(source_file)
+
+    world = objects[WorldClassName]
+    width_field, height_field = world["gridWidth"], world["gridHeight"]
+    width, height = width_field.value, height_field.value
+    cells = objects[CellClassName].class_base.instances
+    count = len(cells)
+    if count != width * height:
+        raise ValueError("Expected {} cells, found {}".format(width * height, count))
+
+    # Locate the BinaryArray holding references to every cell
+    type_pattern = bytes((BinaryType.Class, )) + _length_prefixed(CellClassName)
+    type_pos = data.find(type_pattern)
+    array_start = type_pos - 14
+    if type_pos < 0 or data[array_start] != RecordType.BinaryArray:
+        raise ValueError("Unable to find the {} array".format(CellClassName))
+    length_pos = type_pos - 4
+    if struct.unpack_from("<i", data, length_pos)[0] != count:
+        raise ValueError("Cell array length does not match the cell count")
+    refs_start = type_pos + len(type_pattern) + 4
+    refs_end = refs_start + 5 * count
+    cell_ids = [struct.unpack_from("<i", data, refs_start + 5 * i + 1)[0] for i in range(count)]
+
+    # Locate the cell records themselves; the first record also defines the class
+    cells_start = data.find(_length_prefixed(CellClassName) + struct.pack("<i", 5)) - 5
+    if cells_start < 0 or data[cells_start] != RecordType.ClassWithMembersAndTypes:
+        raise ValueError("Unable to find the {} records".format(CellClassName))
+    first_end = cells[0]["deepWater"].position + 1
+    cells_end = cells[-1]["deepWater"].position + 1
+    if cells_end - first_end != _CELL_RECORD_SIZE * (count - 1):
+        raise ValueError("Cell records do not have the expected layout")
+
+    cell_class_id = struct.unpack_from("<i", data, cells_start + 1)[0]
+    resource_class_id = struct.unpack_from("<i", data, first_end + 14)[0]
+    if max(width_field.position, height_field.position) >= length_pos:
+        raise ValueError("World dimensions are expected before the cell array")
+    if max(cell_ids) >= SYNTHETIC_ID_BASE:
+        raise ValueError("Source save uses object ids beyond {}".format(SYNTHETIC_ID_BASE))
+
+    payloads = [bytes(data[first_end - _CELL_PAYLOAD_SIZE:first_end])]  # type: List[bytes]
+    resource_ids = [0]
+    for i in range(1, count):
+        record_end = first_end + _CELL_RECORD_SIZE * i
+        payloads.append(bytes(data[record_end - _CELL_PAYLOAD_SIZE:record_end]))
+        resource_ids.append(struct.unpack_from("<i", data, record_end - _CELL_RECORD_SIZE + 10)[0])
+
+    new_width, new_height = width * scale, height * scale
+    new_count = new_width * new_height
+    record_struct = struct.Struct("<BiiBii")
+    refs = bytearray()
+    records = bytearray(data[cells_start:first_end])
+    refs += struct.pack("<Bi", RecordType.MemberReference, cell_ids[0])
+    for i in range(1, new_count):
+        if i < count:
+            cell_id, resource_id = cell_ids[i], resource_ids[i]
+        else:
+            cell_id = SYNTHETIC_ID_BASE + 2 * (i - count)
+            resource_id = cell_id + 1
+        source = ((i // new_width) % height) * width + (i % new_width) % width
+        refs += struct.pack("<Bi", RecordType.MemberReference, cell_id)
+        records += record_struct.pack(RecordType.ClassWithId, cell_id, cell_class_id,
+                                      RecordType.ClassWithId, resource_id, resource_class_id)
+        records += payloads[source]
+
+    output = bytearray(data[:refs_start])
+    struct.pack_into("<i", output, length_pos, new_count)
+    struct.pack_into("<i", output, width_field.position, new_width)
+    struct.pack_into("<i", output, height_field.position, new_height)
+    output += refs
+    output += data[refs_end:cells_start]
+    output += records
+    output += data[cells_end:]
+    return output
+
+
+def write_synthetic_save(source_file: str, scale: int, output_file: str) -> int:
+    data = generate_save(source_file, scale)
+    with open(output_file, mode="wb") as new_file:
+        new_file.write(data)
+    return len(data)
@@ -0,0 +1,133 @@
+import gc
+import json
+import time
+
+from kac.datatypes import RecordType
+
+import typing
+if typing.TYPE_CHECKING:
+    from typing import Any, Dict, List, Optional
+
+
+class RecordStats(object):
+    """Totals for one kind of record"""
+
+    __slots__ = ("count", "bytes", "seconds", "objects")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.objects = 0
+
+    def add(self, size: int, seconds: float, objects: int) -> None:
+        self.count += 1
+        self.bytes += size
+        self.seconds += seconds
+        self.objects += objects
+
+    def to_dict(self) -> 'Dict[str, Any]':
+        return {"count": self.count, "bytes": self.bytes, "seconds": self.seconds, "objects": self.objects}
+
+
+class ParseTelemetry(object):
+    """Where the time of parsing saves goes, by record type and by class
+
+    Pass one to parse_save_file or parse_save_buffer and every record read
+    is measured: how many there were, the bytes they take in the save,
+    the time spent decoding them, and the objects allocated meanwhile, as
+    the net change in objects tracked by the garbage collector.
+
+    Records nest, a class instance containing the records of its members,
+    so the bytes, time and objects of a record exclude those of the
+    records inside it, and the totals over all records add up to the
+    whole parse. Class records are also totalled by class name. One
+    telemetry may be passed to several parses to total them all.
+    """
+
+    def __init__(self) -> None:
+        self.saves = 0
+        self.record_types = {}  # type: Dict[int, RecordStats]
+        self.classes = {}  # type: Dict[str, RecordStats]
+        # Per record being read: start position, start time, start object count, and the
+        # bytes, seconds and objects of the records nested in it so far
+        self._stack = []  # type: List[List[Any]]
+
+    def begin(self, position: int) -> None:
+        self._stack.append([position, time.perf_counter(), gc.get_count()[0], 0, 0.0, 0])
+
+    def end(self, record_type: int, position: int, class_name: 'Optional[str]') -> None:
+        """Account for the record begun last, which ended at position"""
+        start, start_time, start_objects, nested_bytes, nested_seconds, nested_objects = self._stack.pop()
+        seconds = time.perf_counter() - start_time
+        size = position - start
+        objects = gc.get_count()[0] - start_objects
+        if len(self._stack) > 0:
+            parent = self._stack[-1]
+            parent[3] += size
+            parent[4] += seconds
+            parent[5] += objects
+        size -= nested_bytes
+        seconds -= nested_seconds
+        objects -= nested_objects
+
+        stats = self.record_types.get(record_type)
+        if stats is None:
+            stats = self.record_types[record_type] = RecordStats()
+        stats.add(size, seconds, objects)
+        if class_name is not None:
+            stats = self.classes.get(class_name)
+            if stats is None:
+                stats = self.classes[class_name] = RecordStats()
+            stats.add(size, seconds, objects)
+
+    def total(self) -> RecordStats:
+        total = RecordStats()
+        for stats in self.record_types.values():
+            total.count += stats.count
+            total.bytes += stats.bytes
+            total.seconds += stats.seconds
+            total.objects += stats.objects
+        return total
+
+    def report(self) -> 'Dict[str, Any]':
+        """The totals as plain data, record types and classes sorted by time, slowest first"""
+        record_types = sorted(self.record_types.items(), key=lambda item: item[1].seconds, reverse=True)
+        classes = sorted(self.classes.items(), key=lambda item: item[1].seconds, reverse=True)
+        return {
+            "saves": self.saves,
+            "total": self.total().to_dict(),
+            "record_types": [dict(record_type=_record_type_name(record_type), **stats.to_dict())
+                             for record_type, stats in record_types],
+            "classes": [dict(class_name=name, **stats.to_dict()) for name, stats in classes],
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.report(), indent=2)
+
+    def format_table(self, limit: 'Optional[int]'=None) -> str:
+        """The report as text tables
+
+        :param limit: Show at most this many classes
+        """
+        report = self.report()
+        total = report["total"]
+        lines = ["{} records in {} saves: {} bytes, {:.4f} seconds, {} objects".format(
+            total["count"], report["saves"], total["bytes"], total["seconds"], total["objects"])]
+        for title, key, rows in (("record type", "record_type", report["record_types"]),
+                                 ("class", "class_name", report["classes"][:limit])):
+            lines.append("")
+            lines.append("{:<40} {:>9} {:>10} {:>10} {:>6} {:>10}".format(
+                title, "count", "bytes", "seconds", "time", "objects"))
+            for row in rows:
+                share = row["seconds"] / total["seconds"] * 100.0 if total["seconds"] > 0 else 0.0
+                lines.append("{:<40} {:>9} {:>10} {:>10.4f} {:>5.1f}% {:>10}".format(
+                    row[key][:40], row["count"], row["bytes"], row["seconds"], share, row["objects"]))
+        return "\n".join(lines)
+
+
+def _record_type_name(record_type: int) -> str:
+    try:
+        return RecordType(record_type).name
+    except ValueError:
+        return str(record_type)
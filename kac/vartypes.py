@@ -1,31 +1,196 @@
 import struct
 
+import numpy
 
-class MSBoolean(object):
-    def __init__(self, value, position):
-        self.value = value
-        self.position = position
+import typing
+if typing.TYPE_CHECKING:
+    from typing import Any, Optional
+    from kac.journal import Journal
 
-    def __repr__(self):
-        return "<boolean pos=" + str(self.position) + ", value=" + str(self.value) + ">"
 
-    def update(self, data_array, value):
-        data_array[self.position] = 0 if value is False else 1
-        self.value = value
+class MSField(object):
+    """A fixed-width primitive field of a save
+
+    Each subclass is one primitive type, with the little-endian struct
+    the save stores it in and the matching NumPy dtype. When data is the
+    save buffer, value is read from it, and update writes straight into
+    it with struct.pack_into. update_many and read_many do the same for
+    many fields of one type at once, given arrays of their offsets.
+    """
 
+    __slots__ = ("_value", "position", "data")
 
-class MSInteger32(object):
-    def __init__(self, value, position):
-        self.value = value
+    fmt = None  # type: struct.Struct
+    dtype = None  # type: numpy.dtype
+    name = "field"
+
+    def __init__(self, value, position, data=None):
+        self._value = value
         self.position = position
+        self.data = data
+
+    @property
+    def value(self):
+        """The current value, read from the save buffer when one is attached"""
+        if self.data is None:
+            return self._value
+        return self.decode(self.fmt.unpack_from(self.data, self.position)[0])
 
     def __repr__(self):
-        return "<integer32 pos=" + str(self.position) + ", value=" + str(self.value) + ">"
-
-    def update(self, data_array, value):
-        v = struct.pack(">I", value)
-        data_array[self.position] = v[0]
-        data_array[self.position] = v[1]
-        data_array[self.position] = v[2]
-        data_array[self.position] = v[3]
-        self.value = value
+        return "<" + self.name + " pos=" + str(self.position) + ", value=" + str(self.value) + ">"
+
+    def update(self, data_array: bytearray, value: 'Any', journal: 'Optional[Journal]'=None) -> None:
+        """Write value to the field in data_array
+
+        :param journal: Records the bytes changed, for undo
+        """
+        if journal is None:
+            self.fmt.pack_into(data_array, self.position, self.encode(value))
+        else:
+            end = self.position + self.fmt.size
+            old = bytes(data_array[self.position:end])
+            self.fmt.pack_into(data_array, self.position, self.encode(value))
+            journal.record(self.position, old, data_array[self.position:end])
+        self._value = value
+
+    @classmethod
+    def decode(cls, raw: 'Any') -> 'Any':
+        return raw
+
+    @classmethod
+    def encode(cls, value: 'Any') -> 'Any':
+        return value
+
+    @classmethod
+    def read_many(cls, data: 'Any', offsets: 'Any') -> numpy.ndarray:
+        """The values of the fields of this type at offsets, as an array of the same shape"""
+        offsets = numpy.asarray(offsets, dtype=numpy.intp)
+        buffer = numpy.frombuffer(data, dtype=numpy.uint8)
+        raw = buffer[offsets.reshape(-1, 1) + numpy.arange(cls.fmt.size)]
+        return cls.decode_many(raw.view(cls.dtype).reshape(offsets.shape))
+
+    @classmethod
+    def update_many(cls, data_array: bytearray, offsets: 'Any', values: 'Any',
+                    journal: 'Optional[Journal]'=None) -> int:
+        """Write values to the fields of this type at offsets
+
+        :param offsets: The offsets of the fields in data_array, as an array of any shape
+        :param values: A scalar, or an array broadcastable to offsets
+        :param journal: Records the bytes changed, for undo
+        :return: The number of fields written
+        """
+        offsets = numpy.asarray(offsets, dtype=numpy.intp)
+        encoded = numpy.broadcast_to(cls.encode_many(values), offsets.shape)
+        new = numpy.ascontiguousarray(encoded, dtype=cls.dtype).view(numpy.uint8).ravel()
+        positions = (offsets.reshape(-1, 1) + numpy.arange(cls.fmt.size)).ravel()
+        buffer = numpy.frombuffer(data_array, dtype=numpy.uint8)
+        if journal is not None:
+            journal.record_bytes(positions, buffer[positions], new)
+        buffer[positions] = new
+        return offsets.size
+
+    @classmethod
+    def decode_many(cls, raw: numpy.ndarray) -> numpy.ndarray:
+        return raw
+
+    @classmethod
+    def encode_many(cls, values: 'Any') -> numpy.ndarray:
+        return numpy.asarray(values).astype(cls.dtype)
+
+
+class MSBoolean(MSField):
+    __slots__ = ()
+    fmt = struct.Struct("<B")
+    dtype = numpy.dtype(numpy.uint8)
+    name = "boolean"
+
+    @classmethod
+    def decode(cls, raw):
+        return raw != 0
+
+    @classmethod
+    def encode(cls, value):
+        return 1 if value else 0
+
+    @classmethod
+    def decode_many(cls, raw):
+        return raw != 0
+
+    @classmethod
+    def encode_many(cls, values):
+        return (numpy.asarray(values) != 0).astype(cls.dtype)
+
+
+class MSByte(MSField):
+    __slots__ = ()
+    fmt = struct.Struct("<B")
+    dtype = numpy.dtype(numpy.uint8)
+    name = "byte"
+
+
+class MSSignedByte(MSField):
+    __slots__ = ()
+    fmt = struct.Struct("<b")
+    dtype = numpy.dtype(numpy.int8)
+    name = "sbyte"
+
+
+class MSInteger16(MSField):
+    __slots__ = ()
+    fmt = struct.Struct("<h")
+    dtype = numpy.dtype("<i2")
+    name = "integer16"
+
+
+class MSInteger32(MSField):
+    __slots__ = ()
+    fmt = struct.Struct("<i")
+    dtype = numpy.dtype("<i4")
+    name = "integer32"
+
+
+class MSInteger64(MSField):
+    __slots__ = ()
+    fmt = struct.Struct("<q")
+    dtype = numpy.dtype("<i8")
+    name = "integer64"
+
+
+class MSUnsignedInteger16(MSField):
+    __slots__ = ()
+    fmt = struct.Struct("<H")
+    dtype = numpy.dtype("<u2")
+    name = "uinteger16"
+
+
+class MSUnsignedInteger32(MSField):
+    __slots__ = ()
+    fmt = struct.Struct("<I")
+    dtype = numpy.dtype("<u4")
+    name = "uinteger32"
+
+
+class MSUnsignedInteger64(MSField):
+    __slots__ = ()
+    fmt = struct.Struct("<Q")
+    dtype = numpy.dtype("<u8")
+    name = "uinteger64"
+
+
+class MSSingle(MSField):
+    __slots__ = ()
+    fmt = struct.Struct("<f")
+    dtype = numpy.dtype("<f4")
+    name = "single"
+
+
+class MSDouble(MSField):
+    __slots__ = ()
+    fmt = struct.Struct("<d")
+    dtype = numpy.dtype("<f8")
+    name = "double"
+
+
+# Every field type, in a fixed order that may be used to refer to them by number
+FIELD_TYPES = (MSBoolean, MSByte, MSSignedByte, MSInteger16, MSInteger32, MSInteger64, MSUnsignedInteger16,
+               MSUnsignedInteger32, MSUnsignedInteger64, MSSingle, MSDouble)
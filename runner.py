@@ -1,18 +1,29 @@
 #!/usr/bin/python3
 
 import argparse
+import contextlib
+import io
 import os
 import pygame
-import shutil
+import sys
+import tempfile
 import time
 
+from kac import batch
+from kac.backup import DEFAULT_STORE, BackupStore, backup_save
+from kac.cache import DEFAULT_CACHE, DEFAULT_CACHE_LIMIT, ParseCache
 from kac.brush import BrushTile
 from kac.extractor import parse_save_file, write_save_file
 from kac.map import KacMap, MapWidget
 from kac.gui import Container, Label, PushButton
+from kac.journal import Journal
+from kac.patch import write_patch
+from kac.profiling import PhaseProfiler
+from kac.telemetry import ParseTelemetry
 
 import typing
 if typing.TYPE_CHECKING:
+    from typing import ContextManager, Optional
     from kac.gui import Widget
 
 
@@ -26,20 +37,91 @@ class Application(object):
         self.parser.add_argument("--gui", "-g", help="Launches the GUI", action="store_true")
         self.parser.add_argument("--dim", "-d", help="The height of the window")
         self.parser.add_argument("--origin", "-o", help="The windows top-left corner")
+        self.parser.add_argument("--fps", type=int, default=60,
+                                 help="The most frames per second to draw while painting; 0 for no limit")
+        self.parser.add_argument("--patch", help="Also write the changes made as a patch to this file on exit")
+        self.parser.add_argument("--patch-only", action="store_true",
+                                 help="Write only the --patch file on exit and leave the save untouched")
+        self.parser.add_argument("--backup-store", default=DEFAULT_STORE,
+                                 help="The directory saves are backed up to before they are edited")
+        self.parser.add_argument("--cache-dir", default=DEFAULT_CACHE,
+                                 help="The directory parsed saves are cached in, so reopening them is faster")
+        self.parser.add_argument("--no-cache", action="store_true", help="Always parse saves from scratch")
+        self.parser.add_argument("--max-cache-size", type=int, default=DEFAULT_CACHE_LIMIT // (1024 * 1024),
+                                 help="The most space in MiB the parse cache may take; the least recently used "
+                                      "saves are dropped from it beyond that")
+        self.parser.add_argument("--undo-budget", type=int, default=64,
+                                 help="The most memory in MiB to keep undo history in")
+        self.parser.add_argument("--profile", help="Profile loading, drawing and saving into this directory: a "
+                                                   "pstats file per phase and a summary.txt of the slowest "
+                                                   "functions and largest allocations")
+        self.parser.add_argument("--headless", action="store_true",
+                                 help="Load the save, draw one frame offscreen and write it to a temporary file, "
+                                      "without a window, for profiling from scripts and batch jobs. The save is "
+                                      "always parsed from scratch, and it, its backups and the parse cache are "
+                                      "left untouched")
+        commands = self.parser.add_subparsers(dest="command")
+        batch_parser = commands.add_parser("batch", help="Edit many saves without the GUI")
+        batch_parser.add_argument("inputs", nargs="+", help="Save files, directories or glob patterns")
+        batch_parser.add_argument("--op", "-p", dest="operations", action="append", default=[],
+                                  help="An operation to apply, in order: fertilize, clear, salt-water, "
+                                       "strip-trees, replace:<type>:<type> or brush:<tile>:<x>,<y>[:<size>]. "
+                                       "Append @rect:x,y,w,h or @poly:x,y;x,y;... to limit it to a region")
+        batch_parser.add_argument("--workers", "-j", type=int, help="Number of worker processes")
+        batch_parser.add_argument("--output", "-O", help="Write edited saves to this directory instead of in place")
+        batch_parser.add_argument("--no-backup", action="store_true", help="Do not back up saves edited in place")
+        batch_parser.add_argument("--cache", action="store_true",
+                                  help="Use the parse cache; worth it when the same saves are edited repeatedly")
+        batch_parser.add_argument("--patch", action="store_true",
+                                  help="Write a <save>.kacpatch of the changes instead of the edited save")
+        backup_parser = commands.add_parser("backup", help="Manage the backups of edited saves")
+        backup_commands = backup_parser.add_subparsers(dest="backup_command")
+        backup_list = backup_commands.add_parser("list", help="List backups, oldest first")
+        backup_list.add_argument("save", nargs="?", help="Only list the backups of this save")
+        backup_restore = backup_commands.add_parser("restore", help="Restore a backup")
+        backup_restore.add_argument("id", help="The backup to restore, as shown by list")
+        backup_restore.add_argument("--output", "-O", help="Where to write it; by default over the save it came from")
+        backup_prune = backup_commands.add_parser("prune", help="Delete old backups")
+        backup_prune.add_argument("--keep", "-k", type=int, default=10, help="Backups to keep per save")
+        backup_prune.add_argument("save", nargs="?", help="Only prune the backups of this save")
+        backup_commands.add_parser("stats", help="Show how much space the backups take")
+        cache_parser = commands.add_parser("cache", help="Manage the cache of parsed saves")
+        cache_commands = cache_parser.add_subparsers(dest="cache_command")
+        cache_prune = cache_commands.add_parser("prune", help="Drop the least recently used saves from the cache")
+        cache_prune.add_argument("--max-size", type=int, default=0,
+                                 help="The most space in MiB to leave the cache taking; 0 empties it")
+        cache_commands.add_parser("stats", help="Show how much space the cache takes")
+        patch_parser = commands.add_parser("apply-patch", help="Apply a patch file to saves without parsing them")
+        patch_parser.add_argument("patch", help="The patch file, as written by --patch")
+        patch_parser.add_argument("inputs", nargs="+", help="Save files, directories or glob patterns")
+        patch_parser.add_argument("--output", "-O", help="Write patched saves to this directory instead of in place")
+        patch_parser.add_argument("--no-backup", action="store_true", help="Do not back up saves patched in place")
+        patch_parser.add_argument("--force", action="store_true",
+                                  help="Apply to any save of the right size, not only the one the patch was made from")
+        stats_parser = commands.add_parser("parse-stats", help="Show which records and classes parsing saves "
+                                                               "spends its time on")
+        stats_parser.add_argument("inputs", nargs="+", help="Save files, directories or glob patterns")
+        stats_parser.add_argument("--json", help="Also write the report as JSON to this file")
+        stats_parser.add_argument("--classes", type=int, default=20, help="The most classes to list")
+        self.args = None
         self.height = 640
         self._run_gui = True
         self.save_file = None
         self.objects = None
         self.data = None
+        self.original = None
+        self.cache = None
         self.screen = None
         self.small_font = None
         self.font = None
         self._last_widget = None
         self._brush_size_label = None
+        self.profiler = None  # type: Optional[PhaseProfiler]
 
     def parse_args(self) -> None:
         print("Application::parse_args()")
         args = self.parser.parse_args()
+        self.args = args
         self.save_file = args.input
         if args.dim is not None:
             try:
@@ -104,6 +186,7 @@ class Application(object):
         gui.add(PushButton(x + 94, y + 452, "+", self.small_font, width=14, action=self.action_brush_inc))
         gui.add(PushButton(x + 110, y + 452, '-', self.small_font, width=14, action=self.action_brush_dec))
 
+        gui.add(Label(x + 2, self.height - 60, "Ctrl+Z to undo, Ctrl+Y to redo", self.small_font))
         gui.add(Label(x + 2, self.height - 40, "Press F to turn all land fertile+", self.small_font))
         gui.add(Label(x + 2, self.height - 20, "Press C to clear the map", self.small_font))
 
@@ -113,15 +196,157 @@ class Application(object):
             print("No Save file chosen; using test data")
             self.save_file = "./test/world"
 
-        backup_file = self.save_file + "-" + time.strftime("%Y%m%d%H%M%S")
-        print("Making a backup copy of {} at {}".format(self.save_file, backup_file))
-        shutil.copyfile(self.save_file, backup_file)
-        self.objects, self.data = parse_save_file(backup_file)
-        self.map = KacMap(self.objects, self.data)
+        if self.args.patch_only:
+            if self.args.patch is None:
+                print("--patch-only needs a --patch file")
+                return False
+        elif not self.args.headless:
+            manifest = backup_save(self.save_file, self.args.backup_store)
+            print("Backed up {} as {} in {}".format(self.save_file, manifest["id"], self.args.backup_store))
+        with self.phase("parse_save"):
+            # Headless runs profile a real parse, so they bypass the cache like they do the backups
+            if self.args.no_cache or self.args.headless:
+                self.objects, self.data = parse_save_file(self.save_file)
+            else:
+                self.cache = ParseCache(self.args.cache_dir, self.args.max_cache_size * 1024 * 1024)
+                self.objects, self.data = self.cache.parse_file(self.save_file)
+        if self.args.patch is not None:
+            self.original = bytes(self.data)
+        with self.phase("KacMap"):
+            self.map = KacMap(self.objects, self.data, Journal(self.data, self.args.undo_budget * 1024 * 1024))
         print("Loaded save for town {}".format(self.map.name))
         print("The map is {} by {}".format(self.map.width, self.map.height))
         return True
 
+    def phase(self, name: str) -> 'ContextManager':
+        """Profile a phase of the editor, if --profile was given"""
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.phase(name)
+
+    def save(self) -> None:
+        if self.args.patch is not None:
+            size = write_patch(self.args.patch, self.original, self.map.file)
+            print("Wrote a {} byte patch to {}".format(size, self.args.patch))
+        if self.args.patch_only:
+            return
+        if self.cache is not None:
+            self.cache.write_file(self.save_file, self.map.file)
+        else:
+            write_save_file(self.save_file, self.map.file)
+
+    def run_apply_patch(self) -> bool:
+        args = self.args
+        paths = batch.expand_inputs(args.inputs)
+        if len(paths) == 0:
+            print("No save files found in {}".format(", ".join(args.inputs)))
+            return False
+        if args.output is not None:
+            os.makedirs(args.output, exist_ok=True)
+
+        start_time = time.perf_counter()
+        results = []
+        for path in paths:
+            result = batch.patch_save(path, args.patch, args.output, None if args.no_backup else args.backup_store,
+                                      not args.force, None if args.no_cache else args.cache_dir)
+            print(batch.format_result(result))
+            results.append(result)
+        failures, summary = batch.summarize(results, time.perf_counter() - start_time)
+        print(summary)
+        return failures == 0
+
+    def run_backup(self) -> bool:
+        args = self.args
+        store = BackupStore(args.backup_store)
+        try:
+            if args.backup_command == "list":
+                for manifest in store.list(args.save):
+                    print("{}  {:>10}  {}  {}".format(
+                        manifest["id"], manifest["size"],
+                        time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(manifest["time"])), manifest["source"]))
+            elif args.backup_command == "restore":
+                print("Restored {} to {}".format(args.id, store.restore(args.id, args.output)))
+            elif args.backup_command == "prune":
+                removed = store.prune(args.keep, args.save)
+                print("Removed {} backups and {} chunks, freeing {} bytes".format(
+                    removed["backups"], removed["chunks"], removed["bytes"]))
+            elif args.backup_command == "stats":
+                stats = store.stats()
+                print("{} backups of {} saves in {} chunks".format(stats["backups"], stats["sources"], stats["chunks"]))
+                print("{} bytes stored for {} bytes of saves, {} bytes saved".format(
+                    stats["stored_bytes"], stats["logical_bytes"], stats["saved_bytes"]))
+            else:
+                print("Choose one of list, restore, prune or stats")
+                return False
+        except ValueError as e:
+            print(e)
+            return False
+        return True
+
+    def run_cache(self) -> bool:
+        args = self.args
+        cache = ParseCache(args.cache_dir)
+        if args.cache_command == "prune":
+            removed = cache.prune(args.max_size * 1024 * 1024)
+            print("Removed {} saves and {} aliases, freeing {} bytes".format(
+                removed["entries"], removed["aliases"], removed["bytes"]))
+        elif args.cache_command == "stats":
+            stats = cache.stats()
+            print("{} saves and {} aliases taking {} bytes in {}".format(
+                stats["entries"], stats["aliases"], stats["bytes"], args.cache_dir))
+        else:
+            print("Choose one of prune or stats")
+            return False
+        return True
+
+    def run_parse_stats(self) -> bool:
+        args = self.args
+        paths = batch.expand_inputs(args.inputs)
+        if len(paths) == 0:
+            print("No save files found in {}".format(", ".join(args.inputs)))
+            return False
+
+        telemetry = ParseTelemetry()
+        for path in paths:
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    parse_save_file(path, telemetry=telemetry)
+            except Exception as e:
+                print("Failed to parse {}: {}: {}".format(path, type(e).__name__, e), file=sys.stderr)
+                return False
+        print(telemetry.format_table(args.classes))
+        if args.json is not None:
+            with open(args.json, mode="w") as new_file:
+                new_file.write(telemetry.to_json())
+        return True
+
+    def run_batch(self) -> bool:
+        args = self.args
+        paths = batch.expand_inputs(args.inputs)
+        if len(paths) == 0:
+            print("No save files found in {}".format(", ".join(args.inputs)))
+            return False
+        if len(args.operations) == 0:
+            print("No operations given; use --op")
+            return False
+
+        start_time = time.perf_counter()
+        results = []
+        try:
+            backup_store = None if args.no_backup else args.backup_store
+            cache_dir = args.cache_dir if args.cache and not args.no_cache else None
+            cache_limit = args.max_cache_size * 1024 * 1024
+            for result in batch.run_batch(paths, args.operations, args.workers, args.output, backup_store, args.patch,
+                                          cache_dir, cache_limit):
+                print(batch.format_result(result))
+                results.append(result)
+        except ValueError as e:
+            print("Invalid operation: {}".format(e))
+            return False
+        failures, summary = batch.summarize(results, time.perf_counter() - start_time)
+        print(summary)
+        return failures == 0
+
     def render(self) -> None:
         pygame.draw.line(self.screen, (255, 255, 255), (640, 0), (640, 640))
 
@@ -134,52 +359,127 @@ class Application(object):
     def main_loop(self):
         os.environ["SDL_VIDEO_WINDOW_POS"] = "50,50"
         self.parse_args()
+        if self.args.command == "batch":
+            if not self.run_batch():
+                sys.exit(1)
+            return
+        if self.args.command == "backup":
+            if not self.run_backup():
+                sys.exit(1)
+            return
+        if self.args.command == "apply-patch":
+            if not self.run_apply_patch():
+                sys.exit(1)
+            return
+        if self.args.command == "cache":
+            if not self.run_cache():
+                sys.exit(1)
+            return
+        if self.args.command == "parse-stats":
+            if not self.run_parse_stats():
+                sys.exit(1)
+            return
+
+        if self.args.profile is not None:
+            self.profiler = PhaseProfiler(self.args.profile)
+        try:
+            self.run_editor()
+        finally:
+            if self.profiler is not None:
+                print("Wrote profiles to {}".format(self.profiler.write()))
+
+    def run_headless(self) -> None:
+        # Go through the same phases as opening the editor and closing it straight away, but write the save
+        # somewhere else, so that profiling a user's save never changes it
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+        with self.phase("start_pygame"):
+            self.start_pygame()
+        with self.phase("render"):
+            self.render()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with self.phase("save"):
+                write_save_file(os.path.join(temp_dir, os.path.basename(self.save_file)), self.map.file)
+        pygame.display.quit()
+
+    def run_editor(self) -> None:
         if not self.parse_save():
             print("Failed to parse save file; quitting...")
             return
 
-        if self._run_gui:
+        if self.args.headless:
+            self.run_headless()
+        elif self._run_gui:
             print("Loading GUI...")
-            self.start_pygame()
-            self.render()
+            with self.phase("start_pygame"):
+                self.start_pygame()
+            with self.phase("render"):
+                self.render()
 
+            clock = pygame.time.Clock()
             running = True
             is_mouse_down = False
             while running:
-                event = pygame.event.wait()
-                if event.type == pygame.QUIT:
-                    running = False
-                    write_save_file(self.save_file, self.map.file)
-                elif event.type == pygame.MOUSEBUTTONDOWN:
-                    x, y = event.pos[0], event.pos[1]
-                    gui = self.gui  # type: Container
-                    if gui.contains((x, y)):
-                        gui.click(x, y)
-                        if gui.dirty:
-                            gui.render(self.screen)
-                    elif self.map_widget.contains((x, y)):
-                        self.map_widget.click(x, y)
-                        self.map_widget.render(self.screen)
-                    is_mouse_down = True
+                # Handle everything that queued up since the last frame, then draw once
+                events = [pygame.event.wait()] + pygame.event.get()
+                flip = False
+                for event in events:
+                    if event.type == pygame.QUIT:
+                        running = False
+                        with self.phase("save"):
+                            self.save()
+                        break
+                    elif event.type == pygame.MOUSEBUTTONDOWN:
+                        x, y = event.pos[0], event.pos[1]
+                        gui = self.gui  # type: Container
+                        if gui.contains((x, y)):
+                            gui.click(x, y)
+                            if gui.dirty:
+                                gui.render(self.screen)
+                            flip = True
+                        elif self.map_widget.contains((x, y)):
+                            self.map_widget.click(x, y)
+                        is_mouse_down = True
+                    elif event.type == pygame.MOUSEBUTTONUP:
+                        is_mouse_down = False
+                        self.map_widget.release()
+                    elif event.type == pygame.MOUSEMOTION:
+                        if is_mouse_down:
+                            self.map_widget.drag(event.pos[0], event.pos[1])
+                    elif event.type == pygame.KEYDOWN:
+                        if event.key == pygame.K_z and event.mod & pygame.KMOD_CTRL:
+                            if event.mod & pygame.KMOD_SHIFT:
+                                self.action_redo()
+                            else:
+                                self.action_undo()
+                        elif event.key == pygame.K_y and event.mod & pygame.KMOD_CTRL:
+                            self.action_redo()
+                        elif event.unicode == "f" or event.unicode == "F":
+                            self.map.turn_all_farms()
+                            self.map_widget.invalidate()
+                        elif event.unicode == "c" or event.unicode == "C":
+                            self.map.clear()
+                            self.map_widget.invalidate()
+                if not running:
+                    break
+
+                with self.phase("render"):
+                    rects = self.map_widget.render(self.screen)
+                if flip:
                     pygame.display.flip()
-                elif event.type == pygame.MOUSEBUTTONUP:
-                    is_mouse_down = False
-                elif event.type == pygame.MOUSEMOTION:
-                    if is_mouse_down:
-                        self.map_widget.click(event.pos[0], event.pos[1])
-                        self.map_widget.render(self.screen)
-                        pygame.display.flip()
-                elif event.type == pygame.KEYDOWN:
-                    if event.unicode == "f" or event.unicode == "F":
-                        self.map.turn_all_farms()
-                        self.map_widget.dirty = True
-                        self.map_widget.render(self.screen)
-                        pygame.display.flip()
-                    elif event.unicode == "c" or event.unicode == "C":
-                        self.map.clear()
-                        self.map_widget.dirty = True
-                        self.map_widget.render(self.screen)
-                        pygame.display.flip()
+                elif len(rects) > 0:
+                    pygame.display.update(rects)
+                if self.args.fps > 0:
+                    clock.tick(self.args.fps)
+
+    def action_undo(self) -> None:
+        self.map_widget.release()
+        if self.map.undo():
+            self.map_widget.invalidate()
+
+    def action_redo(self) -> None:
+        self.map_widget.release()
+        if self.map.redo():
+            self.map_widget.invalidate()
 
     def _handle_click(self, widget: 'Widget', cell_type: int):
         if self._last_widget is widget:
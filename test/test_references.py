@@ -0,0 +1,56 @@
+import os
+import unittest
+
+from kac.datatypes import ArrayInstance, MemberReference, ObjectInstance, RecordType
+from kac.extractor import iter_save_records, parse_save_buffer
+
+
+WORLD = os.path.join(os.path.dirname(__file__), "world")
+
+# Array records the parser reads only the header of, so references to them cannot resolve
+_UNBUILT_ARRAYS = (RecordType.BinaryArray, RecordType.ArraySingleObject, RecordType.ArraySingleString)
+
+
+def _references(registry):
+    for obj in registry:
+        if isinstance(obj, ArrayInstance):
+            values = obj.values if isinstance(obj.values, list) else []
+        elif isinstance(obj, ObjectInstance):
+            values = obj.members
+        else:
+            continue
+        for value in values:
+            if type(value) is MemberReference:
+                yield value
+
+
+class ResolveAllTest(unittest.TestCase):
+    def setUp(self):
+        with open(WORLD, mode="rb") as save_file:
+            self.data = save_file.read()
+        self.registry = parse_save_buffer(self.data).registry
+
+    def test_every_reference_resolves(self):
+        unbuilt = {record.header["object_id"] for record in iter_save_records(self.data)
+                   if record.record_type in _UNBUILT_ARRAYS}
+        unresolved = self.registry.resolve_all()
+        self.assertEqual({reference.idRef for reference in unresolved}, unbuilt)
+
+        references = list(_references(self.registry))
+        self.assertGreater(len(references), len(unresolved))
+        for reference in references:
+            if reference.idRef not in unbuilt:
+                self.assertIsNotNone(reference.target)
+                self.assertIs(reference.target, self.registry.get(reference.idRef))
+
+    def test_unknown_reference_is_reported(self):
+        instance = next(obj for obj in self.registry
+                        if isinstance(obj, ObjectInstance) and not isinstance(obj, ArrayInstance))
+        missing = MemberReference(max(obj.object_id for obj in self.registry) + 1, self.registry)
+        instance.members.append(missing)
+        self.assertIn(missing, self.registry.resolve_all())
+        self.assertIsNone(missing.target)
+
+
+if __name__ == "__main__":
+    unittest.main()